@@ -0,0 +1,214 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import argparse
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from .gpustat import get_card_list
+from .utils import parse_clusters
+
+
+# the key of the total of a partition over all gpu types
+ANY_TYPE = "*"
+
+SPARKS = "▁▂▃▄▅▆▇█"
+
+
+class AvailabilitySeries:
+    """
+    A time series of the free resources per partition and gpu type, stored at `<base_path>/.availability/`.
+
+    `series.bin` is an append-only file of fixed-size records (time, key, free gpus, free cpus, free mem in MB),
+    and `keys.json` maps the key index to "partition|gpu type". Records are appended in time order, so a range
+    query is a binary search over the memory-mapped file. A snapshot of 20 keys every 5 minutes costs ~160KB a day.
+    """
+
+    RECORD = struct.Struct("<dIiiq")
+
+    def __init__(self, base_path: Path) -> None:
+        self.folder = Path(base_path) / ".availability"
+        self.path = self.folder / "series.bin"
+        self.keys_path = self.folder / "keys.json"
+        self.keys: List[str] = self.load_keys()
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def load_keys(self) -> List[str]:
+        try:
+            with open(self.keys_path, "r") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return []
+
+    def key_index(self, partition: str, gpu_type: str) -> Optional[int]:
+        try:
+            return self.keys.index(f"{partition}|{gpu_type}")
+        except ValueError:
+            return None
+
+    def record(self, card_list: dict, now: float = None):
+        """append a snapshot of the card list, never before the last record so that the file stays sorted."""
+        totals = {}
+        for partition, cards in card_list.items():
+            for gpu_type, nodes in cards.items():
+                for key in (f"{partition}|{gpu_type}", f"{partition}|{ANY_TYPE}"):
+                    total = totals.setdefault(key, [0, 0, 0])
+                    for node in nodes:
+                        total[0] += node["gpu"]
+                        total[1] += node["cpu"]
+                        total[2] += node["mem"]
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with open(self.folder / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # other recorders may have added keys
+            self.keys = self.load_keys()
+            new_keys = [key for key in totals if key not in self.keys]
+            if new_keys:
+                self.keys += new_keys
+                with open(self.keys_path.with_suffix(".tmp"), "w") as f:
+                    f.write(json.dumps(self.keys))
+                os.replace(self.keys_path.with_suffix(".tmp"), self.keys_path)
+
+            # take the time under the lock, and clamp it for recorders on other hosts with a skewed clock
+            now = max(time.time() if now is None else now, self.last_time())
+            data = b"".join(
+                self.RECORD.pack(now, self.keys.index(key), gpu, cpu, mem) for key, (gpu, cpu, mem) in totals.items()
+            )
+            with open(self.path, "ab") as f:
+                f.write(data)
+
+    def last_time(self) -> float:
+        """the time of the last record, 0 if there is none."""
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(-self.RECORD.size, os.SEEK_END)
+                return struct.unpack("<d", f.read(8))[0]
+        except OSError:
+            return 0.0
+
+    def query(self, start: float, end: float, key: int = None) -> Iterator[Tuple[float, int, int, int, int]]:
+        """yield the records (time, key, gpus, cpus, mem) in [start, end)."""
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            count = size // self.RECORD.size
+            if count == 0:
+                return
+            with mmap.mmap(f.fileno(), count * self.RECORD.size, access=mmap.ACCESS_READ) as mm:
+                times = _Times(mm, self.RECORD, count)
+                lo, hi = bisect.bisect_left(times, start), bisect.bisect_left(times, end)
+                for i in range(lo, hi):
+                    record = self.RECORD.unpack_from(mm, i * self.RECORD.size)
+                    if key is None or record[1] == key:
+                        yield record
+
+    def hourly(self, partition: str, gpu_type: str = ANY_TYPE, hours: int = 24, now: float = None) -> List[float]:
+        """the average free gpus of each of the last `hours` hours, None if there is no snapshot in that hour."""
+        key = self.key_index(partition, gpu_type)
+        if key is None:
+            return []
+        now = time.time() if now is None else now
+        start = now - hours * 3600
+        sums, counts = [0.0] * hours, [0] * hours
+        for t, _, gpu, _, _ in self.query(start, now, key):
+            i = min(hours - 1, int((t - start) // 3600))
+            sums[i] += gpu
+            counts[i] += 1
+        return [s / c if c else None for s, c in zip(sums, counts)]
+
+    def usually_free(
+        self, partition: str, gpu_type: str = ANY_TYPE, days: int = 7, now: float = None
+    ) -> Optional[int]:
+        """the hour of day with the most free gpus on average over the last days, None if there is no such hour."""
+        key = self.key_index(partition, gpu_type)
+        if key is None:
+            return None
+        now = time.time() if now is None else now
+        sums, counts = [0.0] * 24, [0] * 24
+        for t, _, gpu, _, _ in self.query(now - days * 86400, now, key):
+            hour = datetime.fromtimestamp(t).hour
+            sums[hour] += gpu
+            counts[hour] += 1
+        means = {h: sums[h] / counts[h] for h in range(24) if counts[h]}
+        if len(means) < 12:  # less than half of the day is covered
+            return None
+        if max(means.values()) - min(means.values()) < 1:  # no hour is better than the others
+            return None
+        return max(means, key=means.get)
+
+    def hint(self, partition: str, gpu_type: str = ANY_TYPE) -> str:
+        """e.g. 'Free GPUs in 24h: ▁▁▂▅██▇▃ (usually most free at 02:00).' Empty if nothing is recorded."""
+        hint = ""
+        values = [v for v in self.hourly(partition, gpu_type) if v is not None]
+        if values:
+            hint = f"Free GPUs in 24h: {sparkline(values)}"
+        hour = self.usually_free(partition, gpu_type)
+        if hour is not None:
+            hint += f" (usually most free at {hour:02d}:00)"
+        return f"{hint}." if hint else ""
+
+
+class _Times:
+    """a read-only sequence of the record times, for bisect."""
+
+    def __init__(self, mm: mmap.mmap, record: struct.Struct, count: int) -> None:
+        self.mm, self.record, self.count = mm, record, count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> float:
+        return struct.unpack_from("<d", self.mm, i * self.record.size)[0]
+
+
+def sparkline(values: List[float]) -> str:
+    top = max(values)
+    if top <= 0:
+        return SPARKS[0] * len(values)
+    return "".join(SPARKS[min(len(SPARKS) - 1, int(v / top * (len(SPARKS) - 1) + 0.5))] for v in values)
+
+
+def cli(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="sapp record",
+        description="Record the free resources of the cluster, e.g. from cron, for the availability hints of sapp.",
+    )
+    parser.add_argument(
+        "-i", "--interval", type=float, default=0, help="keep recording every INTERVAL seconds. Default: record once."
+    )
+    args = parser.parse_args(argv)
+
+    from .core import Database
+
+    database = Database()
+    # the same clusters as the forms, so that the keys match the partitions they look up
+    clusters = parse_clusters(database.config.get("clusters", ""))
+    series = AvailabilitySeries(database.base_path)
+    try:
+        while True:
+            try:
+                series.record(get_card_list(clusters))
+            except RuntimeError as e:
+                print(f"sapp record: {e}", file=sys.stderr)
+                if args.interval <= 0:
+                    sys.exit(1)
+            if args.interval <= 0:
+                return
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
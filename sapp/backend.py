@@ -0,0 +1,403 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import getpass
+import http.client
+import json
+import math
+import os
+import queue
+import re
+import select
+import shlex
+import socket
+import subprocess
+import time
+import urllib.parse
+import warnings
+from collections import defaultdict
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import utils
+from .gpustat import GRES_PATTERN, query_card_list
+
+
+class CLIBackend:
+    """Talk to slurm with the command line tools. Each call forks a process and opens a new slurmctld connection."""
+
+    name = "cli"
+
+    def card_list(self, cluster: str = None) -> dict:
+        return query_card_list(cluster)
+
+    def job_states(self, jobids: List[str], cluster: str = None) -> Dict[str, dict]:
+        """the states of the jobs known to slurmctld, i.e. pending, running or recently finished."""
+        states = {}
+        if not jobids:
+            return states
+        # squeue prints the jobs it knows even if some job ids are invalid, so ignore the return code
+        proc = subprocess.run(
+            ["squeue", "-h", "-j", ",".join(jobids), "-o", "%i|%T|%M|%N|%P"] + (["-M", cluster] if cluster else []),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        for line in proc.stdout.decode().splitlines():
+            fields = line.strip().split("|")
+            if len(fields) == 5:
+                states[fields[0]] = {
+                    "state": fields[1],
+                    "elapsed": fields[2],
+                    "node": fields[3],
+                    "partition": fields[4],
+                }
+        return states
+
+    def submit(self, script_path: Path) -> Optional[str]:
+        """submit the batch script and print the output of sbatch. Return the job id or None if it fails."""
+        # we capture the output first, then print them to console
+        result = subprocess.run(["sbatch", str(script_path)], stdout=subprocess.PIPE)
+        output = result.stdout.decode()
+
+        if output:
+            print(output, end="")
+
+        # parse the output, we assert this is the only possible output based on
+        # https://github.com/SchedMD/slurm/blob/01cec7faa194990bc95b8a18adc1c29ac7f8733b/src/sbatch/sbatch.c#L333
+        match = re.match(r"^Submitted batch job (\d+)(?: on cluster .+)?$", output)
+        return match.group(1) if result.returncode == 0 and match else None
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class MaybeSent(Exception):
+    """the request may have reached the server (e.g. a read timeout), so it must not be sent again."""
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections to slurmrestd, reused across calls and threads. A request on a connection closed
+    by the server while idle is sent again on the next connection, but only if it surely never reached the server,
+    or if it is a GET. Otherwise MaybeSent is raised, so that a job is never submitted twice.
+    """
+
+    def __init__(self, url: str, size: int = 4, timeout: float = 30) -> None:
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https", "unix"):
+            raise ValueError(f"Unsupported slurmrestd url {url}. Use http://, https:// or unix://.")
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.socket_path = parsed.path
+        self.timeout = timeout
+        self.idle: queue.LifoQueue = queue.LifoQueue(size)
+
+    def connect(self) -> http.client.HTTPConnection:
+        if self.scheme == "unix":
+            return UnixHTTPConnection(self.socket_path, self.timeout)
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def request(self, method: str, path: str, body: dict = None, headers: dict = None) -> tuple:
+        """return the status and the decoded json body."""
+        headers = {"Accept": "application/json", **(headers or {})}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+
+        while True:
+            try:
+                conn, reused = self.idle.get_nowait(), True
+            except queue.Empty:
+                conn, reused = self.connect(), False
+            if reused and conn.sock is not None and select.select([conn.sock], [], [], 0)[0]:
+                conn.close()  # an idle connection is readable only if the server has closed it
+                continue
+            if conn.sock is None:
+                try:
+                    conn.connect()
+                except OSError:
+                    conn.close()
+                    raise  # nothing was sent
+            try:
+                conn.request(method, path, body=data, headers=headers)
+            except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue  # the server closed the idle connection before we sent anything
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                if method != "GET":
+                    raise MaybeSent(e) from e  # e.g. a timeout while sending the body
+                raise
+
+            try:
+                response = conn.getresponse()
+                payload = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError) as e:
+                conn.close()
+                if reused and method == "GET":
+                    continue  # the idle connection was closed, and a GET is safe to send again
+                if method != "GET":
+                    raise MaybeSent(e) from e
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                if method != "GET":
+                    raise MaybeSent(e) from e  # a timeout or a partial response
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                try:
+                    self.idle.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+            try:
+                return response.status, json.loads(payload or b"{}")
+            except ValueError:
+                return response.status, {}
+
+
+def number(value):
+    """slurmrestd wraps numbers as {"set": true, "infinite": false, "number": 1} since v0.0.39."""
+    if isinstance(value, dict):
+        return value.get("number") if value.get("set", True) and not value.get("infinite") else None
+    return value
+
+
+def state_of(value) -> str:
+    """the base state, e.g. ["MIXED", "DRAIN"] -> MIXED, DRAIN. Older versions use a plain string."""
+    if isinstance(value, list):
+        return "+".join(value)
+    return str(value or "")
+
+
+def human_elapsed(seconds: float) -> str:
+    """the squeue style of the elapsed time, e.g. 1:02, 1:02:03, 1-02:03:04."""
+    seconds = max(0, int(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return f"{days}-{hours:02d}:{minutes:02d}:{seconds:02d}"
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+class Unsupported(Exception):
+    """the request could not be expressed with the rest api, use the command line tools instead."""
+
+
+class RestBackend(CLIBackend):
+    """
+    Talk to slurmrestd with pooled keep-alive connections, so that status queries and submissions are in-process
+    calls. Enabled by `SAPP_SLURMRESTD=unix:///path/to/slurmrestd.sock` or `http://host:6820`. A JWT token is read
+    from `SLURM_JWT` as for the other slurm clients.
+
+    Whatever the rest api could not do (e.g. sbatch options it does not know), or any failure to reach slurmrestd,
+    falls back to the command line tools with a warning.
+    """
+
+    name = "rest"
+
+    def __init__(self, url: str, version: str = "v0.0.40") -> None:
+        self.pool = ConnectionPool(url)
+        self.version = version
+        self.warned = False
+
+    def headers(self) -> dict:
+        headers = {"X-SLURM-USER-NAME": getpass.getuser()}
+        if os.environ.get("SLURM_JWT"):
+            headers["X-SLURM-USER-TOKEN"] = os.environ["SLURM_JWT"]
+        return headers
+
+    def call(self, method: str, endpoint: str, body: dict = None) -> dict:
+        status, data = self.pool.request(method, f"/slurm/{self.version}/{endpoint}", body, self.headers())
+        errors = [e.get("error") or e.get("description") for e in data.get("errors", []) if isinstance(e, dict)]
+        if status >= 400 or errors:
+            raise RuntimeError(f"slurmrestd: {'; '.join(filter(None, errors)) or f'HTTP {status}'}")
+        return data
+
+    def fallback(self, e: Exception):
+        if not self.warned:
+            warnings.warn(f"Fails to use slurmrestd ({e}), use the slurm commands instead.", UserWarning)
+            self.warned = True
+
+    def card_list(self, cluster: str = None) -> dict:
+        if cluster:  # slurmrestd serves its own cluster
+            return super().card_list(cluster)
+        try:
+            nodes = self.call("GET", "nodes")["nodes"]
+        except (OSError, http.client.HTTPException, RuntimeError, KeyError) as e:
+            self.fallback(e)
+            return super().card_list()
+
+        resources = defaultdict(partial(defaultdict, list))
+        for node in nodes:
+            # the same rule as sinfo: idle, mix and alloc nodes without flags like drain
+            if state_of(node.get("state")) not in ("IDLE", "MIXED", "ALLOCATED"):
+                continue
+            gres_match = re.match(GRES_PATTERN, node.get("gres") or "")
+            gres_used_match = re.match(GRES_PATTERN, node.get("gres_used") or "")
+            if gres_match is None or gres_used_match is None:
+                continue
+            gpu_type = gres_match.group(1)
+            if gpu_type == "(null)" or gpu_type == "":
+                gpu_type = "Unknown GPU Type"
+            avail = {
+                "nodelist": node.get("name"),
+                "gpu": int(gres_match.group(2)) - int(gres_used_match.group(2)),
+                "cpu": (number(node.get("cpus")) or 0) - (number(node.get("alloc_cpus")) or 0),
+                "mem": (number(node.get("real_memory")) or 0) - (number(node.get("alloc_memory")) or 0),
+                "features": list(node.get("active_features") or node.get("features") or []),
+            }
+            for partition in node.get("partitions") or []:
+                resources[partition][gpu_type].append(dict(avail))
+        return resources
+
+    def job_states(self, jobids: List[str], cluster: str = None) -> Dict[str, dict]:
+        if not jobids:
+            return {}
+        if cluster:
+            return super().job_states(jobids, cluster)
+
+        # one small request per job on the pooled connections, rather than the whole queue of the cluster
+        jobs = []
+        for jobid in map(str, jobids):
+            try:
+                jobs += self.call("GET", f"job/{jobid}")["jobs"]
+            except RuntimeError:
+                continue  # unknown to slurmctld, e.g. finished long ago. Left to sacct
+            except (OSError, http.client.HTTPException, KeyError) as e:
+                self.fallback(e)
+                return super().job_states(jobids)
+
+        wanted, now = set(map(str, jobids)), time.time()
+        states = {}
+        for job in jobs:
+            jobid = str(job.get("job_id"))
+            if jobid not in wanted:
+                continue
+            state = state_of(job.get("job_state")).split("+")[0]
+            start, end = number(job.get("start_time")), number(job.get("end_time"))
+            if state == "PENDING" or not start:
+                elapsed = 0
+            else:
+                elapsed = (now if state in ("RUNNING", "COMPLETING") or not end else end) - start
+            states[jobid] = {
+                "state": state,
+                "elapsed": human_elapsed(elapsed),
+                "node": job.get("nodes") or "",
+                "partition": job.get("partition") or "",
+            }
+        return states
+
+    def job_description(self, script: str) -> dict:
+        """translate the #SBATCH lines written by `utils.get_command` to the job description of the rest api."""
+        job = {
+            "current_working_directory": os.getcwd(),
+            "environment": [f"{k}={v}" for k, v in os.environ.items()],
+        }
+        for line in script.splitlines():
+            if not line.startswith("#SBATCH"):
+                continue
+            args = shlex.split(line[len("#SBATCH") :])
+            option, value = (args[0].split("=", 1) + [None])[:2] if args else (None, None)
+            if value is None and len(args) == 2:
+                value = args[1]
+            elif value is None or len(args) > 1:
+                raise Unsupported(line)
+
+            if option == "-N":
+                job["minimum_nodes"] = int(value)
+            elif option == "-n":
+                job["tasks"] = int(value)
+            elif option == "--ntasks-per-node":
+                job["tasks_per_node"] = int(value)
+            elif option == "-p":
+                job["partition"] = value
+            elif option == "-c":
+                job["cpus_per_task"] = int(value)
+            elif option == "--gres":
+                job["tres_per_node"] = f"gres/{value}"
+            elif option == "--gpus":
+                job["tres_per_job"] = f"gres/gpu:{value}"
+            elif option == "--gpus-per-node":
+                job["tres_per_node"] = f"gres/gpu:{value}"
+            elif option == "--export" and value.startswith("ALL,"):
+                job["environment"] += value[len("ALL,") :].split(",")
+            elif option == "--constraint":
+                job["constraints"] = value
+            elif option == "--exclude":
+                job["excluded_nodes"] = value.split(",")
+            elif option == "--dependency":
+                job["dependency"] = value
+            elif option == "--kill-on-invalid-dep":
+                job["kill_on_invalid_dependency"] = value == "yes"
+            elif option == "--mem":
+                job["memory_per_node"] = {"set": True, "number": math.ceil(utils.parse_size(value) / (1 << 20))}
+            elif option == "-t":
+                job["time_limit"] = {"set": True, "number": math.ceil(utils.parse_duration(value) / 60)}
+            elif option == "-o":
+                job["standard_output"] = value
+            elif option == "-e":
+                job["standard_error"] = value
+            elif option == "-J":
+                job["name"] = value
+            elif option == "--mail-type":
+                job["mail_type"] = value.split(",")
+            elif option == "--mail-user":
+                job["mail_user"] = value
+            else:
+                raise Unsupported(line)
+        return job
+
+    def submit(self, script_path: Path) -> Optional[str]:
+        script = Path(script_path).read_text()
+        try:
+            job = self.job_description(script)
+        except Unsupported:
+            return super().submit(script_path)  # sbatch knows all the options
+
+        try:
+            data = self.call("POST", "job/submit", {"script": script, "job": job})
+        except MaybeSent as e:  # submitting again with sbatch could run the job twice
+            print(f"slurmrestd: {e.__cause__ or e}. The job may have been submitted, please check squeue.")
+            return None
+        except (OSError, http.client.HTTPException) as e:  # never reached slurmrestd
+            self.fallback(e)
+            return super().submit(script_path)
+        except RuntimeError as e:  # rejected by slurm, like a failed sbatch
+            print(e)
+            return None
+
+        jobid = str(data["job_id"])
+        print(f"Submitted batch job {jobid}")
+        return jobid
+
+
+_backend = None
+
+
+def get_backend() -> CLIBackend:
+    """the backend of this process, chosen by the env var SAPP_SLURMRESTD."""
+    global _backend
+    if _backend is None:
+        url = os.environ.get("SAPP_SLURMRESTD")
+        _backend = RestBackend(url, os.environ.get("SAPP_SLURMRESTD_VERSION", "v0.0.40")) if url else CLIBackend()
+    return _backend
@@ -0,0 +1,31 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import shlex
+from pathlib import Path
+from typing import List
+
+
+def trap(script_path: Path, max_chain: int) -> List[str]:
+    """
+    The script lines to continue a job across the time limit. Slurm sends SIGUSR1 to the script before the limit
+    (`--signal=B:USR1@<lead>`). The trap forwards it to the command so that it could save a checkpoint, and submits
+    the same script again to start after this job ends, up to `max_chain` times. The new job id is written to
+    SLURM_JOB_ID right away, so that the slash proxy lives on while the next job waits, and the job ids of the
+    chain are appended to CHAIN in the job folder.
+    """
+    script = shlex.join([str(script_path)])
+    chain_path = shlex.join([str(Path(script_path).with_name("CHAIN"))])
+    jobid_path = shlex.join([str(Path(script_path).with_name("SLURM_JOB_ID"))])
+    return [
+        "SAPP_CHAIN=${SAPP_CHAIN:-0}",
+        f"echo $SLURM_JOB_ID >> {chain_path}",
+        "resubmit() {",
+        '  kill -USR1 "$pid" 2>/dev/null',
+        f"  if [ $SAPP_CHAIN -lt {max_chain} ]; then",
+        f"    next=$(SAPP_CHAIN=$((SAPP_CHAIN + 1)) sbatch --parsable --dependency=afterany:$SLURM_JOB_ID {script})",
+        f'    [ -n "$next" ] && echo "${{next%%;*}}" > {jobid_path}',  # "jobid;cluster" with -M
+        "  fi",
+        "}",
+        "trap resubmit USR1",
+    ]
@@ -74,6 +74,54 @@ class SlurmConfig:
             "help": "(Optional) Other command line arguments, such as '--exclude ai_gpu02,ai_gpu04'."
         }
     )
+    cluster: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "(Optional) The cluster to submit to. None for the default cluster."
+        }
+    )
+    distributed: bool = field(
+        default=False,
+        metadata={
+            "help": "Run one task per GPU on every node with MASTER_ADDR, MASTER_PORT and RANK set for distributed training."
+        }
+    )
+    cpu_bind: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "(Optional) Bind the tasks to cpus, e.g. cores or sockets. Only for srun steps. Exclusive with hint."
+        }
+    )
+    gpu_bind: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "(Optional) Bind the tasks to gpus, e.g. closest for the gpus on the same NUMA node."
+        }
+    )
+    mem_bind: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "(Optional) Bind the tasks to memory, e.g. local for the NUMA node of the cpus."
+        }
+    )
+    hint: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "(Optional) Scheduling hint, e.g. nomultithread, compute_bound or memory_bound."
+        }
+    )
+    set_threads: bool = field(
+        default=False,
+        metadata={
+            "help": "Export OMP_NUM_THREADS and MKL_NUM_THREADS as the cpus per task."
+        }
+    )
+    constraint: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "(Optional) The node features required, e.g. 'ib&nvlink' or 'a100-80g|h100'."
+        }
+    )
 
 
 @dataclass
@@ -126,6 +174,18 @@ class SubmitConfig:
             "help": "(Optional) Specify the email address to send notification to."
         }
     )
+    resubmit: int = field(
+        default=0,
+        metadata={
+            "help": "Resubmit the sbatch job up to this many times when it reaches the time limit. 0 to disable."
+        }
+    )
+    signal_lead: int = field(
+        default=300,
+        metadata={
+            "help": "Seconds before the time limit to send SIGUSR1 to the command, so that it could save a checkpoint."
+        }
+    )
     task: int = field(
         default=None,
         metadata={
@@ -3,20 +3,31 @@
 
 import json
 import os
-import re
 import shlex
 import shutil
 import socket
-import subprocess
+import threading
+import time
 import warnings
+from contextlib import ExitStack, nullcontext
+from dataclasses import replace
 from datetime import datetime
 from pathlib import Path
 from typing import List
 
 from slash import Slash
 
-from . import utils
+from . import chain, distributed, timeline, utils
+from .backend import get_backend
 from .config import SlurmConfig, SubmitConfig
+from .history import History
+from .jobs import JobIndex
+from .limits import Limits
+from .retry import Blacklist, Retry
+from .runner import Runner
+from .speculative import SpeculativeGroup
+from .tracing import tracer
+from .warm import WarmPool
 
 
 class Database:
@@ -26,8 +37,10 @@ class Database:
         self.base_path = Path(self.SAPP_FOLDER).expanduser()
         self.base_path.mkdir(parents=True, exist_ok=True)
         self.identifier = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        self.limits = Limits(self.base_path)
 
-        self.load()
+        with tracer.span("Database.load"):
+            self.load()
 
     def add(self, config: SlurmConfig):
         self.settings.append(config)
@@ -69,12 +82,58 @@ class Database:
 
         # clean databse
         log_space = self.config.get("log_space", 0)
-        candidates = [p for p in self.base_path.iterdir() if p.is_dir()]
+        candidates = self.job_folders()
         if log_space > 0 and len(candidates) > log_space:  # remove old folders
             to_remove = sorted(candidates)[:-log_space]
             for d in to_remove:
                 shutil.rmtree(d, ignore_errors=True)
 
+    def job_folders(self) -> List[Path]:
+        """return the job folders sorted by submission time. Hidden folders are used by sapp itself."""
+        return sorted(p for p in self.base_path.iterdir() if p.is_dir() and not p.name.startswith("."))
+
+    def find_job(self, key: str = None) -> Path:
+        """
+        Find the job folder by the sapp identifier or the slurm job id. Return the most recent job if key is None.
+        """
+        folders = self.job_folders()
+        if key is None:
+            if not folders:
+                raise FileNotFoundError("No sapp job found.")
+            return folders[-1]
+
+        if (self.base_path / key).is_dir() and not key.startswith("."):
+            return self.base_path / key
+
+        index = JobIndex(self.base_path)
+        for name, entry in sorted(index.refresh().items(), reverse=True):
+            if entry.get("jobid") == key:
+                index.save()
+                return self.base_path / name
+
+        raise FileNotFoundError(f"No sapp job found with identifier or job id {key}.")
+
+    def save_job(self, command: List[str], config: SubmitConfig):
+        """save the job info into the job folder, so that we could find it later."""
+        shell_folder = self.base_path / self.identifier
+        shell_folder.mkdir(parents=True, exist_ok=True)
+
+        data = {
+            "identifier": self.identifier,
+            "pid": os.getpid(),
+            "submit_time": datetime.now().timestamp(),
+            "command": command,
+            "cwd": os.getcwd(),
+            "slurm_config": config.slurm_config.__dict__,
+            **{k: getattr(config, k) for k in config.__dict__.keys() if k != "slurm_config"},
+        }
+        for key in ("output", "error"):
+            if data[key]:
+                data[key] = os.path.abspath(utils.resolve_identifier(data[key], self.identifier))
+
+        with open(shell_folder / "job.json", "w") as f:
+            f.write(json.dumps(data, indent=4))
+
     def dump(self):
         data = {
             "config": self.config,
@@ -85,13 +144,46 @@ class Database:
             },
         }
 
+        # write then rename, since the stages of a workflow are submitted concurrently
         config_path = self.base_path / ".config"
-        with open(config_path, "w") as f:
+        tmp_path = self.base_path / f".config.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
             f.write(json.dumps(data, indent=4))
-
-    def execute(self, command: List[str], config: SubmitConfig):
+        os.replace(tmp_path, config_path)
+
+    def check_limits(self, config: SubmitConfig, count_jobs: bool = False, cached_only: bool = False) -> List[str]:
+        """the reasons that the job could never start under the partition and QOS limits."""
+        with tracer.span("check_limits"):
+            return self.limits.check(config.slurm_config, config.time, self.config, count_jobs, cached_only)
+
+    def execute(
+        self,
+        command: List[str],
+        config: SubmitConfig,
+        prologue: List[str] = None,
+        check: bool = True,
+        dependency: str = None,
+    ):
+        """
+        Execute the command with the config. Return the exit code for srun jobs, or the job id for sbatch jobs.
+        The prologue lines are inserted into the sbatch script right after the job id is saved. If `check`, warn
+        about the partition and QOS limits the job breaks, only if they are cached so that the submission never
+        waits for slurm. The sbatch job waits for the `dependency`, e.g. afterok:123:124, and is cancelled if it
+        could never be satisfied. The blacklisted nodes are excluded, and sbatch jobs are resubmitted on node
+        failures if the general config sets `retries`.
+        """
         self.recent = config
         self.dump()  # dump befure execution
+        prologue = [] if prologue is None else prologue
+
+        if check and config.task in (0, 1):
+            reasons = self.check_limits(config, cached_only=True)
+            if reasons:
+                warnings.warn(f"The job may never start: {'; '.join(reasons)}.", UserWarning)
+
+        # keep away from the nodes that failed the jobs recently, only in the command so that the config stays
+        blacklist_ttl = float(self.config.get("blacklist_ttl", 24)) * 3600
+        bad_nodes = Blacklist(self.base_path, blacklist_ttl).nodes(config.slurm_config.cluster)
 
         def resolve_files(command: List[str]):
             """make a copy for all small (<1M) files mentioned in the command."""
@@ -120,111 +212,181 @@ class Database:
         if not self.config.get("cache", True):
             resolve_files = lambda x: x
 
+        def proxy_lines(host_ip: str, port: int, timeline_path: Path) -> List[str]:
+            """the script lines to export the slash proxy and wait until it accepts connections from the node."""
+            return [
+                f"export http_proxy=http://{host_ip}:{port}",
+                f"export https_proxy=http://{host_ip}:{port}",
+                timeline.wait_for(f"timeout 1 bash -c ': > /dev/tcp/{host_ip}/{port}' 2>/dev/null"),
+                timeline.mark(timeline_path, "proxy_ready"),
+            ]
+
+        def launch_lines(resolved_command: List[str], hostname_path: str, timeline_path: Path) -> List[str]:
+            """
+            the script lines from saving the host to the end, with one task per gpu for distributed jobs and the
+            resubmit trap for chained jobs. The staging ends when the rendezvous is set and the files copied at
+            submission are visible on the node.
+            """
+            run_command = shlex.join(resolved_command)
+            lines = [f"hostname > {shlex.join([hostname_path])}"]
+            if config.slurm_config.distributed:
+                binding = utils.binding_args(config.slurm_config, "srun")
+                run_command = distributed.launch(run_command, config.slurm_config, binding)
+                lines = distributed.rendezvous() + [f"echo $MASTER_ADDR > {shlex.join([hostname_path])}"]
+            elif config.task == 1 and utils.binds_tasks(config.slurm_config):
+                # the batch step is not bound by the #SBATCH options, so run a single task as a bound step
+                if config.slurm_config.nodes == 1 and config.slurm_config.ntasks == 1:
+                    run_command = utils.bound_command(run_command, config.slurm_config)
+                else:
+                    warnings.warn(
+                        "The binding only applies to the srun steps started by the command in batch jobs of "
+                        "several tasks.",
+                        UserWarning,
+                    )
+            data_folder = str(timeline_path.with_name("data"))
+            staged = [arg for arg in resolved_command if os.path.dirname(os.path.abspath(arg)) == data_folder]
+            if staged:  # the shared file system may show the copies on the node a bit later
+                lines += [timeline.wait_for(" && ".join(f"[ -e {shlex.quote(arg)} ]" for arg in staged))]
+            lines += [timeline.mark(timeline_path, "staging_done")]
+            if config.task == 1 and config.resubmit > 0:  # continue the job after the time limit
+                lines += chain.trap(timeline_path.with_name("script.sh"), config.resubmit)
+                return lines + timeline.run(timeline_path, run_command, background=True)
+            return lines + timeline.run(timeline_path, run_command)
+
         # do execution
         if config.task in (0, 2):  # execute srun
-            args = utils.get_command(config, tp="srun", identifier=self.identifier, general_config=self.config)
+            args = utils.get_command(
+                config, tp="srun", identifier=self.identifier, general_config=self.config, exclude=bad_nodes
+            )
+            if config.task == 0 and config.slurm_config.distributed:
+                # salloc runs the script here, and the script starts the tasks on all the nodes with srun
+                args = [
+                    a
+                    for a in utils.get_command(config, tp="salloc", general_config=self.config, exclude=bad_nodes)
+                    if a != "--no-shell"
+                ]
 
             if config.task == 0:
                 # slash may block the process, resolve file first
-                resolved_command = resolve_files(command)
+                with tracer.span("resolve_files"):
+                    resolved_command = resolve_files(command)
 
                 # create folder for this job
                 # it should have been created in resolve_files, but we do it here for safety
                 shell_folder = self.base_path / self.identifier
                 shell_folder.mkdir(parents=True, exist_ok=True)
+                self.save_job(command, config)
                 # the shell script
                 shell_path = shell_folder / "script.sh"
 
                 # save the job info
                 jobid_path = str((shell_folder / "SLURM_JOB_ID").absolute())
                 hostname_path = str((shell_folder / "HOSTNAME").absolute())
+                timeline_path = (shell_folder / "TIMELINE").absolute()
 
                 # get the host ip
                 host_ip = socket.gethostbyname(socket.gethostname())
 
-                if config.slash == "none":
-                    # write the shell script
-                    with open(shell_path, "w") as f:
-                        print("#!/usr/bin/bash", file=f)
-                        print("", file=f)
-                        print(f"echo $SLURM_JOB_ID > {shlex.join([jobid_path])}", file=f)
-                        print(f"hostname > {shlex.join([hostname_path])}", file=f)
-                        print(shlex.join(resolved_command), file=f)
-
-                    # set env vars for tqdm
-                    utils.set_screen_shape()
+                # run inside a warm allocation if the user enables it
+                allocation, pool = nullcontext(args), None
+                if self.config.get("warm", False) and not config.slurm_config.distributed:
+                    pool = WarmPool(self.base_path, timeout=int(self.config.get("warm_timeout", 30)) * 60)
+                    allocation = pool.acquire(config, self.config, identifier=self.identifier, exclude=bad_nodes)
 
-                    # add commands
-                    args += ["bash", str(shell_path)]
-                    os.system(shlex.join(args))
-
-                else:
-                    # let the slash service live with the current process
-                    with Slash(env_name=config.slash) as slash:
-                        port = slash.service.port
+                with allocation as args:
+                    # the job id will be backfilled from the job folder, except for the runs in a warm allocation
+                    with History(self.base_path) as history:
+                        history.record(self.identifier, config, warm=pool is not None and pool.jobid is not None)
 
+                    if config.slash == "none":
                         # write the shell script
                         with open(shell_path, "w") as f:
                             print("#!/usr/bin/bash", file=f)
                             print("", file=f)
-                            print(f"export http_proxy=http://{host_ip}:{port}", file=f)
-                            print(f"export https_proxy=http://{host_ip}:{port}", file=f)
+                            print(timeline.mark(timeline_path, "alloc_start"), file=f)
                             print(f"echo $SLURM_JOB_ID > {shlex.join([jobid_path])}", file=f)
-                            print(f"hostname > {shlex.join([hostname_path])}", file=f)
-                            print(shlex.join(resolved_command), file=f)
+                            print("\n".join(launch_lines(resolved_command, hostname_path, timeline_path)), file=f)
 
                         # set env vars for tqdm
                         utils.set_screen_shape()
 
                         # add commands
-                        # FIXME: I use os.system here because I don't know how to use
-                        # subprocess to run a command while passing the SIGINT signal
-                        # to the child process in an elegant way. See
-                        # https://docs.python.org/3/library/subprocess.html#replacing-os-system
                         args += ["bash", str(shell_path)]
-                        os.system(shlex.join(args))
+                        return Runner(args, shell_folder, tee=self.config.get("tee", False)).run()
+
+                    else:
+                        # let the slash service live with the current process
+                        with ExitStack() as stack:
+                            with tracer.span("slash launch"):
+                                slash = stack.enter_context(Slash(env_name=config.slash))
+                            port = slash.service.port
+
+                            # write the shell script
+                            with open(shell_path, "w") as f:
+                                print("#!/usr/bin/bash", file=f)
+                                print("", file=f)
+                                print(timeline.mark(timeline_path, "alloc_start"), file=f)
+                                print("\n".join(proxy_lines(host_ip, port, timeline_path)), file=f)
+                                print(f"echo $SLURM_JOB_ID > {shlex.join([jobid_path])}", file=f)
+                                print("\n".join(launch_lines(resolved_command, hostname_path, timeline_path)), file=f)
+
+                            # set env vars for tqdm
+                            utils.set_screen_shape()
+
+                            # add commands
+                            args += ["bash", str(shell_path)]
+                            return Runner(args, shell_folder, tee=self.config.get("tee", False)).run()
 
             elif config.task == 2:
                 args += command
                 print(" ".join(args))
 
         elif config.task in (1, 3):  # execute sbatch
-            args = utils.get_command(config, tp="sbatch", identifier=self.identifier, general_config=self.config)
+            args = utils.get_command(
+                config, tp="sbatch", identifier=self.identifier, general_config=self.config, exclude=bad_nodes
+            )
+            if dependency:
+                args += [f"#SBATCH --dependency={dependency}", "#SBATCH --kill-on-invalid-dep=yes"]
             args += [""]
 
             if config.task == 1:
                 # slash may block the process, resolve file first
-                resolved_command = resolve_files(command)
+                with tracer.span("resolve_files"):
+                    resolved_command = resolve_files(command)
 
                 # create folder for this job
                 # it should have been created in resolve_files, but we do it here for safety
                 shell_folder = self.base_path / self.identifier
                 shell_folder.mkdir(parents=True, exist_ok=True)
+                self.save_job(command, config)
 
                 # save the job info
                 jobid_path = str((shell_folder / "SLURM_JOB_ID").absolute())
                 hostname_path = str((shell_folder / "HOSTNAME").absolute())
+                timeline_path = (shell_folder / "TIMELINE").absolute()
 
                 # get the host ip
                 host_ip = socket.gethostbyname(socket.gethostname())
 
                 if config.slash == "none":
+                    args += [timeline.mark(timeline_path, "alloc_start")]
                     args += [f"echo $SLURM_JOB_ID > {shlex.join([jobid_path])}"]
-                    args += [f"hostname > {shlex.join([hostname_path])}"]
-                    args += [shlex.join(resolved_command)]
+                    args += prologue
+                    args += launch_lines(resolved_command, hostname_path, timeline_path)
 
                 else:
                     # init clash
                     slash = Slash(env_name=config.slash)
                     jobname = f"__sapp_{os.getpid()}_{self.identifier}__"
-                    service = slash.launch(jobname)
+                    with tracer.span("slash launch"):
+                        service = slash.launch(jobname)
                     port = service.port
 
-                    args += [f"export http_proxy=http://{host_ip}:{port}"]
-                    args += [f"export https_proxy=http://{host_ip}:{port}"]
+                    args += [timeline.mark(timeline_path, "alloc_start")]
+                    args += proxy_lines(host_ip, port, timeline_path)
                     args += [f"echo $SLURM_JOB_ID > {shlex.join([jobid_path])}"]
-                    args += [f"hostname > {shlex.join([hostname_path])}"]
-                    args += [shlex.join(resolved_command)]
+                    args += prologue
+                    args += launch_lines(resolved_command, hostname_path, timeline_path)
 
                 # write the shell script
                 shell_path = shell_folder / "script.sh"
@@ -240,29 +402,61 @@ class Database:
                     print("Stderr filepath:", utils.resolve_identifier(config.error, self.identifier))
 
                 # submit the job
-                # we capture the output first, then print them to console
-                result = subprocess.run(["sbatch", str(shell_path)], stdout=subprocess.PIPE)
-                output = result.stdout.decode()
-
-                if output:
-                    print(output, end="")
-
-                # if we launch the slash service, do some preparation
-                if config.slash != "none":
-                    # parse the output, we assert this is the only possible output based on
-                    # https://github.com/SchedMD/slurm/blob/01cec7faa194990bc95b8a18adc1c29ac7f8733b/src/sbatch/sbatch.c#L333
-                    match = re.match(r"^Submitted batch job (\d+)(?: on cluster .+)?$", output)
-
-                    # if success, save the job id
-                    if result.returncode == 0 and match:
-                        jobid = match.group(1)
-                        with open(jobid_path, "w") as f:
-                            f.write(jobid)
-
-                    # if failed, stop the slash service
-                    else:
-                        slash.stop(jobname)
+                submit_start = time.time()
+                with tracer.span("sbatch"):
+                    jobid = get_backend().submit(shell_path)
+                submit_latency = time.time() - submit_start
+
+                # if success, save the job id
+                if jobid is not None:
+                    with open(jobid_path, "w") as f:
+                        f.write(jobid)
+                    with History(self.base_path) as history:
+                        history.record(self.identifier, config, jobid, submit_latency=submit_latency)
+                    # speculative jobs and workflow stages are followed by the others, do not resubmit them
+                    retries = int(self.config.get("retries", 0))
+                    if retries > 0 and not prologue and not dependency:
+                        Retry(shell_folder, retries, blacklist_ttl).spawn_watcher()
+                    return jobid
+
+                # if failed, stop the slash service
+                elif config.slash != "none":
+                    slash.stop(jobname)
 
             elif config.task == 3:
                 args += [shlex.join(command)]
                 print("\n".join(args))
+
+    def execute_speculative(self, command: List[str], config: SubmitConfig, slurm_configs: List[SlurmConfig]):
+        """
+        Submit the command with sbatch under several slurm configs at once. The first job to start runs the
+        command and the others are cancelled. Return the job ids submitted.
+        """
+        identifier = self.identifier
+        group = SpeculativeGroup(self.base_path, identifier)
+        jobids = []
+        for k, slurm_config in enumerate(slurm_configs):
+            # each job has its own folder, like a normal sbatch job
+            self.identifier = f"{identifier}_{k}"
+            # the next link of a chain would find the group claimed and cancel itself
+            submit_config = replace(config, slurm_config=slurm_config, task=1, resubmit=0)
+            reasons = self.check_limits(submit_config)
+            if reasons:  # the others will start first anyway
+                warnings.warn(f"Skip setting {slurm_config.name}: {'; '.join(reasons)}.", UserWarning)
+                continue
+            jobid = self.execute(command, submit_config, group.prologue(), check=False)
+            if jobid is not None:
+                group.add(
+                    self.identifier,
+                    jobid,
+                    config.slash,
+                    f"__sapp_{os.getpid()}_{self.identifier}__",
+                    slurm_config.cluster,
+                )
+                jobids.append(jobid)
+        self.identifier = identifier
+
+        group.save()
+        if len(jobids) > 1:
+            group.spawn_watcher()
+        return jobids
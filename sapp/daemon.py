@@ -1,15 +1,19 @@
 # Copyright (c) Haoyi Wu.
 # Licensed under the MIT license.
 
+import json
 import os
 import re
-import subprocess
 import sys
 from pathlib import Path
 from typing import List
 
 from slash.daemon import Daemon
 
+from .backend import get_backend
+from .jobs import FINAL_STATES
+from .retry import watching
+
 
 class SappDaemon(Daemon):
     """
@@ -50,12 +54,22 @@ class SappDaemon(Daemon):
         if not jobid_path.exists():
             return False
 
+        # the job failed on a bad node and is being resubmitted
+        if watching(jobid_path.parent):
+            return True
+
         # get the jobid
         with open(jobid_path, "r") as f:
             jobid = f.read().strip()
 
+        # the job may run on another cluster
+        cluster = None
+        try:
+            with open(jobid_path.parent / "job.json", "r") as f:
+                cluster = json.load(f).get("slurm_config", {}).get("cluster")
+        except (OSError, ValueError):
+            pass
+
         # check the job status
-        proc = subprocess.run(
-            ["squeue", "-j", str(jobid), "-O", "state", "--nohead"], stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        return proc.returncode == 0 and proc.stdout.decode().strip()
+        state = get_backend().job_states([jobid], cluster).get(jobid)
+        return state is not None and state["state"] not in FINAL_STATES
@@ -0,0 +1,50 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import shlex
+from typing import List
+
+from .config import SlurmConfig
+
+
+# print a free tcp port of the host
+FREE_PORT = "python3 -c 'import socket; s = socket.socket(); s.bind((\"\", 0)); print(s.getsockname()[1])'"
+
+
+def tasks_per_node(slurm_config: SlurmConfig) -> int:
+    """one task per gpu, or one task per node for cpu jobs."""
+    return max(1, slurm_config.num_gpus)
+
+
+def rendezvous() -> List[str]:
+    """
+    The script lines to export the rendezvous address of the job, i.e. the head node of the allocation and a free
+    port on it. The script runs on the head node for sbatch and on the login node for interactive jobs.
+    """
+    return [
+        'export MASTER_ADDR=$(scontrol show hostnames "$SLURM_JOB_NODELIST" | head -n 1)',
+        'if [ "$(hostname -s)" = "$MASTER_ADDR" ]; then',
+        f"  export MASTER_PORT=$({FREE_PORT})",
+        "else",
+        f'  export MASTER_PORT=$(srun --overlap -N 1 -n 1 -w "$MASTER_ADDR" {FREE_PORT})',
+        "fi",
+    ]
+
+
+def launch(command: str, slurm_config: SlurmConfig, extra_args: List[str] = None) -> str:
+    """
+    The srun command to run the command as one task per gpu on every node. Each task gets the variables read by
+    torch.distributed (env://), accelerate, deepspeed and lightning. The environment, including the slash proxy,
+    is passed to all the nodes by srun. `extra_args` are added to srun, e.g. the binding options.
+    """
+    ntasks = tasks_per_node(slurm_config)
+    task = (
+        "export RANK=$SLURM_PROCID LOCAL_RANK=$SLURM_LOCALID NODE_RANK=$SLURM_NODEID WORLD_SIZE=$SLURM_NTASKS "
+        f"LOCAL_WORLD_SIZE={ntasks}; exec {command}"
+    )
+    args = ["srun", "-N", "$SLURM_JOB_NUM_NODES", f"--ntasks-per-node={ntasks}", "-c", str(slurm_config.cpus_per_task)]
+    args += ["--kill-on-bad-exit=1"]
+    if slurm_config.unbuffered:
+        args += ["-u"]
+    args += [shlex.quote(arg) for arg in extra_args or []]
+    return " ".join(args + ["bash", "-c", shlex.quote(task)])
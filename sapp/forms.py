@@ -2,70 +2,30 @@
 # Licensed under the MIT license.
 
 import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import replace
+from functools import partial
 
 import npyscreen
 from slash import Slash
 
 from . import utils
+from .availability import AvailabilitySeries
 from .config import SlurmConfig, SubmitConfig
 from .core import Database
-from .gpustat import get_card_list
-
-
-def satisfy(req: dict, avail: dict) -> int:
-    """
-    Check if the requirements are satisfied by the available resources.
-    If so, return the number of jobs that could be run.
-    """
-    # default requirements
-    if req is None:
-        req = {"gpu": 1, "cpu": 1, "mem": "0"}
-
-    # check cpu (must be at least 1)
-    max_avail = avail["cpu"] // max(1, req["cpu"])
-
-    # check gpu
-    if req["gpu"] > 0:
-        max_avail = min(max_avail, avail["gpu"] // req["gpu"])
-
-    # check memory
-    ## convert the memory to MB
-    mem = req["mem"].strip().lower()
-
-    try:
-        if mem.endswith("k"):
-            mem = float(mem[:-1]) / 1024
-        elif mem.endswith("m"):
-            mem = float(mem[:-1])
-        elif mem.endswith("g"):
-            mem = float(mem[:-1]) * 1024
-        elif mem.endswith("t"):
-            mem = float(mem[:-1]) * 1024 * 1024
-        else:
-            mem = float(mem)
-    except ValueError:
-        # edge cases like '' or incomplete input
-        mem = 0
-
-    if mem > 0:
-        max_avail = min(max_avail, avail["mem"] // mem)
-
-    return int(max_avail)
-
-
-def avail_of(config: SlurmConfig, card_list: dict) -> int:
-    """return the number of jobs that could be run with the given config."""
-    partition = config.partition
-    gpu_type = config.gpu_type
-    req = {"gpu": config.num_gpus, "cpu": config.cpus_per_task, "mem": config.mem}
-    if partition not in card_list:
-        return 0
-    if gpu_type == "Any Type":
-        candidates = [node for gpu_type in card_list[partition] for node in card_list[partition][gpu_type]]
-    else:
-        candidates = card_list[partition].get(gpu_type, [])
-    return sum(satisfy(req, node) for node in candidates)
+from .gpustat import (
+    avail_of,
+    feature_index,
+    get_card_list,
+    match_constraint,
+    partition_key,
+    satisfy,
+    split_partition_key,
+)
+from .history import History
+from .predict import WaitPredictor, human_wait, rank_settings, right_size, save_ranking, sync
+from .tracing import tracer
 
 
 class Slider(npyscreen.Slider):
@@ -110,12 +70,31 @@ class MenuForm(npyscreen.FormBaseNew):
         preview = "Run with the same setting as you last time use SAPP without a job name. A quick entry for fast job submission."
         if parentApp.database.recent:
             avail = avail_of(parentApp.database.recent.slurm_config, parentApp.card_list)
+            wait = human_wait(
+                parentApp.predictor.predict(parentApp.database.recent.slurm_config, parentApp.database.recent.time)
+            )
             preview = f"{' '.join(utils.get_command(parentApp.database.recent, 'srun', parentApp.database.identifier, parentApp.database.config))}"
             if parentApp.database.recent.task in (1, 3):
                 preview = "sbatch" + preview[4:]
-            preview = f"Preview ({avail}): " + preview
+            preview = f"Preview ({avail}, wait {wait}): " + preview
+
+        # rank the saved settings by the expected time to start
+        default_time = parentApp.database.config.get("default_time", "0-01:00:00")
+        self.ranking = rank_settings(
+            parentApp.database.settings, parentApp.card_list, parentApp.predictor, default_time
+        )
+        fastest = "No saved setting fits the current cluster. Select a setting by hand."
+        if self.ranking:
+            best = self.ranking[0]
+            prediction = (best["predicted_wait"], best["samples"]) if best["predicted_wait"] is not None else None
+            fastest = (
+                f"Fastest: {best['config'].name} (Available: {best['available']}, Wait: {human_wait(prediction)}). "
+                "Pick the saved setting expected to start first, then set the job details."
+            )
+
         self.options = [
             ("Execute with the most recent setting", preview),
+            ("Execute with the fastest-starting setting...", fastest),
             (
                 "Select from pre-defined settings...",
                 "Run with an existing setting. You may further specify the job name and more details.",
@@ -148,25 +127,31 @@ class MenuForm(npyscreen.FormBaseNew):
 
     def afterEditing(self):
         if self.field.value[0] == 1:
-            self.parentApp.setNextForm("select_config")
+            if not self.ranking:
+                self.parentApp.setNextForm("select_config")
+            else:
+                self.parentApp.getForm("submit").submit_config.slurm_config = self.ranking[0]["config"]
+                self.parentApp.setNextForm("submit")
         elif self.field.value[0] == 2:
+            self.parentApp.setNextForm("select_config")
+        elif self.field.value[0] == 3:
             greetings = "Create a new slurm config."
             if not self.parentApp.database.recent:
                 greetings = "Welcome to SAPP! To use SAPP for the first time, please create a slurm setting."
             self.parentApp.getForm("new_config").update(None, greetings)
             self.parentApp.setNextForm("new_config")
-        elif self.field.value[0] == 3:
+        elif self.field.value[0] == 4:
             self.parentApp.getForm("new_config").update(
                 None, "Create a new slurm config for one-time execution.", True
             )
             self.parentApp.setNextForm("new_config")
-        elif self.field.value[0] == 4:
-            self.parentApp.setNextForm("edit_run_config")
         elif self.field.value[0] == 5:
             self.parentApp.setNextForm("edit_run_config")
         elif self.field.value[0] == 6:
-            self.parentApp.setNextForm("remove_config")
+            self.parentApp.setNextForm("edit_run_config")
         elif self.field.value[0] == 7:
+            self.parentApp.setNextForm("remove_config")
+        elif self.field.value[0] == 8:
             self.parentApp.setNextForm("general_config")
         else:
             self.parentApp.setNextForm(None)
@@ -204,7 +189,7 @@ class MenuForm(npyscreen.FormBaseNew):
         )
 
         if not self.parentApp.database.recent:
-            self.field.value = [2]
+            self.field.value = [3]
 
 
 class RoundCheckBox(npyscreen.RoundCheckBox):
@@ -312,6 +297,21 @@ class FormMultiPageAction(npyscreen.FormMultiPageAction):
         self.empty_line = self.add(npyscreen.FixedText, editable=False, value="")
 
 
+BINDING_CHOICES = [
+    "none: no binding",
+    "gpu: cores, memory and GPUs of the same NUMA node",
+    "gpu-nosmt: one thread per core, memory and GPUs of the same NUMA node",
+    "cpu: cores and memory of the same NUMA node",
+    "memory-bound: spread over the sockets, local memory",
+    "custom: the options in the saved setting",
+]
+
+
+def binding_index(slurm_config: SlurmConfig) -> int:
+    preset = utils.binding_preset(slurm_config)
+    return list(utils.BINDING_PRESETS).index(preset) if preset is not None else len(utils.BINDING_PRESETS)
+
+
 class SlurmConfigForm(FormMultiPageAction):
     def __init__(
         self,
@@ -332,6 +332,10 @@ class SlurmConfigForm(FormMultiPageAction):
         self.card_list = parentApp.card_list
         self.partitions = list(self.card_list.keys())
         self.cards = {p: list(self.card_list[p].keys()) for p in self.partitions}
+        self.features = feature_index(self.card_list)
+        self.availability = parentApp.availability
+        self.limits = parentApp.database.limits
+        self.hint = ""
 
         super().__init__(name, parentApp, framed, help, color, widget_list, cycle_widgets, *args, **keywords)
 
@@ -341,14 +345,20 @@ class SlurmConfigForm(FormMultiPageAction):
             self.slurm_config.name = self.get_widget("name").value
         self.slurm_config.nodes = int(self.get_widget("nodes").value)
         self.slurm_config.ntasks = int(self.get_widget("ntasks").value)
+        self.slurm_config.distributed = self.get_widget("distributed").value == [1]
         self.slurm_config.disable_status = self.get_widget("disable_status").value == [0]
         self.slurm_config.unbuffered = self.get_widget("unbuffered").value == [0]
         p = self.partitions[self.get_widget("partition").value[0]]
-        self.slurm_config.partition = p
+        self.slurm_config.partition, self.slurm_config.cluster = split_partition_key(p)
         self.slurm_config.gpu_type = ["Any Type", *self.cards[p]][self.get_widget("gpu_type").value[0]]
         self.slurm_config.num_gpus = int(self.get_widget("num_gpus").value)
         self.slurm_config.cpus_per_task = int(self.get_widget("cpus_per_task").value)
         self.slurm_config.mem = self.get_widget("mem").value
+        self.slurm_config.constraint = self.get_widget("constraint").value or None
+        presets = list(utils.BINDING_PRESETS.values())
+        if self.get_widget("binding").value[0] < len(presets):  # keep the custom options as they are
+            for key, value in presets[self.get_widget("binding").value[0]].items():
+                setattr(self.slurm_config, key, value)
         self.slurm_config.other = self.get_widget("other").value
 
         # write to submit config
@@ -371,14 +381,14 @@ class SlurmConfigForm(FormMultiPageAction):
         partitions = self.partitions
         cards = self.cards
 
-        def avail_of(partition: str, gpu_type: str = None, req: dict = None) -> int:
+        def avail_of(partition: str, gpu_type: str = None, req: dict = None, constraint: str = None) -> int:
             if partition not in card_list:
                 return 0
             if gpu_type is None:
                 candidates = [node for gpu_type in card_list[partition] for node in card_list[partition][gpu_type]]
             else:
                 candidates = card_list[partition].get(gpu_type, [])
-            return sum(satisfy(req, node) for node in candidates)
+            return sum(satisfy(req, node) for node in candidates if match_constraint(constraint, node.get("features")))
 
         self.auto_add(
             npyscreen.TitleText,
@@ -406,6 +416,17 @@ class SlurmConfigForm(FormMultiPageAction):
             name="# tasks",
             comments="Specify the number of tasks to run. Do not change unless you know its meaning.",
         )
+        self.auto_add(
+            TitleSelectOne,
+            w_id="distributed",
+            max_height=2,
+            value=[1 if self.slurm_config.distributed else 0],
+            name="Distributed",
+            values=["No", "Yes"],
+            scroll_exit=True,
+            select_exit=True,
+            comments="Run one task per GPU on every node with MASTER_ADDR, MASTER_PORT, RANK, LOCAL_RANK and WORLD_SIZE set, e.g. for torch.distributed. # tasks is ignored.",
+        )
         self.auto_add(
             TitleSelectOne,
             w_id="disable_status",
@@ -429,14 +450,13 @@ class SlurmConfigForm(FormMultiPageAction):
             comments="Always flush the outputs to console. Only useful for srun. Safe to leave it untouched.",
         )
 
+        key = partition_key(self.slurm_config.partition, self.slurm_config.cluster)
         height = max(2, min(len(partitions), max(5, self.lines - self.text.height - 6)))
         partition_widget = self.auto_add(
             TitleSelectOne,
             w_id="partition",
             max_height=height,
-            value=(
-                [0] if self.slurm_config.partition not in partitions else partitions.index(self.slurm_config.partition)
-            ),
+            value=[partitions.index(key) if key in partitions else 0],
             name="Partition",
             values=[f"{p} (Available: {avail_of(p)})" for p in partitions],
             scroll_exit=True,
@@ -485,6 +505,24 @@ class SlurmConfigForm(FormMultiPageAction):
             name="Memory",
             comments="(Optional) Specify the real memory required per node. E.g. 40G.",
         )
+        self.auto_add(
+            TitleSelectOne,
+            w_id="binding",
+            max_height=3,
+            value=[binding_index(self.slurm_config)],
+            name="Binding",
+            values=BINDING_CHOICES,
+            scroll_exit=True,
+            select_exit=True,
+            comments="Bind the tasks to the cpus, memory and GPUs of the same NUMA node, and set OMP_NUM_THREADS/MKL_NUM_THREADS to the cpus per task. (press arrow keys to show presets)",
+        )
+        constraint_widget = self.auto_add(
+            npyscreen.TitleText,
+            w_id="constraint",
+            value=self.slurm_config.constraint,
+            name="Constraint",
+            comments="(Optional) Node features required, e.g. ib&nvlink or a100|h100.",
+        )
         self.auto_add(
             npyscreen.TitleText,
             w_id="other",
@@ -500,14 +538,41 @@ class SlurmConfigForm(FormMultiPageAction):
                 "mem": str(num_mem_widget.value),
             }
 
+        # hints from the recorded availability of the partition, see `sapp record`
+        hints = {}
+
+        def update_hints(p: str):
+            if p not in hints:
+                hints[p] = self.availability.hint(p) if self.availability.exists() else ""
+            partition_widget.comments = f"Request a specific partition for the resource allocation. {hints[p]}"
+            gpu_type_widget.comments = f"GPU type for allocation. {hints[p]}"
+
+        update_hints(partitions[partition_widget.value[0]])
+
+        def update_features(p: str):
+            """count the jobs that fit on the nodes of each feature in the partition."""
+            counts = [
+                f"{f} {sum(satisfy(getreq(), node) for node in nodes)}"
+                for f, nodes in sorted(self.features[p].items())
+            ]
+            constraint_widget.comments = "(Optional) Node features required, e.g. ib&nvlink or a100|h100."
+            if counts:
+                constraint_widget.comments += f" Available by feature: {', '.join(counts)}."
+
+        update_features(partitions[partition_widget.value[0]])
+
         def when_value_edited():
             p = partitions[partition_widget.value[0]]
             if p == when_value_edited.old_p:
                 return
             when_value_edited.old_p = p
+            update_hints(p)
+            update_features(p)
+            self.show_limits()
+            constraint = constraint_widget.value
             gpu_type_widget.value = [0]
-            gpu_type_widget.values = [f"Any Type (Available: {avail_of(p, req=getreq())})"] + [
-                f"{c} (Available: {avail_of(p, c, req=getreq())})" for c in cards[p]
+            gpu_type_widget.values = [f"Any Type (Available: {avail_of(p, None, getreq(), constraint)})"] + [
+                f"{c} (Available: {avail_of(p, c, getreq(), constraint)})" for c in cards[p]
             ]
             gpu_type_widget.update()
 
@@ -516,15 +581,25 @@ class SlurmConfigForm(FormMultiPageAction):
 
         def when_value_edited_req():
             p = partitions[partition_widget.value[0]]
-            partition_widget.values = [f"{p} (Available: {avail_of(p, req=getreq())})" for p in partitions]
-            gpu_type_widget.values = [f"Any Type (Available: {avail_of(p, req=getreq())})"] + [
-                f"{c} (Available: {avail_of(p, c, req=getreq())})" for c in cards[p]
+            constraint = constraint_widget.value
+            partition_widget.values = [
+                f"{p} (Available: {avail_of(p, None, getreq(), constraint)})" for p in partitions
             ]
+            gpu_type_widget.values = [f"Any Type (Available: {avail_of(p, None, getreq(), constraint)})"] + [
+                f"{c} (Available: {avail_of(p, c, getreq(), constraint)})" for c in cards[p]
+            ]
+            update_features(p)
+            self.show_limits()
             self.display()  # redraw the form so that no display problem
 
         num_gpu_widget.entry_widget.when_value_edited = when_value_edited_req
         num_cpu_widget.entry_widget.when_value_edited = when_value_edited_req
         num_mem_widget.entry_widget.when_value_edited = when_value_edited_req
+        constraint_widget.entry_widget.when_value_edited = when_value_edited_req
+        for key in ("nodes", "ntasks", "distributed", "gpu_type", "other"):
+            self.get_widget(key).entry_widget.when_value_edited = self.show_limits
+
+        self.default_comments = {key: self.get_widget(key).comments for key in ("cpus_per_task", "mem")}
 
     def pre_edit_loop(self):
         super().pre_edit_loop()
@@ -550,16 +625,14 @@ class SlurmConfigForm(FormMultiPageAction):
                 self.get_widget("name").value = self.slurm_config.name
             self.get_widget("nodes").value = self.slurm_config.nodes
             self.get_widget("ntasks").value = self.slurm_config.ntasks
+            self.get_widget("distributed").value = [1 if self.slurm_config.distributed else 0]
             self.get_widget("disable_status").value = [0 if self.slurm_config.disable_status else 1]
             self.get_widget("unbuffered").value = [0 if self.slurm_config.unbuffered else 1]
-            self.get_widget("partition").value = (
-                [self.partitions.index(self.slurm_config.partition)]
-                if self.slurm_config.partition in self.partitions
-                else [0]
-            )
+            key = partition_key(self.slurm_config.partition, self.slurm_config.cluster)
+            self.get_widget("partition").value = [self.partitions.index(key)] if key in self.partitions else [0]
             self.get_widget("partition").update()  # we must update early to get the correct gpu_type
             self.get_widget("partition").entry_widget.when_value_edited()  # update options for gpu_type
-            avail_cards = self.cards.get(self.slurm_config.partition, [])
+            avail_cards = self.cards.get(key, [])
             self.get_widget("gpu_type").value = [
                 0
                 if self.slurm_config.gpu_type == "Any Type"
@@ -575,22 +648,90 @@ class SlurmConfigForm(FormMultiPageAction):
             self.get_widget("cpus_per_task").entry_widget.when_value_edited()  # update available cpus
             self.get_widget("mem").value = self.slurm_config.mem
             self.get_widget("mem").entry_widget.when_value_edited()  # update available mem
+            self.get_widget("binding").value = [binding_index(self.slurm_config)]
+            self.get_widget("constraint").value = self.slurm_config.constraint
+            self.get_widget("constraint").entry_widget.when_value_edited()  # update available nodes
             self.get_widget("other").value = self.slurm_config.other
 
             for key in (
                 "name",
                 "nodes",
                 "ntasks",
+                "distributed",
                 "disable_status",
                 "unbuffered",
                 "gpu_type",
                 "num_gpus",
                 "cpus_per_task",
                 "mem",
+                "binding",
+                "constraint",
                 "other",
             ):
                 self.get_widget(key).update()
 
+        self.suggest(slurm_config)
+        self.show_limits()
+
+    def suggest(self, slurm_config: SlurmConfig = None):
+        """suggest tighter memory and cpus from the usage of the past jobs of the config."""
+        self.hint = ""
+        for key, comments in self.default_comments.items():
+            self.get_widget(key).comments = comments
+        if slurm_config is None:
+            return
+
+        suggestion = right_size(slurm_config, self.parentApp.history)
+        if suggestion is None:
+            return
+
+        tight = replace(
+            slurm_config,
+            mem=suggestion["mem"] or slurm_config.mem,
+            cpus_per_task=suggestion["cpus_per_task"] or slurm_config.cpus_per_task,
+        )
+        changes = []
+        if suggestion["mem"]:
+            changes.append(f"mem {suggestion['mem']}")
+        if suggestion["cpus_per_task"]:
+            changes.append(f"{suggestion['cpus_per_task']} cpus")
+        hint = (
+            f"Your last {suggestion['samples']} jobs suggest {' and '.join(changes)} "
+            f"(Available: {avail_of(slurm_config, self.card_list)} -> {avail_of(tight, self.card_list)})."
+        )
+
+        for key in ("cpus_per_task", "mem"):
+            self.get_widget(key).comments = f"{hint} {self.default_comments[key]}"
+        self.hint = hint
+
+    def show_limits(self):
+        """show the partition and QOS limits that the current values break in the head line."""
+        if not self.get_widget("partition").value:
+            return
+        p = self.partitions[self.get_widget("partition").value[0]]
+        partition, cluster = split_partition_key(p)
+        try:
+            config = replace(
+                self.slurm_config,
+                nodes=int(self.get_widget("nodes").value),
+                ntasks=int(self.get_widget("ntasks").value),
+                distributed=self.get_widget("distributed").value == [1],
+                partition=partition,
+                cluster=cluster,
+                gpu_type=["Any Type", *self.cards[p]][(self.get_widget("gpu_type").value or [0])[0]],
+                num_gpus=int(self.get_widget("num_gpus").value),
+                cpus_per_task=int(self.get_widget("cpus_per_task").value),
+                mem=self.get_widget("mem").value,
+                other=self.get_widget("other").value,
+            )
+        except (ValueError, IndexError):  # in the middle of editing
+            return
+
+        reasons = self.limits.check(config, general_config=self.parentApp.database.config, cached_only=True)
+        warning = f"Never starts: {'; '.join(reasons)}." if reasons else ""
+        self.text.value = " ".join(filter(None, [self.greetings, self.hint, warning]))
+        self.text.update()
+
 
 class SelectConfigForm(npyscreen.ActionFormV2):
     def __init__(
@@ -606,20 +747,23 @@ class SelectConfigForm(npyscreen.ActionFormV2):
         **keywords,
     ):
         card_list = parentApp.card_list
+        predictor: WaitPredictor = parentApp.predictor
+        default_time = parentApp.database.config.get("default_time", "0-01:00:00")
 
         self.options = [
             (
-                f"{s.name} (Available: {avail_of(s, card_list)})",
+                f"{s.name} (Available: {avail_of(s, card_list)}, Wait: {human_wait(predictor.predict(s, default_time))})",
                 f"Preview: {' '.join(utils.get_command(s, 'srun', general_config=parentApp.database.config))}",
             )
             for s in parentApp.database.settings
         ]
         if parentApp.database.recent:
+            recent = parentApp.database.recent
             self.options.insert(
                 0,
                 (
-                    f"RECENT (Available: {avail_of(parentApp.database.recent.slurm_config, card_list)})",
-                    f"Preview: {' '.join(utils.get_command(parentApp.database.recent.slurm_config, 'srun', general_config=parentApp.database.config))}",
+                    f"RECENT (Available: {avail_of(recent.slurm_config, card_list)}, Wait: {human_wait(predictor.predict(recent.slurm_config, recent.time))})",
+                    f"Preview: {' '.join(utils.get_command(recent.slurm_config, 'srun', general_config=parentApp.database.config))}",
                 ),
             )
 
@@ -745,7 +889,7 @@ class EditRunConfigForm(npyscreen.ActionFormV2):
 
         # if we do not want to save the change, we freeze the name field
         freeze_name = False
-        if self.parentApp.getForm("MAIN").field.value[0] == 4:
+        if self.parentApp.getForm("MAIN").field.value[0] == 5:
             freeze_name = True
 
         # write to submit config
@@ -873,7 +1017,7 @@ class SubmitForm(FormMultiPageAction):
         self.submit_config = SubmitConfig()
 
         # obtain slash environments
-        self.slash_envs = ["none"] + sorted(Slash.list().keys())
+        self.slash_envs = self.parentApp.slash_envs
 
         super().__init__(display_pages, pages_label_color, *args, **keywords)
 
@@ -882,6 +1026,7 @@ class SubmitForm(FormMultiPageAction):
         self.submit_config.task = self.get_widget("task").value[0]
         self.submit_config.slash = self.slash_envs[self.get_widget("slash").value[0]]
         self.submit_config.time = self.get_widget("time").value
+        self.submit_config.resubmit = int(self.get_widget("resubmit").value or 0)
         self.submit_config.jobname = self.get_widget("jobname").value
         self.submit_config.output = self.get_widget("output").value
         self.submit_config.error = self.get_widget("error").value
@@ -891,10 +1036,22 @@ class SubmitForm(FormMultiPageAction):
         )
         self.submit_config.mail_user = self.get_widget("mail_user").value
 
+        # a job that breaks the partition or QOS limits would be rejected or pending forever
+        if self.submit_config.task in (0, 1) and self.submit_config.slurm_config is not None:
+            reasons = self.parentApp.database.check_limits(self.submit_config, count_jobs=True)
+            if reasons and not npyscreen.notify_yes_no(
+                f"The job may never start: {'; '.join(reasons)}. Submit anyway?", title="Limits"
+            ):
+                return  # stay in the form
+            self.parentApp.checked = True
+
         # proceed to exit
         self.parentApp.setNextForm(None)
 
     def on_cancel(self):
+        if self.parentApp.getHistory()[-2:-1] == ["MAIN"]:
+            form = self.parentApp.getForm("MAIN")
+            form.field.value = None
         self.parentApp.setNextFormPrevious()
 
     def adjust_widgets(self):
@@ -946,13 +1103,24 @@ class SubmitForm(FormMultiPageAction):
             select_exit=True,
             comments="Slash environment name. It will automatically setup the internet/proxy service on the compute node. Choose 'none' to disable.",
         )
-        self.auto_add(
+        time_widget = self.auto_add(
             npyscreen.TitleText,
             w_id="time",
             value=str(self.general_config.get("default_time", "0-01:00:00")),
             name="Time",
             comments="Limit on the total run time of the job allocation. E.g. 0-01:00:00",
         )
+        self.auto_add(
+            npyscreen.TitleText,
+            w_id="resubmit",
+            value="0",
+            name="Resubmit",
+            comments=(
+                "Resubmit the sbatch job up to N times when it reaches the time limit. Your command gets SIGUSR1 "
+                f"{SubmitConfig.signal_lead}s before the limit to save a checkpoint, and should resume from it. "
+                "0 to disable."
+            ),
+        )
         output = self.auto_add(
             npyscreen.TitleFilenameCombo,
             w_id="output",
@@ -1018,6 +1186,21 @@ class SubmitForm(FormMultiPageAction):
 
         task.when_value_edited = when_value_edited
 
+        def when_time_edited():
+            slurm_config = self.submit_config.slurm_config
+            comments = "Limit on the total run time of the job allocation. E.g. 0-01:00:00"
+            if slurm_config is not None and time_widget.value:
+                reasons = self.parentApp.database.limits.check(
+                    slurm_config, time_widget.value, self.general_config, cached_only=True
+                )
+                if reasons:
+                    comments = f"Never starts: {'; '.join(reasons)}. {comments}"
+            time_widget.comments = comments
+            self.explanation.value = comments
+            self.explanation.update()
+
+        time_widget.entry_widget.when_value_edited = when_time_edited
+
     def pre_edit_loop(self):
         super().pre_edit_loop()
 
@@ -1034,7 +1217,7 @@ class GeneralConfigForm(FormMultiPageAction):
         self.general_config: dict = self.parentApp.database.config
 
         # obtain slash environments
-        self.slash_envs = ["none"] + sorted(Slash.list().keys())
+        self.slash_envs = self.parentApp.slash_envs
 
         super().__init__(display_pages, pages_label_color, *args, **keywords)
 
@@ -1043,10 +1226,16 @@ class GeneralConfigForm(FormMultiPageAction):
         self.general_config["log_space"] = int(self.get_widget("log_space").value)
         self.general_config["gpu"] = self.get_widget("gpu").value == [1]
         self.general_config["cache"] = self.get_widget("cache").value == [0]
+        self.general_config["tee"] = self.get_widget("tee").value == [1]
+        self.general_config["warm"] = self.get_widget("warm").value == [1]
+        self.general_config["warm_timeout"] = int(self.get_widget("warm_timeout").value)
+        self.general_config["retries"] = int(self.get_widget("retries").value)
+        self.general_config["blacklist_ttl"] = float(self.get_widget("blacklist_ttl").value)
         self.general_config["default_jobname"] = self.get_widget("default_jobname").value
         self.general_config["default_slash"] = self.slash_envs[self.get_widget("default_slash").value[0]]
         self.general_config["default_time"] = self.get_widget("default_time").value
         self.general_config["default_mail_user"] = self.get_widget("default_mail_user").value
+        self.general_config["clusters"] = ",".join(utils.parse_clusters(self.get_widget("clusters").value))
 
         # proceed to exit
         self.parentApp.setNextForm(None)
@@ -1097,6 +1286,52 @@ class GeneralConfigForm(FormMultiPageAction):
             comments="Whether to cache the files. This allows you change the files right after submission, no need to wait for allocation.",
             select_exit=True,
         )
+        self.auto_add(
+            TitleSelectOne,
+            w_id="tee",
+            max_height=2,
+            value=[1 if self.general_config.get("tee", False) else 0],
+            name="Tee",
+            values=["Only print the srun outputs to console", "Also keep the srun outputs in the log folder"],
+            scroll_exit=True,
+            comments="Whether to save the last few MB of srun stdout/stderr into the log folder (output.txt, error.txt).",
+            select_exit=True,
+        )
+        self.auto_add(
+            TitleSelectOne,
+            w_id="warm",
+            max_height=2,
+            value=[1 if self.general_config.get("warm", False) else 0],
+            name="Keep Warm",
+            values=[
+                "Release the allocation once the srun job finishes",
+                "Keep the allocation and reuse it for the next srun job",
+            ],
+            scroll_exit=True,
+            comments="Hold an salloc allocation after an srun job, so that the next run with the same setting starts in seconds.",
+            select_exit=True,
+        )
+        self.auto_add(
+            npyscreen.TitleText,
+            w_id="warm_timeout",
+            name="Warm Timeout",
+            value=str(self.general_config.get("warm_timeout", 30)),
+            comments="Minutes to keep an idle warm allocation before it is released. Only useful when Keep Warm is on.",
+        )
+        self.auto_add(
+            npyscreen.TitleText,
+            w_id="retries",
+            name="Node Retries",
+            value=str(self.general_config.get("retries", 0)),
+            comments="Resubmit an sbatch job up to this many times if it fails because of a node (NODE_FAIL or a broken GPU), excluding the node. 0 to disable.",
+        )
+        self.auto_add(
+            npyscreen.TitleText,
+            w_id="blacklist_ttl",
+            name="Blacklist TTL",
+            value=str(self.general_config.get("blacklist_ttl", 24)),
+            comments="Hours to exclude a node from your jobs after it fails one. See ~/.config/sapp/.blacklist.json.",
+        )
         self.auto_add(
             npyscreen.TitleText,
             w_id="default_jobname",
@@ -1129,6 +1364,13 @@ class GeneralConfigForm(FormMultiPageAction):
             value=str(self.general_config.get("default_mail_user", "")),
             comments="The default value of mail user to appear during sapp job submission. If empty, slurm will use the email of the current account.",
         )
+        self.auto_add(
+            npyscreen.TitleText,
+            w_id="clusters",
+            name="Clusters",
+            value=str(self.general_config.get("clusters", "")),
+            comments="(Optional) Comma separated clusters to query and submit to, e.g. a,b. Their partitions show as partition@cluster. Takes effect on the next start.",
+        )
 
     def pre_edit_loop(self):
         super().pre_edit_loop()
@@ -1137,21 +1379,58 @@ class GeneralConfigForm(FormMultiPageAction):
         self.c_button.comments = "Back to the main menu."
 
 
+def list_slash_envs():
+    return ["none"] + sorted(Slash.list().keys())
+
+
+def traced(func, name: str = None):
+    def wrapper():
+        with tracer.span(name or func.__name__):
+            return func()
+
+    return wrapper
+
+
 class SlurmApplication(npyscreen.NPSAppManaged):
     def __init__(self, command):
         self.command = command
-        self.card_list = get_card_list()
-        self.database = Database()
+
+        # the startup queries are independent, so run them at the same time and keep the results for the session
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            slash_envs = pool.submit(traced(list_slash_envs, "Slash.list"))
+            self.database = Database()
+            clusters = utils.parse_clusters(self.database.config.get("clusters", ""))
+            card_list = pool.submit(traced(partial(get_card_list, clusters), "get_card_list"))
+            self.card_list = card_list.result()
+            self.slash_envs = slash_envs.result()
+
+        # the limits are cached for an hour, warm them up for the forms without holding the first render back
+        threading.Thread(target=lambda: [self.database.limits.get(c) for c in clusters or [None]], daemon=True).start()
+
+        # the snapshot is free, keep it if the user records the availability
+        self.availability = AvailabilitySeries(self.database.base_path)
+        if self.availability.exists():
+            self.availability.record(self.card_list)
+
+        # predictions are read from the aggregates of the previous runs, update them at background
+        self.history = History(self.database.base_path)
+        self.predictor = WaitPredictor(self.history)
+        # a daemon thread, it never holds the submission back
+        threading.Thread(target=sync, args=(self.database.base_path,), daemon=True).start()
+
+        # whether the user has confirmed the limits of the job in the submit form
+        self.checked = False
         super().__init__()
 
     def onStart(self):
-        self.addForm("MAIN", MenuForm, name="SAPP", minimum_lines=9, scroll_exit=True)
-        self.addForm("select_config", SelectConfigForm, name="SAPP", minimum_lines=9, scroll_exit=True)
-        self.addForm("edit_run_config", EditRunConfigForm, name="SAPP", minimum_lines=9, scroll_exit=True)
-        self.addForm("remove_config", RemoveConfigForm, name="SAPP", minimum_lines=9, scroll_exit=True)
-        self.addForm("new_config", SlurmConfigForm, name="SAPP", minimum_lines=14, scroll_exit=True)
-        self.addForm("submit", SubmitForm, name="SAPP", minimum_lines=14, scroll_exit=True)
-        self.addForm("general_config", GeneralConfigForm, name="SAPP", minimum_lines=9, scroll_exit=True)
+        with tracer.span("forms"):
+            self.addForm("MAIN", MenuForm, name="SAPP", minimum_lines=9, scroll_exit=True)
+            self.addForm("select_config", SelectConfigForm, name="SAPP", minimum_lines=9, scroll_exit=True)
+            self.addForm("edit_run_config", EditRunConfigForm, name="SAPP", minimum_lines=9, scroll_exit=True)
+            self.addForm("remove_config", RemoveConfigForm, name="SAPP", minimum_lines=9, scroll_exit=True)
+            self.addForm("new_config", SlurmConfigForm, name="SAPP", minimum_lines=14, scroll_exit=True)
+            self.addForm("submit", SubmitForm, name="SAPP", minimum_lines=14, scroll_exit=True)
+            self.addForm("general_config", GeneralConfigForm, name="SAPP", minimum_lines=9, scroll_exit=True)
 
     def process(self):
         menu = self.getForm("MAIN").field.value[0]
@@ -1160,33 +1439,36 @@ class SlurmApplication(npyscreen.NPSAppManaged):
             assert (
                 self.database.recent is not None
             ), "If you use SAPP for the first time, please consider creating a new setting first."
-            self.database.execute(self.command, self.database.recent)
+            self.database.execute(self.command, self.database.recent, check=not self.checked)
         elif menu == 1:
-            self.database.execute(self.command, submit)
+            save_ranking(self.database.base_path / self.database.identifier, self.getForm("MAIN").ranking)
+            self.database.execute(self.command, submit, check=not self.checked)
         elif menu == 2:
-            self.database.add(submit.slurm_config)
-            self.database.execute(self.command, submit)
+            self.database.execute(self.command, submit, check=not self.checked)
         elif menu == 3:
-            self.database.execute(self.command, submit)
+            self.database.add(submit.slurm_config)
+            self.database.execute(self.command, submit, check=not self.checked)
         elif menu == 4:
-            self.database.execute(self.command, submit)
+            self.database.execute(self.command, submit, check=not self.checked)
         elif menu == 5:
+            self.database.execute(self.command, submit, check=not self.checked)
+        elif menu == 6:
             idx = self.getForm("edit_run_config").field.value[0]
             if self.database.recent and idx != 0:
                 self.database.settings[idx - 1] = submit.slurm_config
             elif not self.database.recent:
                 self.database.settings[idx] = submit.slurm_config
-            self.database.execute(self.command, submit)
-        elif menu == 6:
+            self.database.execute(self.command, submit, check=not self.checked)
+        elif menu == 7:
             deleted = self.database.remove(self.getForm("remove_config").field.value)
             self.database.dump()
             if deleted:
                 print(f"Successfully removed {deleted} setting{'s' if deleted > 1 else ''}.")
             else:
                 print("No setting is removed.")
-        elif menu == 7:
+        elif menu == 8:
             self.database.config = self.getForm("general_config").general_config
             self.database.dump()
             print("Successfully updated SAPP general config.")
-        elif menu == 8:
+        elif menu == 9:
             exit(0)
@@ -3,8 +3,18 @@
 
 import re
 import subprocess
+import warnings
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from typing import List, Optional, Tuple
+
+from .config import SlurmConfig
+
+
+# regex from https://github.com/itzsimpl/prometheus-slurm-exporter/blob/64535e24c61ea4d44795571d054c268b1ca69a35/gpus.go#L73
+# might fail when multiple types of gpus appear on the same node
+GRES_PATTERN = r"gpu:(\(null\)|[^:(]*):?([0-9]+)(\([^)]*\))?"
 
 
 def parse_gres_line(line):
@@ -24,17 +34,16 @@ def parse_gres_line(line):
     # free_mem = line[140:155].strip()
     alloc_mem = line[155:170].strip()
     total_mem = line[170:185].strip()
-    partition = line[185:].strip()
+    partition = line[185:235].strip()
+    # the features that are active now, e.g. "ib,nvlink". Features that need a reboot are not counted
+    features = [f for f in line[235:].strip().split(",") if f and f != "(null)"]
 
     # we do not consider drain nodes
     if status not in ["idle", "mix", "alloc"]:
         return None
 
-    # regex from https://github.com/itzsimpl/prometheus-slurm-exporter/blob/64535e24c61ea4d44795571d054c268b1ca69a35/gpus.go#L73
-    # might fail when multiple types of gpus appear on the same node
-    pattern = r"gpu:(\(null\)|[^:(]*):?([0-9]+)(\([^)]*\))?"
-    gres_match = re.match(pattern, gres)
-    gres_used_match = re.match(pattern, gres_used)
+    gres_match = re.match(GRES_PATTERN, gres)
+    gres_used_match = re.match(GRES_PATTERN, gres_used)
 
     # the gres line is not in the expected format
     if gres_match is None or gres_used_match is None:
@@ -57,10 +66,66 @@ def parse_gres_line(line):
     # XXX: I am not sure if the memory that is available to be allocated could be calculated in this way.
     mem_avail = int(total_mem) - int(alloc_mem)
 
-    return gpu_type, nodelist, gpu_avail, cpu_avail, mem_avail, partition
+    return gpu_type, nodelist, gpu_avail, cpu_avail, mem_avail, partition, features
+
+
+def partition_key(partition: str, cluster: str = None) -> str:
+    """the key of a partition in the card list, `partition@cluster` for the partitions of a named cluster."""
+    return f"{partition}@{cluster}" if cluster else partition
+
 
+def split_partition_key(key: str) -> Tuple[str, Optional[str]]:
+    partition, _, cluster = key.partition("@")
+    return partition, cluster or None
 
-def get_card_list():
+
+def get_card_list(clusters: List[str] = None):
+    """
+    Return the availability of the cards from the local sapp service if it is running, otherwise from the slurm
+    backend (sinfo by default). See `query_card_list` for the format.
+
+    If clusters are given, they are queried at the same time and merged into one card list, with the partitions
+    keyed by `partition@cluster`. A cluster that fails to answer is skipped with a warning.
+    """
+    if not clusters:
+        return cluster_card_list()
+
+    with ThreadPoolExecutor(max_workers=len(clusters)) as pool:
+        futures = [pool.submit(cluster_card_list, cluster) for cluster in clusters]
+
+    resources = defaultdict(partial(defaultdict, list))
+    errors = []
+    for cluster, future in zip(clusters, futures):
+        try:
+            cards = future.result()
+        except RuntimeError as e:
+            errors.append(e)
+            warnings.warn(f"Fails to query cluster {cluster}: {e}", UserWarning)
+            continue
+        for partition, gpu_types in cards.items():
+            resources[partition_key(partition, cluster)] = gpu_types
+    if len(errors) == len(clusters):
+        raise errors[0]
+    return resources
+
+
+def cluster_card_list(cluster: str = None):
+    """the card list of one cluster, through the local sapp service if it is running."""
+    from .backend import get_backend
+    from .service import request
+
+    cards = request("card_list", cluster=cluster)
+    if cards is None:
+        return get_backend().card_list(cluster)
+
+    resources = defaultdict(partial(defaultdict, list))
+    for partition, gpu_types in cards.items():
+        for gpu_type, nodes in gpu_types.items():
+            resources[partition][gpu_type] = nodes
+    return resources
+
+
+def query_card_list(cluster: str = None):
     """
     Return a dict with the key as partitions and the values as the availibility of the cards.
     The unit of the memory is MB.
@@ -73,7 +138,8 @@ def get_card_list():
                     "nodelist": "ai_gpu01",
                     "gpu": 1,
                     "cpu": 10,
-                    "mem": 359477
+                    "mem": 359477,
+                    "features": ["ib", "nvlink"]
                 },
                 {
                     "nodelist": "ai_gpu02",
@@ -103,9 +169,11 @@ def get_card_list():
         "sinfo",
         "-N",
         "-O",
-        "StateCompact:.10,Gres:.30,GresUsed:.50,NodeList:.30,CPUsState:.20,FreeMem:.15,AllocMem:.15,Memory:.15,PartitionName:.50",
+        "StateCompact:.10,Gres:.30,GresUsed:.50,NodeList:.30,CPUsState:.20,FreeMem:.15,AllocMem:.15,Memory:.15,PartitionName:.50,FeaturesAct:.200",
         "--noheader",
     ]
+    if cluster:
+        cmd += ["-M", cluster]  # sinfo adds a "CLUSTER: name" line, which is skipped by parse_gres_line
     result = subprocess.run(cmd, stdout=subprocess.PIPE)
 
     if result.returncode != 0:
@@ -120,9 +188,93 @@ def get_card_list():
         if parse is None:
             continue
 
-        gpu_type, nodelist, gpu_avail, cpu_avail, mem_avail, partition = parse
+        gpu_type, nodelist, gpu_avail, cpu_avail, mem_avail, partition, features = parse
         resources[partition][gpu_type].append(
-            {"nodelist": nodelist, "gpu": gpu_avail, "cpu": cpu_avail, "mem": mem_avail}
+            {"nodelist": nodelist, "gpu": gpu_avail, "cpu": cpu_avail, "mem": mem_avail, "features": features}
         )
 
     return resources
+
+
+def satisfy(req: dict, avail: dict) -> int:
+    """
+    Check if the requirements are satisfied by the available resources.
+    If so, return the number of jobs that could be run.
+    """
+    # default requirements
+    if req is None:
+        req = {"gpu": 1, "cpu": 1, "mem": "0"}
+
+    # check cpu (must be at least 1)
+    max_avail = avail["cpu"] // max(1, req["cpu"])
+
+    # check gpu
+    if req["gpu"] > 0:
+        max_avail = min(max_avail, avail["gpu"] // req["gpu"])
+
+    # check memory
+    ## convert the memory to MB
+    mem = str(req["mem"] or "").strip().lower()
+
+    try:
+        if mem.endswith("k"):
+            mem = float(mem[:-1]) / 1024
+        elif mem.endswith("m"):
+            mem = float(mem[:-1])
+        elif mem.endswith("g"):
+            mem = float(mem[:-1]) * 1024
+        elif mem.endswith("t"):
+            mem = float(mem[:-1]) * 1024 * 1024
+        else:
+            mem = float(mem)
+    except ValueError:
+        # edge cases like '' or incomplete input
+        mem = 0
+
+    if mem > 0:
+        max_avail = min(max_avail, avail["mem"] // mem)
+
+    return int(max_avail)
+
+
+def match_constraint(constraint: str, features: List[str]) -> bool:
+    """
+    Whether a node with the features satisfies the constraint, e.g. "ib&nvlink" or "[a100|h100]". The operators
+    & and | are supported, and the counts (e.g. "ib*2") are ignored.
+    """
+    constraint = re.sub(r"[\[\]()\s]", "", str(constraint or ""))
+    if not constraint:
+        return True
+    features = set(features or [])
+    return any(
+        all(re.sub(r"\*\d+$", "", f) in features for f in re.split(r"[&,]", term) if f)
+        for term in constraint.split("|")
+    )
+
+
+def feature_index(card_list: dict) -> dict:
+    """
+    Index the nodes by their features, i.e. {partition: {feature: [node, ...]}}, to count the availability of each
+    feature. The nodes of all gpu types are included.
+    """
+    index = defaultdict(partial(defaultdict, list))
+    for partition, gpu_types in card_list.items():
+        for nodes in gpu_types.values():
+            for node in nodes:
+                for feature in node.get("features", []):
+                    index[partition][feature].append(node)
+    return index
+
+
+def avail_of(config: SlurmConfig, card_list: dict) -> int:
+    """return the number of jobs that could be run with the given config."""
+    partition = partition_key(config.partition, config.cluster)
+    gpu_type = config.gpu_type
+    req = {"gpu": config.num_gpus, "cpu": config.cpus_per_task, "mem": config.mem}
+    if partition not in card_list:
+        return 0
+    if gpu_type == "Any Type":
+        candidates = [node for gpu_type in card_list[partition] for node in card_list[partition][gpu_type]]
+    else:
+        candidates = card_list[partition].get(gpu_type, [])
+    return sum(satisfy(req, node) for node in candidates if match_constraint(config.constraint, node.get("features")))
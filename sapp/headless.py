@@ -0,0 +1,142 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import argparse
+import sys
+from dataclasses import replace
+from typing import List
+
+from . import utils
+from .config import SubmitConfig
+from .core import Database
+from .gpustat import get_card_list
+from .history import History
+from .predict import WaitPredictor, human_wait, rank_settings, save_ranking
+from .tracing import tracer
+
+
+def submit_config(database: Database, args: argparse.Namespace) -> SubmitConfig:
+    """build the submit config from the most recent one (or the general config) and the command line."""
+    general_config = database.config
+    if database.recent is not None:
+        config = replace(database.recent)
+    else:
+        config = SubmitConfig(
+            jobname=general_config.get("default_jobname") or None,
+            slash=general_config.get("default_slash", "none"),
+            time=general_config.get("default_time", "0-01:00:00"),
+            mail_user=general_config.get("default_mail_user") or None,
+        )
+
+    config.task = 1 if args.sbatch or args.speculative else 0
+    if args.slash is not None:
+        config.slash = args.slash
+    if args.time is not None:
+        config.time = args.time
+    if args.jobname is not None:
+        config.jobname = args.jobname
+    # the chain is chosen per job, do not inherit it from the recent submission
+    config.resubmit = getattr(args, "resubmit", None) or 0
+    if getattr(args, "signal_lead", None) is not None:
+        config.signal_lead = args.signal_lead
+
+    # the same defaults as the submit form
+    if config.task == 1 and not config.output and not config.error:
+        config.output = str(database.base_path / "%i" / "output.txt")
+        config.error = str(database.base_path / "%i" / "error.txt")
+    elif config.task == 0 and config.output == str(database.base_path / "%i" / "output.txt"):
+        config.output = config.error = None
+    return config
+
+
+def cli(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="sapp run",
+        description="Submit a job with a saved setting, without the menu.",
+        usage="sapp run [options] -- command ...",
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-c", "--config", default=None, help="name of the saved setting. Default: the most recent one.")
+    group.add_argument("--fastest", action="store_true", help="use the saved setting expected to start first.")
+    group.add_argument(
+        "--speculative",
+        default=None,
+        metavar="NAME,NAME,...",
+        help="submit with sbatch under several saved settings, keep the first to start and cancel the others.",
+    )
+    parser.add_argument("--sbatch", action="store_true", help="submit with sbatch instead of srun.")
+    parser.add_argument("--slash", default=None, help="slash environment to use. 'none' to disable.")
+    parser.add_argument("-t", "--time", default=None, help="time limit, e.g. 0-01:00:00.")
+    parser.add_argument("-J", "--jobname", default=None, help="job name for slurm.")
+    parser.add_argument(
+        "--resubmit",
+        type=int,
+        default=None,
+        metavar="N",
+        help="resubmit the sbatch job up to N times at the time limit. The command gets SIGUSR1 to checkpoint.",
+    )
+    parser.add_argument(
+        "--signal-lead", type=int, default=None, metavar="SECONDS", help="send SIGUSR1 before the limit. Default: 300."
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="submit even if the job breaks the partition or QOS limits."
+    )
+    parser.add_argument("--profile", action="store_true", help="save the time of each phase to trace.json.")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="command to execute.")
+    args = parser.parse_args(argv)
+
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if not command:
+        parser.error("no command to execute.")
+    if args.speculative is not None and args.resubmit:
+        # every link of a chain would claim the group again, lose and cancel itself
+        parser.error("--resubmit does not work with --speculative.")
+    if args.profile:
+        tracer.enable()
+
+    database = Database()
+    config = submit_config(database, args)
+
+    if args.fastest:
+        with History(database.base_path) as history:
+            card_list = get_card_list(utils.parse_clusters(database.config.get("clusters", "")))
+            ranking = rank_settings(database.settings, card_list, WaitPredictor(history), config.time)
+        save_ranking(database.base_path / database.identifier, ranking)
+        if not ranking:
+            parser.exit(1, "sapp run: no saved setting fits the current cluster.\n")
+        best = ranking[0]
+        prediction = (best["predicted_wait"], best["samples"]) if best["predicted_wait"] is not None else None
+        print(
+            f"sapp: Fastest start with setting {best['config'].name} "
+            f"(Available: {best['available']}, Wait: {human_wait(prediction)})",
+            file=sys.stderr,
+        )
+        config.slurm_config = best["config"]
+    elif args.speculative is not None:
+        names = [name.strip() for name in args.speculative.split(",") if name.strip()]
+        settings = {s.name: s for s in database.settings}
+        missing = [name for name in names if name not in settings]
+        if missing:
+            parser.exit(1, f"sapp run: no saved setting named {', '.join(missing)}.\n")
+        jobids = database.execute_speculative(command, config, [settings[name] for name in names])
+        tracer.save(database.base_path / database.identifier)
+        if not jobids:
+            parser.exit(1, "sapp run: fails to submit the jobs.\n")
+        print(f"sapp: Submitted {len(jobids)} speculative jobs, the first to start will be kept.", file=sys.stderr)
+        return
+    elif args.config is not None:
+        settings = [s for s in database.settings if s.name == args.config]
+        if not settings:
+            parser.exit(1, f"sapp run: no saved setting named {args.config}.\n")
+        config.slurm_config = settings[0]
+    elif database.recent is None:
+        parser.exit(1, "sapp run: no recent setting. Please run sapp with the menu first.\n")
+
+    reasons = database.check_limits(config, count_jobs=True)
+    if reasons and not args.force:
+        parser.exit(1, f"sapp run: the job could never start: {'; '.join(reasons)}. Use --force to submit anyway.\n")
+
+    returncode = database.execute(command, config, check=False)
+    tracer.save(database.base_path / database.identifier)
+    if isinstance(returncode, int):
+        sys.exit(128 - returncode if returncode < 0 else returncode)
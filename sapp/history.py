@@ -0,0 +1,297 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import argparse
+import sqlite3
+import subprocess
+import time
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import utils
+from .config import SubmitConfig
+from .jobs import FINAL_STATES, JobIndex, format_table
+
+
+class History:
+    """
+    The submission history of sapp jobs, stored in a sqlite database at `<base_path>/.history.db`.
+
+    A record is added on every submission. The job id, start/end time and state are backfilled from sacct
+    in batches, so that the queue wait and the run time of each config could be queried with the indices.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        identifier TEXT PRIMARY KEY,
+        jobid TEXT,
+        config_hash TEXT,
+        config_name TEXT,
+        partition TEXT,
+        gpu_type TEXT,
+        num_gpus INTEGER,
+        cpus INTEGER,
+        mem TEXT,
+        time_limit REAL,
+        task INTEGER,
+        submit_time REAL,
+        start_time REAL,
+        end_time REAL,
+        state TEXT,
+        queue_wait REAL,
+        runtime REAL,
+        done INTEGER DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS jobs_config ON jobs (config_hash, submit_time);
+    CREATE INDEX IF NOT EXISTS jobs_jobid ON jobs (jobid);
+    CREATE INDEX IF NOT EXISTS jobs_done ON jobs (done, submit_time);
+    """
+
+    # columns added after the first release, created on existing databases by `migrate`
+    COLUMNS = {
+        "max_rss": "REAL",
+        "total_cpu": "REAL",
+        "alloc_cpus": "INTEGER",
+        "submit_latency": "REAL",
+        "cluster": "TEXT",
+        "warm": "INTEGER",
+    }
+
+    def __init__(self, base_path: Path) -> None:
+        self.base_path = Path(base_path)
+        self.conn = sqlite3.connect(str(self.base_path / ".history.db"), timeout=10)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(self.SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        existing = {row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        with self.conn:
+            for name, tp in self.COLUMNS.items():
+                if name not in existing:
+                    self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {tp}")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(
+        self,
+        identifier: str,
+        config: SubmitConfig,
+        jobid: str = None,
+        submit_latency: float = None,
+        warm: bool = False,
+    ):
+        """
+        Add a record on submission. The submit latency is the round trip of sbatch. The runs in a warm allocation
+        share the job id of the allocation, whose accounting tells nothing about them, so they are never backfilled.
+        """
+        slurm_config = config.slurm_config
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs "
+                "(identifier, jobid, config_hash, config_name, partition, gpu_type, num_gpus, cpus, mem, "
+                "time_limit, task, submit_time, submit_latency, cluster, warm, done) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    identifier,
+                    jobid,
+                    utils.config_digest(slurm_config),
+                    slurm_config.name,
+                    slurm_config.partition,
+                    slurm_config.gpu_type,
+                    slurm_config.num_gpus,
+                    slurm_config.cpus_per_task,
+                    slurm_config.mem,
+                    utils.parse_duration(config.time),
+                    config.task,
+                    time.time(),
+                    submit_latency,
+                    slurm_config.cluster,
+                    int(warm),
+                    int(warm),
+                ),
+            )
+
+    @staticmethod
+    def parse_time(s: str) -> Optional[float]:
+        try:
+            return datetime.fromisoformat(s).timestamp()
+        except (TypeError, ValueError):  # Unknown, None, etc.
+            return None
+
+    def backfill(self, batch_size: int = 500) -> int:
+        """
+        Fill in the job ids from the job folders, then update the unfinished records with sacct in batches.
+        Return the number of records updated.
+        """
+        rows = self.conn.execute("SELECT identifier, jobid, cluster FROM jobs WHERE done = 0").fetchall()
+        if not rows:
+            return 0
+
+        missing = [r["identifier"] for r in rows if not r["jobid"]]
+        if missing:
+            index = JobIndex(self.base_path)
+            entries = index.refresh()
+            index.save()
+            with self.conn:
+                for identifier in missing:
+                    if identifier not in entries:  # the job folder is removed, nothing to backfill
+                        self.conn.execute("UPDATE jobs SET done = 1 WHERE identifier = ?", (identifier,))
+                    elif entries[identifier].get("jobid"):
+                        jobid = entries[identifier]["jobid"]
+                        self.conn.execute("UPDATE jobs SET jobid = ? WHERE identifier = ?", (jobid, identifier))
+            rows = self.conn.execute("SELECT identifier, jobid, cluster FROM jobs WHERE done = 0").fetchall()
+
+        # sacct only reports the jobs of one cluster at a time
+        groups = defaultdict(list)
+        for r in rows:
+            if r["jobid"]:
+                groups[r["cluster"]].append(r["jobid"])
+        updated = 0
+        for cluster, jobids in groups.items():
+            updated += self.backfill_cluster(jobids, cluster, batch_size)
+        return updated
+
+    def backfill_cluster(self, jobids: List[str], cluster: Optional[str], batch_size: int) -> int:
+        updated = 0
+        for i in range(0, len(jobids), batch_size):
+            # the memory usage is only reported by the job steps, so we do not use -X here
+            proc = subprocess.run(
+                [
+                    "sacct",
+                    "-n",
+                    "-P",
+                    "-j",
+                    ",".join(jobids[i : i + batch_size]),
+                    "-o",
+                    "JobIDRaw,Submit,Start,End,State,MaxRSS,TotalCPU,AllocCPUS",
+                ]
+                + (["-M", cluster] if cluster else []),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            if proc.returncode != 0:
+                break
+
+            jobs, max_rss = {}, {}
+            for line in proc.stdout.decode().splitlines():
+                fields = line.strip().split("|")
+                if len(fields) != 8:
+                    continue
+                jobid = fields[0].split(".")[0]
+                max_rss[jobid] = max(max_rss.get(jobid, 0.0), utils.parse_size(fields[5], "B"))
+                if "." not in fields[0]:
+                    jobs[jobid] = fields
+
+            with self.conn:
+                for jobid, (_, submit, start, end, state, _, total_cpu, alloc_cpus) in jobs.items():
+                    submit, start, end = self.parse_time(submit), self.parse_time(start), self.parse_time(end)
+                    updated += self.update(jobid, submit, start, end, state.split()[0] if state else None, cluster)
+                    self.conn.execute(
+                        "UPDATE jobs SET max_rss = ?, total_cpu = ?, alloc_cpus = ? WHERE jobid = ? AND cluster IS ?",
+                        (
+                            max_rss[jobid] or None,
+                            utils.parse_duration(total_cpu),
+                            int(alloc_cpus or 0) or None,
+                            jobid,
+                            cluster,
+                        ),
+                    )
+        return updated
+
+    def update(self, jobid: str, submit: float, start: float, end: float, state: str, cluster: str = None) -> int:
+        """update a record with the accounting data."""
+        queue_wait = start - submit if start is not None and submit is not None else None
+        runtime = end - start if end is not None and start is not None else None
+        cursor = self.conn.execute(
+            "UPDATE jobs SET submit_time = COALESCE(?, submit_time), start_time = ?, end_time = ?, state = ?, "
+            "queue_wait = ?, runtime = ?, done = ? WHERE jobid = ? AND cluster IS ?",
+            (submit, start, end, state, queue_wait, runtime, int(state in FINAL_STATES), jobid, cluster),
+        )
+        return cursor.rowcount
+
+    def stats(self) -> Dict[str, dict]:
+        """the number of jobs, the average queue wait and run time of each config."""
+        rows = self.conn.execute(
+            "SELECT config_hash, COUNT(*) AS count, AVG(queue_wait) AS queue_wait, AVG(runtime) AS runtime "
+            "FROM jobs GROUP BY config_hash"
+        ).fetchall()
+        return {r["config_hash"]: dict(r) for r in rows}
+
+    def usage(self, config_hash: str, limit: int = 20) -> List[sqlite3.Row]:
+        """the resource usage of the recent finished jobs of a config."""
+        return self.conn.execute(
+            "SELECT max_rss, total_cpu, alloc_cpus, runtime FROM jobs "
+            "WHERE config_hash = ? AND done = 1 AND runtime > 0 AND max_rss IS NOT NULL "
+            "ORDER BY submit_time DESC LIMIT ?",
+            (config_hash, limit),
+        ).fetchall()
+
+    def values(self, column: str, since: float = 0) -> List[float]:
+        """the non-null values of a column of the jobs submitted since the time, e.g. for histograms."""
+        assert column in ("queue_wait", "runtime", "submit_latency")
+        return [
+            r[0]
+            for r in self.conn.execute(
+                f"SELECT {column} FROM jobs WHERE submit_time >= ? AND {column} IS NOT NULL", (since,)
+            )
+        ]
+
+    def recent(self, limit: int = 20) -> List[sqlite3.Row]:
+        return self.conn.execute(
+            "SELECT * FROM (SELECT * FROM jobs ORDER BY submit_time DESC LIMIT ?) ORDER BY submit_time", (limit,)
+        ).fetchall()
+
+
+def human_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    if seconds >= 86400:
+        return f"{seconds // 86400}d{seconds % 86400 // 3600}h"
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60}s"
+    return f"{seconds}s"
+
+
+def cli(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="sapp history", description="Show the submission history of sapp jobs.")
+    parser.add_argument("-n", "--num", type=int, default=20, help="number of recent jobs to show. Default: 20.")
+    parser.add_argument("--no-sync", action="store_true", help="do not update the records with sacct.")
+    args = parser.parse_args(argv)
+
+    from .core import Database
+
+    with History(Path(Database.SAPP_FOLDER).expanduser()) as history:
+        if not args.no_sync:
+            history.backfill()
+        rows = [
+            [
+                r["identifier"],
+                r["jobid"] or "-",
+                r["config_name"] or "-",
+                r["partition"] or "-",
+                f"{r['gpu_type']}:{r['num_gpus']}",
+                datetime.fromtimestamp(r["submit_time"]).strftime("%m-%d %H:%M") if r["submit_time"] else "-",
+                human_duration(r["queue_wait"]),
+                human_duration(r["runtime"]),
+                r["state"] or "-",
+            ]
+            for r in history.recent(args.num)
+        ]
+
+    if not rows:
+        print("No sapp job found.")
+        return
+    print(format_table(["IDENTIFIER", "JOBID", "CONFIG", "PARTITION", "GPU", "SUBMIT", "WAIT", "RUN", "STATE"], rows))
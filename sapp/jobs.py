@@ -0,0 +1,252 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import argparse
+import json
+import os
+import subprocess
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+from .backend import get_backend
+
+
+# job states that will never change
+FINAL_STATES = {
+    "BOOT_FAIL",
+    "CANCELLED",
+    "COMPLETED",
+    "DEADLINE",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "REVOKED",
+    "TIMEOUT",
+}
+
+
+class JobIndex:
+    """
+    A small index of the job folders stored at `<base_path>/.index.json`.
+
+    A folder is read again only if its mtime or the mtime of SLURM_JOB_ID or HOSTNAME changes (these are
+    rewritten in place by chained and retried jobs, which leaves the folder mtime alone), and the states of
+    finished jobs are cached, so that listing thousands of historical jobs stays cheap.
+    """
+
+    WATCHED = ("SLURM_JOB_ID", "HOSTNAME")
+
+    def __init__(self, base_path: Path) -> None:
+        self.base_path = Path(base_path)
+        self.path = self.base_path / ".index.json"
+        try:
+            with open(self.path, "r") as f:
+                self.entries: Dict[str, dict] = json.loads(f.read())
+        except (OSError, ValueError):
+            self.entries = {}
+        self.changed = False
+
+    @classmethod
+    def stamp(cls, folder: os.DirEntry) -> int:
+        """the latest mtime of the folder and the files that change during the job."""
+        mtime = folder.stat().st_mtime_ns
+        for name in cls.WATCHED:
+            try:
+                mtime = max(mtime, os.stat(os.path.join(folder.path, name)).st_mtime_ns)
+            except OSError:
+                pass
+        return mtime
+
+    @staticmethod
+    def read_folder(folder: Path) -> dict:
+        entry = {}
+        for key, name in (("jobid", "SLURM_JOB_ID"), ("hostname", "HOSTNAME")):
+            try:
+                entry[key] = (folder / name).read_text().strip() or None
+            except OSError:
+                entry[key] = None
+        try:
+            with open(folder / "job.json", "r") as f:
+                job = json.loads(f.read())
+            entry["pid"] = job.get("pid")
+            entry["task"] = job.get("task")
+            entry["slash"] = job.get("slash")
+            entry["jobname"] = job.get("jobname")
+            entry["submit_time"] = job.get("submit_time")
+            entry["partition"] = job.get("slurm_config", {}).get("partition")
+            entry["cluster"] = job.get("slurm_config", {}).get("cluster")
+        except (OSError, ValueError):
+            pass
+        return entry
+
+    def refresh(self) -> Dict[str, dict]:
+        """scan the base folder and update the entries of new or modified job folders."""
+        seen = set()
+        with os.scandir(self.base_path) as it:
+            for d in it:
+                if d.name.startswith(".") or not d.is_dir():
+                    continue
+                seen.add(d.name)
+                mtime = self.stamp(d)
+                entry = self.entries.get(d.name)
+                if entry is not None and entry.get("mtime") == mtime:
+                    continue
+                new_entry = self.read_folder(Path(d.path))
+                new_entry["mtime"] = mtime
+                if entry is not None and entry.get("final") and entry.get("jobid") == new_entry["jobid"]:
+                    for key in ("state", "elapsed", "node", "partition", "final"):
+                        new_entry[key] = entry.get(key)
+                self.entries[d.name] = new_entry
+                self.changed = True
+
+        for name in list(self.entries):
+            if name not in seen:
+                del self.entries[name]
+                self.changed = True
+
+        return self.entries
+
+    def update(self, states: Dict[str, dict]):
+        """cache the states of finished jobs."""
+        for entry in self.entries.values():
+            state = states.get(entry.get("jobid"))
+            if state is not None and state["state"] in FINAL_STATES and not entry.get("final"):
+                entry.update(state, final=True)
+                self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(self.entries))
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+
+def query_states(jobids: List[str], clusters: Dict[str, str] = None) -> Dict[str, dict]:
+    """
+    Query the states of jobs with one call to the local sapp service or the slurm backend (squeue by default) for
+    the active jobs and one sacct call for the rest. `clusters` maps the job ids to their clusters if they are not
+    on the default cluster, and each cluster is queried separately.
+    """
+    groups = defaultdict(list)
+    for jobid in jobids:
+        if jobid:
+            groups[(clusters or {}).get(jobid)].append(str(jobid))
+
+    states = {}
+    for cluster, group in groups.items():
+        states.update(query_cluster_states(group, cluster))
+    return states
+
+
+def query_cluster_states(jobids: List[str], cluster: str = None) -> Dict[str, dict]:
+    # the local sapp service shares one squeue call among all the users
+    from .service import request
+
+    states = request("states", jobids=jobids, cluster=cluster)
+    if states is None:
+        states = get_backend().job_states(jobids, cluster)
+
+    rest = [j for j in jobids if j not in states]
+    if rest:
+        proc = subprocess.run(
+            ["sacct", "-X", "-n", "-P", "-j", ",".join(rest), "-o", "JobIDRaw,State,Elapsed,NodeList,Partition"]
+            + (["-M", cluster] if cluster else []),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        for line in proc.stdout.decode().splitlines():
+            fields = line.strip().split("|")
+            if len(fields) == 5:
+                # e.g. "CANCELLED by 1234"
+                state = fields[1].split()[0] if fields[1] else "UNKNOWN"
+                states[fields[0]] = {"state": state, "elapsed": fields[2], "node": fields[3], "partition": fields[4]}
+
+    return states
+
+
+def cluster_map(entries: Dict[str, dict]) -> Dict[str, str]:
+    """the job ids of the index entries on named clusters, for `query_states`."""
+    return {e["jobid"]: e["cluster"] for e in entries.values() if e.get("jobid") and e.get("cluster")}
+
+
+def slash_state(entry: dict, state: str = None) -> str:
+    """the slash service lives with the sapp process for srun jobs, and with the slurm job for sbatch jobs."""
+    slash = entry.get("slash")
+    if not slash or slash == "none":
+        return "-"
+    pid = entry.get("pid")
+    if pid is not None and (Path("/proc") / str(pid)).exists():
+        alive = True
+    else:
+        alive = entry.get("task") == 1 and state is not None and state not in FINAL_STATES
+    return f"{slash} ({'up' if alive else 'down'})"
+
+
+def format_table(header: List[str], rows: List[List[str]]) -> str:
+    widths = [max(len(str(r[i])) for r in [header] + rows) for i in range(len(header))]
+    return "\n".join("  ".join(str(c).ljust(w) for c, w in zip(r, widths)).rstrip() for r in [header] + rows)
+
+
+def cli(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="sapp status", description="Show the states of your sapp jobs.")
+    parser.add_argument("-n", "--num", type=int, default=20, help="number of recent jobs to show. Default: 20.")
+    parser.add_argument("-a", "--all", action="store_true", help="show all the jobs.")
+    parser.add_argument(
+        "-t", "--timeline", action="store_true", help="show the queue wait, the setup overhead and the run time."
+    )
+    args = parser.parse_args(argv)
+
+    from . import timeline
+    from .core import Database
+
+    base_path = Path(Database.SAPP_FOLDER).expanduser()
+    index = JobIndex(base_path)
+    entries = index.refresh()
+    names = sorted(entries)
+    if not args.all:
+        names = names[-args.num :] if args.num > 0 else []
+
+    # only query the jobs whose states might change
+    pending = [entries[n]["jobid"] for n in names if entries[n].get("jobid") and not entries[n].get("final")]
+    states = query_states(pending, cluster_map(entries))
+    index.update(states)
+    index.save()
+
+    rows = []
+    for name in names:
+        entry = entries[name]
+        jobid = entry.get("jobid")
+        state = states.get(jobid) or (entry if entry.get("final") else {})
+        rows.append(
+            [
+                name,
+                jobid or "-",
+                state.get("state") or ("UNKNOWN" if jobid else "NOT STARTED"),
+                state.get("elapsed") or "-",
+                state.get("node") or entry.get("hostname") or "-",
+                state.get("partition") or entry.get("partition") or "-",
+                slash_state(entry, state.get("state")),
+            ]
+        )
+        if args.timeline:
+            # the markers are appended while the job runs, so they are always read from the file
+            breakdown = timeline.breakdown(base_path / name) or {}
+            rows[-1] += [
+                timeline.human_span(breakdown.get("queue")),
+                timeline.human_span(breakdown.get("setup")),
+                timeline.human_span(breakdown.get("run")),
+                str(breakdown["returncode"]) if breakdown.get("returncode") is not None else "-",
+            ]
+
+    if not rows:
+        print("No sapp job found.")
+        return
+    header = ["IDENTIFIER", "JOBID", "STATE", "ELAPSED", "NODE", "PARTITION", "SLASH"]
+    if args.timeline:
+        header += ["QUEUE", "SETUP", "RUN", "EXIT"]
+    print(format_table(header, rows))
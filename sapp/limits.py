@@ -0,0 +1,292 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import getpass
+import json
+import os
+import shlex
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import utils
+from .config import SlurmConfig
+from .distributed import tasks_per_node
+
+
+def parse_limit(value: str) -> Optional[int]:
+    """slurm prints UNLIMITED, N/A or nothing for no limit."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_wall(value: str) -> Optional[float]:
+    """the time limit in seconds, None for no limit."""
+    if not value or value in ("UNLIMITED", "INFINITE", "N/A", "NONE"):
+        return None
+    return utils.parse_duration(value) or None
+
+
+def human_seconds(seconds: float) -> str:
+    days, seconds = divmod(int(seconds), 86400)
+    return f"{days}-{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def parse_tres(s: str) -> Dict[str, float]:
+    """e.g. "cpu=64,mem=100G,gres/gpu=8" -> {"cpu": 64, "mem": 102400, "gres/gpu": 8}. The memory is in MB."""
+    tres = {}
+    for item in str(s or "").split(","):
+        name, _, value = item.partition("=")
+        if not name or not value:
+            continue
+        if name == "mem":
+            tres[name] = utils.parse_size(value) / (1 << 20)
+        elif parse_limit(value) is not None:
+            tres[name] = parse_limit(value)
+    return tres
+
+
+def query_partitions(cluster: str = None) -> Dict[str, dict]:
+    proc = subprocess.run(
+        ["scontrol", "show", "partition", "-o"] + (["-M", cluster] if cluster else []),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError("scontrol fails to execute. Please check if slurm is available.")
+
+    partitions = {}
+    for line in proc.stdout.decode().splitlines():
+        fields = dict(item.partition("=")[::2] for item in line.split())
+        if "PartitionName" not in fields:
+            continue
+        partitions[fields["PartitionName"]] = {
+            "state": fields.get("State", "UP"),
+            "max_time": parse_wall(fields.get("MaxTime")),
+            "max_nodes": parse_limit(fields.get("MaxNodes")),
+            "max_cpus_per_node": parse_limit(fields.get("MaxCPUsPerNode")),
+            "max_mem_per_node": parse_limit(fields.get("MaxMemPerNode")),
+            "qos": fields.get("QoS") if fields.get("QoS") not in (None, "N/A") else None,
+            "allow_qos": fields.get("AllowQos", "ALL").split(","),
+        }
+    return partitions
+
+
+def query_qos() -> Dict[str, dict]:
+    """the QOS are shared by the clusters of the slurmdbd."""
+    proc = subprocess.run(
+        ["sacctmgr", "-nP", "show", "qos", "format=Name,MaxWall,MaxTRES,MaxTRESPU,MaxSubmitPU,MaxJobsPU"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError("sacctmgr fails to execute. Please check if slurm accounting is available.")
+
+    qos = {}
+    for line in proc.stdout.decode().splitlines():
+        fields = line.strip().split("|")
+        if len(fields) != 6:
+            continue
+        qos[fields[0]] = {
+            "max_wall": parse_wall(fields[1]),
+            "max_tres": parse_tres(fields[2]),
+            "max_tres_per_user": parse_tres(fields[3]),
+            "max_submit": parse_limit(fields[4]),
+            "max_jobs": parse_limit(fields[5]),
+        }
+    return qos
+
+
+def query_assoc(cluster: str = None) -> List[dict]:
+    """the associations of the user, one per account and partition."""
+    proc = subprocess.run(
+        ["sacctmgr", "-nP", "show", "assoc", "where", f"user={getpass.getuser()}"]
+        + ([f"cluster={cluster}"] if cluster else [])
+        + ["format=Partition,QOS,DefaultQOS,MaxSubmit,MaxJobs,MaxTRES,MaxWall"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError("sacctmgr fails to execute. Please check if slurm accounting is available.")
+
+    assoc = []
+    for line in proc.stdout.decode().splitlines():
+        fields = line.strip().split("|")
+        if len(fields) != 7:
+            continue
+        assoc.append(
+            {
+                "partition": fields[0],
+                "qos": [q for q in fields[1].split(",") if q],
+                "default_qos": fields[2] or None,
+                "max_submit": parse_limit(fields[3]),
+                "max_jobs": parse_limit(fields[4]),
+                "max_tres": parse_tres(fields[5]),
+                "max_wall": parse_wall(fields[6]),
+            }
+        )
+    return assoc
+
+
+def count_queued(cluster: str = None) -> int:
+    """the number of pending and running jobs of the user, for MaxSubmitJobs."""
+    proc = subprocess.run(
+        ["squeue", "-h", "-u", getpass.getuser(), "-o", "%i"] + (["-M", cluster] if cluster else []),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    return sum(1 for line in proc.stdout.decode().split() if line.isdigit())
+
+
+def requested_qos(slurm_config: SlurmConfig) -> Optional[str]:
+    """the --qos in the other arguments."""
+    try:
+        args = shlex.split(slurm_config.other or "")
+    except ValueError:
+        return None
+    for i, arg in enumerate(args):
+        if arg.startswith("--qos="):
+            return arg[len("--qos=") :]
+        if arg in ("-q", "--qos") and i + 1 < len(args):
+            return args[i + 1]
+    return None
+
+
+def requested_tres(slurm_config: SlurmConfig, general_config: dict = None) -> Dict[str, float]:
+    """the trackable resources of the job, in the units of sacctmgr."""
+    nodes = max(1, slurm_config.nodes)
+    ntasks = tasks_per_node(slurm_config) if slurm_config.distributed else max(1, slurm_config.ntasks)
+    per_job = (general_config or {}).get("gpu", False) and not slurm_config.distributed  # --gpus
+    gpus = slurm_config.num_gpus if per_job else slurm_config.num_gpus * nodes
+    tres = {
+        "node": nodes,
+        "cpu": slurm_config.cpus_per_task * (ntasks * nodes if slurm_config.distributed else ntasks),
+        "mem": utils.parse_size(slurm_config.mem) / (1 << 20) * nodes,
+        "gres/gpu": gpus,
+    }
+    if slurm_config.gpu_type not in (None, "Any Type", "Unknown GPU Type"):
+        tres[f"gres/gpu:{slurm_config.gpu_type}"] = gpus
+    return tres
+
+
+class Limits:
+    """
+    The limits of the partitions (`scontrol show partition`), the QOS and the associations of the user
+    (`sacctmgr`), cached in `<base_path>/.limits.json` for `ttl` seconds since they rarely change. `check` tells
+    whether a job breaks them, i.e. will be rejected or pending forever.
+    """
+
+    def __init__(self, base_path: Path, ttl: float = 3600) -> None:
+        self.path = Path(base_path) / ".limits.json"
+        self.ttl = ttl
+        self.loaded: Dict[str, dict] = {}
+
+    def read(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, cluster: str = None, cached_only: bool = False) -> dict:
+        """
+        The limits of the cluster. Empty if they could not be queried, i.e. nothing to check. If `cached_only`,
+        never query slurm and return empty unless the cache is fresh.
+        """
+        key = cluster or ""
+        if key in self.loaded:
+            return self.loaded[key]
+
+        cache = self.read()
+        entry = cache.get(key)
+        if entry is None or time.time() - entry.get("time", 0) > self.ttl:
+            if cached_only:
+                return {}
+            try:
+                entry = {
+                    "time": time.time(),
+                    "partitions": query_partitions(cluster),
+                    "qos": query_qos(),
+                    "assoc": query_assoc(cluster),
+                }
+            except RuntimeError:
+                entry = entry or {}  # keep the stale limits rather than none
+            else:
+                cache[key] = entry
+                # the forms warm the cache in a thread while the submission may query it as well
+                tmp_path = self.path.with_name(f".limits.{os.getpid()}.{threading.get_ident()}.tmp")
+                with open(tmp_path, "w") as f:
+                    f.write(json.dumps(cache))
+                os.replace(tmp_path, self.path)
+        self.loaded[key] = entry
+        return entry
+
+    def check(
+        self,
+        slurm_config: SlurmConfig,
+        time_limit: str = None,
+        general_config: dict = None,
+        count_jobs: bool = False,
+        cached_only: bool = False,
+    ) -> List[str]:
+        """
+        Return the reasons that the job could never start, empty if it looks fine. The time limit is checked if
+        given, and the number of queued jobs of the user (one squeue call) if `count_jobs`. With `cached_only`,
+        nothing is checked unless the limits are cached, see `get`.
+        """
+        limits = self.get(slurm_config.cluster, cached_only)
+        if not limits:
+            return []
+        partition = slurm_config.partition
+        seconds = utils.parse_duration(time_limit) if time_limit else 0
+        tres = requested_tres(slurm_config, general_config)
+        reasons = []
+
+        part = limits["partitions"].get(partition)
+        if part is not None:
+            if part["state"] != "UP":
+                reasons.append(f"partition {partition} is {part['state']}")
+            if seconds and part["max_time"] and seconds > part["max_time"]:
+                reasons.append(f"time exceeds MaxTime {human_seconds(part['max_time'])} of partition {partition}")
+            if part["max_nodes"] and tres["node"] > part["max_nodes"]:
+                reasons.append(f"{tres['node']} nodes exceed MaxNodes {part['max_nodes']} of partition {partition}")
+            cpus_per_node = tres["cpu"] / tres["node"]
+            if part["max_cpus_per_node"] and cpus_per_node > part["max_cpus_per_node"]:
+                reasons.append(f"cpus per node exceed MaxCPUsPerNode {part['max_cpus_per_node']} of {partition}")
+            mem_per_node = tres["mem"] / tres["node"]
+            if part["max_mem_per_node"] and mem_per_node > part["max_mem_per_node"]:
+                reasons.append(f"mem exceeds MaxMemPerNode {part['max_mem_per_node']}M of partition {partition}")
+
+        # the association of the partition, or the one for all partitions
+        assoc = [a for a in limits["assoc"] if a["partition"] == partition] or [
+            a for a in limits["assoc"] if not a["partition"]
+        ]
+        qos_name = requested_qos(slurm_config) or next((a["default_qos"] for a in assoc if a["default_qos"]), None)
+        if qos_name is None and "normal" in limits["qos"]:
+            qos_name = "normal"
+        if qos_name and any(a["qos"] for a in assoc) and not any(qos_name in a["qos"] for a in assoc):
+            reasons.append(f"QOS {qos_name} is not allowed for you on partition {partition}")
+        if qos_name and part is not None and "ALL" not in part["allow_qos"] and qos_name not in part["allow_qos"]:
+            reasons.append(f"QOS {qos_name} is not allowed on partition {partition}")
+
+        qos_names = dict.fromkeys([qos_name, part and part["qos"]])  # the partition QOS applies as well
+        scopes = [(f"QOS {q}", limits["qos"][q]) for q in qos_names if q in limits["qos"]]
+        scopes += [("your association", a) for a in assoc[:1]]
+        queued = None
+        if count_jobs and any(limit["max_submit"] is not None for _, limit in scopes):
+            queued = count_queued(slurm_config.cluster)
+        for scope, limit in scopes:
+            if seconds and limit["max_wall"] and seconds > limit["max_wall"]:
+                reasons.append(f"time exceeds MaxWall {human_seconds(limit['max_wall'])} of {scope}")
+            # more than the limits even with no other jobs running
+            for kind, key in (("MaxTRES", "max_tres"), ("MaxTRESPerUser", "max_tres_per_user")):
+                for name, value in limit.get(key, {}).items():
+                    if tres.get(name, 0) > value:
+                        reasons.append(f"{name}={tres[name]:g} exceeds {kind} {name}={value:g} of {scope}")
+            if queued is not None and limit["max_submit"] is not None and queued >= limit["max_submit"]:
+                reasons.append(f"{queued} queued jobs reach MaxSubmitJobs {limit['max_submit']} of {scope}")
+        return reasons
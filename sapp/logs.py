@@ -0,0 +1,260 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import argparse
+import bz2
+import ctypes
+import gzip
+import json
+import lzma
+import mmap
+import os
+import re
+import select
+import sys
+import time
+from pathlib import Path
+from typing import BinaryIO, List, Optional
+
+
+COMPRESSED = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+class Inotify:
+    """
+    A minimal inotify wrapper based on ctypes. Only used to wake up when the log folder changes.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 fails")
+
+    def add_watch(self, path: Path, mask: int):
+        if self._add_watch(self.fd, os.fsencode(path), mask) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch fails on {path}")
+
+    def wait(self, timeout: float) -> bool:
+        """wait for events. Return True if anything happens."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def log_segments(path: Path) -> List[Path]:
+    """
+    Return the rotated segments of a log file from the oldest to the newest, followed by the file itself.
+    Both numbered (output.txt.1, output.txt.2.gz) and dated (output.txt-20240101.gz) segments are supported.
+    """
+    path = Path(path)
+    numbered, dated = [], []
+    for p in path.parent.glob(path.name + "[.-]*"):
+        suffix = p.name[len(path.name) + 1 :]
+        if p.suffix in COMPRESSED:
+            suffix = suffix[: -len(p.suffix)]
+        if suffix.isdigit():
+            numbered.append((int(suffix), p))
+        elif suffix:
+            dated.append((suffix, p))
+
+    segments = [p for _, p in sorted(numbered, reverse=True)] + [p for _, p in sorted(dated)]
+    if path.exists():
+        segments.append(path)
+    return segments
+
+
+def open_segment(path: Path) -> BinaryIO:
+    return COMPRESSED.get(path.suffix, open)(path, "rb")
+
+
+def write(out: BinaryIO, data: bytes):
+    out.write(data)
+    out.flush()
+
+
+def tail(path: Path, lines: int) -> int:
+    """return the offset of the last `lines` lines of a file without reading the whole file."""
+    size = path.stat().st_size
+    if size == 0 or lines <= 0:
+        return size
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        end = size - 1 if mm[size - 1 : size] == b"\n" else size
+        for _ in range(lines):
+            end = mm.rfind(b"\n", 0, end)
+            if end < 0:
+                return 0
+        return end + 1
+
+
+def show(segments: List[Path], out: BinaryIO, lines: Optional[int] = None):
+    """print the segments. If lines is given, only print the last lines of the newest segment."""
+    if lines is not None:
+        segments = segments[-1:]
+    for segment in segments:
+        offset = tail(segment, lines) if lines is not None and segment.suffix not in COMPRESSED else 0
+        with open_segment(segment) as f:
+            f.seek(offset)
+            while chunk := f.read(1 << 20):
+                write(out, chunk)
+
+
+def search(segments: List[Path], pattern: str, out: BinaryIO, ignore_case: bool = False) -> int:
+    """
+    Print the lines that match the pattern. Plain files are searched through mmap and compressed
+    segments are streamed, so that multi-GB logs are never read into memory. `^` and `$` match at the line
+    boundaries in both, like grep. Return the number of matches.
+    """
+    regex = re.compile(pattern.encode(), re.MULTILINE | (re.IGNORECASE if ignore_case else 0))
+    count = 0
+    for segment in segments:
+        if segment.suffix in COMPRESSED:
+            with open_segment(segment) as f:
+                for line in f:
+                    if regex.search(line):
+                        write(out, line if line.endswith(b"\n") else line + b"\n")
+                        count += 1
+            continue
+
+        if segment.stat().st_size == 0:
+            continue
+        with open(segment, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            while match := regex.search(mm, pos):
+                start = mm.rfind(b"\n", 0, match.start()) + 1
+                end = mm.find(b"\n", match.end())
+                end = len(mm) if end < 0 else end + 1
+                line = mm[start:end]
+                write(out, line if line.endswith(b"\n") else line + b"\n")
+                count += 1
+                pos = end
+                if pos >= len(mm):
+                    break
+    return count
+
+
+def follow(path: Path, out: BinaryIO, lines: int = 10, interval: float = 1.0):
+    """
+    Print the last lines and keep printing the new contents, like `tail -F`. Wake up on inotify events.
+    Home folders of clusters are usually on NFS, where writes from the compute nodes do not trigger
+    inotify, so we also check the file every `interval` seconds.
+    """
+    path = Path(path)
+    try:
+        inotify = Inotify()
+        inotify.add_watch(
+            path.parent,
+            Inotify.IN_MODIFY
+            | Inotify.IN_CLOSE_WRITE
+            | Inotify.IN_CREATE
+            | Inotify.IN_DELETE
+            | Inotify.IN_MOVED_FROM
+            | Inotify.IN_MOVED_TO,
+        )
+    except (OSError, AttributeError):
+        inotify = None
+
+    f, inode = None, None
+    try:
+        while True:
+            # (re)open the file if it appears, rotates or gets truncated
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                stat = None
+            if stat is not None and (f is None or stat.st_ino != inode or stat.st_size < f.tell()):
+                if f is not None:
+                    write(out, f.read())  # drain the rotated file
+                    f.close()
+                    offset = 0
+                else:
+                    offset = tail(path, lines)
+                f, inode = open(path, "rb"), stat.st_ino
+                f.seek(offset)
+
+            if f is not None:
+                while chunk := f.read(1 << 20):
+                    write(out, chunk)
+
+            if inotify is not None:
+                inotify.wait(interval)
+            else:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if f is not None:
+            f.close()
+        if inotify is not None:
+            inotify.close()
+
+
+def log_path(folder: Path, stream: str = "output") -> Path:
+    """find the log file of a job. Use the path in job.json if any, otherwise the file in the job folder."""
+    job_path = folder / "job.json"
+    if job_path.exists():
+        with open(job_path, "r") as f:
+            job = json.loads(f.read())
+        path = job.get(stream)
+        if path:
+            jobid_path = folder / "SLURM_JOB_ID"
+            if "%j" in path and jobid_path.exists():
+                path = path.replace("%j", jobid_path.read_text().strip())
+            if "%x" in path and job.get("jobname"):
+                path = path.replace("%x", job["jobname"])
+            return Path(path)
+    return folder / ("output.txt" if stream == "output" else "error.txt")
+
+
+def cli(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="sapp logs", description="Show the outputs of a sapp job.")
+    parser.add_argument(
+        "job", nargs="?", default=None, help="sapp identifier or slurm job id. Default: the latest job."
+    )
+    parser.add_argument("-e", "--stderr", action="store_true", help="show stderr instead of stdout.")
+    parser.add_argument("-f", "--follow", action="store_true", help="keep printing new outputs.")
+    parser.add_argument("-n", "--lines", type=int, default=None, help="only show the last n lines.")
+    parser.add_argument("-g", "--grep", default=None, help="only show the lines matching the regex.")
+    parser.add_argument("-i", "--ignore-case", action="store_true", help="case insensitive --grep.")
+    args = parser.parse_args(argv)
+
+    from .core import Database
+
+    try:
+        folder = Database().find_job(args.job)
+    except FileNotFoundError as e:
+        parser.exit(1, f"sapp logs: {e}\n")
+
+    path = log_path(folder, "error" if args.stderr else "output")
+    segments = log_segments(path)
+    out = sys.stdout.buffer
+
+    if args.grep is not None:
+        if not segments:
+            parser.exit(1, f"sapp logs: {path} does not exist.\n")
+        count = search(segments, args.grep, out, args.ignore_case)
+        sys.exit(0 if count else 1)
+    elif args.follow:
+        follow(path, out, 10 if args.lines is None else args.lines)
+    else:
+        if not segments:
+            parser.exit(1, f"sapp logs: {path} does not exist.\n")
+        show(segments, out, args.lines)
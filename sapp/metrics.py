@@ -0,0 +1,157 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from typing import List
+
+from .gpustat import get_card_list
+from .history import History
+from .jobs import JobIndex, cluster_map, query_states, slash_state
+
+
+# histogram buckets in seconds
+SUBMIT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUEUE_BUCKETS = (10, 60, 300, 900, 3600, 4 * 3600, 12 * 3600, 86400)
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    """integers as they are, floats without losing precision (e.g. timestamps)."""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Metrics:
+    """Collect metrics in the OpenMetrics text format, which is also accepted by the node_exporter textfiles."""
+
+    def __init__(self) -> None:
+        self.lines: List[str] = []
+
+    def family(self, name: str, tp: str, help: str):
+        self.lines.append(f"# TYPE {name} {tp}")
+        self.lines.append(f"# HELP {name} {help}")
+
+    def sample(self, name: str, value: float, **labels):
+        if labels:
+            label_str = ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+            self.lines.append(f"{name}{{{label_str}}} {format_value(value)}")
+        else:
+            self.lines.append(f"{name} {format_value(value)}")
+
+    def gauge(self, name: str, help: str, samples: List[tuple]):
+        """samples are (labels, value) pairs."""
+        self.family(name, "gauge", help)
+        for labels, value in samples:
+            self.sample(name, value, **labels)
+
+    def histogram(self, name: str, help: str, values: List[float], buckets: tuple):
+        self.family(name, "histogram", help)
+        for le in buckets:
+            self.sample(f"{name}_bucket", sum(1 for v in values if v <= le), le=f"{le:g}")
+        self.sample(f"{name}_bucket", len(values), le="+Inf")
+        self.sample(f"{name}_count", len(values))
+        self.sample(f"{name}_sum", sum(values))
+
+    def text(self) -> str:
+        return "\n".join(self.lines + ["# EOF"]) + "\n"
+
+
+def collect(index: JobIndex, history: History) -> str:
+    """collect the metrics with one sinfo call, and squeue/sacct calls only for the unfinished jobs."""
+    metrics = Metrics()
+
+    card_list = get_card_list()
+    free = {"gpus": [], "cpus": [], "mem_bytes": []}
+    for partition, cards in card_list.items():
+        for gpu_type, nodes in cards.items():
+            labels = {"partition": partition, "gpu_type": gpu_type}
+            free["gpus"].append((labels, sum(n["gpu"] for n in nodes)))
+            free["cpus"].append((labels, sum(n["cpu"] for n in nodes)))
+            free["mem_bytes"].append((labels, sum(n["mem"] for n in nodes) * (1 << 20)))
+    metrics.gauge("sapp_free_gpus", "Free GPUs by partition and GPU type.", free["gpus"])
+    metrics.gauge("sapp_free_cpus", "Free CPUs on the nodes by partition and GPU type.", free["cpus"])
+    metrics.gauge("sapp_free_mem_bytes", "Free memory on the nodes by partition and GPU type.", free["mem_bytes"])
+
+    entries = index.refresh()
+    pending = [e["jobid"] for e in entries.values() if e.get("jobid") and not e.get("final")]
+    states = query_states(pending, cluster_map(entries))
+    index.update(states)
+    index.save()
+
+    counts, services = Counter(), Counter()
+    for entry in entries.values():
+        jobid = entry.get("jobid")
+        state = (states.get(jobid) or (entry if entry.get("final") else {})).get("state")
+        counts[state or ("UNKNOWN" if jobid else "NOT_STARTED")] += 1
+        slash = slash_state(entry, state)
+        if slash.endswith("(up)"):
+            services[entry["slash"]] += 1
+    metrics.gauge("sapp_jobs", "The sapp jobs of the user by state.", [({"state": s}, n) for s, n in counts.items()])
+    metrics.gauge(
+        "sapp_slash_services",
+        "Active slash proxy services by environment.",
+        [({"env": e}, n) for e, n in services.items()],
+    )
+
+    metrics.histogram(
+        "sapp_submit_latency_seconds", "The round trip of sbatch.", history.values("submit_latency"), SUBMIT_BUCKETS
+    )
+    metrics.histogram(
+        "sapp_queue_wait_seconds", "The queue wait of the sapp jobs.", history.values("queue_wait"), QUEUE_BUCKETS
+    )
+    metrics.gauge("sapp_last_update_seconds", "The time of the last update.", [({}, time.time())])
+    return metrics.text()
+
+
+def write_atomic(path: Path, text: str):
+    """write to a temporary file in the same folder then rename, so that readers never see a partial file."""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def cli(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="sapp export", description="Write the cluster availability and your sapp jobs as OpenMetrics."
+    )
+    parser.add_argument("--textfile", default=None, help="file to write, e.g. for the node_exporter. Default: stdout.")
+    parser.add_argument(
+        "-i", "--interval", type=float, default=0, help="keep writing every INTERVAL seconds. Default: write once."
+    )
+    args = parser.parse_args(argv)
+
+    from .core import Database
+
+    base_path = Path(Database.SAPP_FOLDER).expanduser()
+    base_path.mkdir(parents=True, exist_ok=True)
+    index = JobIndex(base_path)
+    try:
+        while True:
+            try:
+                with History(base_path) as history:
+                    history.backfill()
+                    text = collect(index, history)
+            except RuntimeError as e:  # keep the last file if slurm is not available for a while
+                print(f"sapp export: {e}", file=sys.stderr)
+                if args.interval <= 0:
+                    sys.exit(1)
+            else:
+                if args.textfile is None:
+                    print(text, end="", flush=True)
+                else:
+                    write_atomic(args.textfile, text)
+            if args.interval <= 0:
+                return
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
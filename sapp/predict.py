@@ -0,0 +1,281 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import getpass
+import json
+import math
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from . import utils
+from .config import SlurmConfig
+from .gpustat import avail_of, partition_key
+from .history import History
+
+
+# the expected wait of a setting without free resources and history
+UNKNOWN_WAIT = 3600.0
+
+
+def bucket(x: float) -> int:
+    """round up to the power of 2, so that similar requests share the same statistics."""
+    return 0 if x <= 0 else 1 << math.ceil(math.log2(x))
+
+
+class WaitPredictor:
+    """
+    Predict the queue wait of a config from the past jobs of the user.
+
+    The queue waits reported by sacct are aggregated on insertion at several granularities, from
+    (partition, gpu type, # gpus, cpus, mem, time limit, hour of day) down to the partition alone.
+    A prediction backs off to a coarser granularity when there are not enough samples, so it only costs a few
+    indexed lookups. The aggregates are updated incrementally with the jobs that start since the last sync. The
+    partitions of a named cluster are kept apart as `partition@cluster`.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS waits (
+        key TEXT PRIMARY KEY,
+        n INTEGER,
+        sum_log REAL
+    );
+    CREATE TABLE IF NOT EXISTS waits_seen (
+        jobid TEXT PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        name TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+
+    MIN_SAMPLES = 3
+
+    def __init__(self, history: History) -> None:
+        self.conn = history.conn
+        self.conn.executescript(self.SCHEMA)
+
+    @staticmethod
+    def keys(
+        partition: str, gpu_type: str, num_gpus: int, cpus: int, mem: float, time_limit: float, hour: int
+    ) -> List[str]:
+        """the aggregate keys from the finest to the coarsest granularity."""
+        gpu_type = (gpu_type or "").lower()
+        if gpu_type in ("any type", "unknown gpu type"):
+            gpu_type = ""
+        full = (
+            f"{partition}|{gpu_type}|{num_gpus}|{bucket(cpus)}|{bucket(mem / (1 << 30))}|{bucket(time_limit / 3600)}"
+        )
+        return [
+            f"{full}|{hour}",
+            full,
+            f"{partition}|{gpu_type}|{num_gpus}|{hour}",
+            f"{partition}|{gpu_type}|{num_gpus}",
+            f"{partition}|{gpu_type}",
+            f"{partition}",
+        ]
+
+    @classmethod
+    def config_keys(cls, config: SlurmConfig, time_limit: str = None, hour: int = None) -> List[str]:
+        hour = datetime.now().hour if hour is None else hour
+        return cls.keys(
+            partition_key(config.partition, config.cluster),
+            config.gpu_type,
+            config.num_gpus,
+            config.cpus_per_task * config.ntasks,
+            utils.parse_size(config.mem),
+            utils.parse_duration(time_limit),
+            hour,
+        )
+
+    def add(self, keys: List[str], wait: float):
+        log_wait = math.log1p(max(0.0, wait))
+        self.conn.executemany(
+            "INSERT INTO waits (key, n, sum_log) VALUES (?, 1, ?) "
+            "ON CONFLICT(key) DO UPDATE SET n = n + 1, sum_log = sum_log + excluded.sum_log",
+            [(key, log_wait) for key in keys],
+        )
+
+    def predict(self, config: SlurmConfig, time_limit: str = None, hour: int = None) -> Optional[Tuple[float, int]]:
+        """return the expected queue wait in seconds and the number of samples behind it, or None."""
+        for key in self.config_keys(config, time_limit, hour):
+            row = self.conn.execute("SELECT n, sum_log FROM waits WHERE key = ?", (key,)).fetchone()
+            if row is not None and row["n"] >= self.MIN_SAMPLES:
+                return math.expm1(row["sum_log"] / row["n"]), row["n"]
+        return None
+
+    @staticmethod
+    def parse_tres(s: str) -> dict:
+        """e.g. billing=8,cpu=8,gres/gpu:a40=1,gres/gpu=1,mem=40G,node=1"""
+        tres = {"cpu": 1, "mem": 0.0, "gpu": 0, "gpu_type": ""}
+        for item in s.split(","):
+            name, _, value = item.partition("=")
+            if name == "cpu":
+                tres["cpu"] = int(value or 1)
+            elif name == "mem":
+                tres["mem"] = utils.parse_size(value)
+            elif name == "gres/gpu":
+                tres["gpu"] = int(value or 0)
+            elif name.startswith("gres/gpu:"):
+                tres["gpu_type"] = name[len("gres/gpu:") :]
+        return tres
+
+    def sync(self, days: int = 30) -> int:
+        """
+        Aggregate the queue waits of the jobs of the user that started since the last sync with one sacct call for
+        each cluster in the history. Return the number of new samples.
+        """
+        clusters = {row["cluster"] for row in self.conn.execute("SELECT DISTINCT cluster FROM jobs")}
+        return sum(self.sync_cluster(cluster, days) for cluster in sorted(clusters | {None}, key=str))
+
+    def sync_cluster(self, cluster: Optional[str], days: int) -> int:
+        name = partition_key("last_sync", cluster)
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        now = time.time()
+        since = float(row["value"]) if row else now - days * 86400
+        # jobs pending at the last sync are still reported by sacct, so step back a little
+        start = datetime.fromtimestamp(since - 60).strftime("%Y-%m-%dT%H:%M:%S")
+
+        proc = subprocess.run(
+            [
+                "sacct",
+                "-X",
+                "-n",
+                "-P",
+                "-u",
+                getpass.getuser(),
+                "-S",
+                start,
+                "-o",
+                "JobIDRaw,Partition,ReqTRES,Timelimit,Submit,Start",
+            ]
+            + (["-M", cluster] if cluster else []),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        if proc.returncode != 0:
+            return 0
+
+        added = 0
+        with self.conn:
+            for line in proc.stdout.decode().splitlines():
+                fields = line.strip().split("|")
+                if len(fields) != 6:
+                    continue
+                jobid, partition, req_tres, time_limit, submit, started = fields
+                submit, started = History.parse_time(submit), History.parse_time(started)
+                if submit is None or started is None:
+                    continue  # not started yet, it will be reported again next time
+                seen = partition_key(jobid, cluster)
+                if self.conn.execute("INSERT OR IGNORE INTO waits_seen (jobid) VALUES (?)", (seen,)).rowcount == 0:
+                    continue
+                tres = self.parse_tres(req_tres)
+                keys = self.keys(
+                    partition_key(partition.split(",")[0], cluster),
+                    tres["gpu_type"],
+                    tres["gpu"],
+                    tres["cpu"],
+                    tres["mem"],
+                    utils.parse_duration(time_limit),
+                    datetime.fromtimestamp(submit).hour,
+                )
+                self.add(keys, started - submit)
+                added += 1
+            self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, str(now)))
+        return added
+
+
+def rank_settings(
+    settings: List[SlurmConfig], card_list: dict, predictor: WaitPredictor, time_limit: str = None
+) -> List[dict]:
+    """
+    Score the settings by the expected time to start, the fastest first. A setting that fits into the free
+    resources right now is expected to start immediately, otherwise we use the predicted queue wait. Settings
+    whose partition or gpu type is not in the current card list are skipped.
+    """
+    ranking = []
+    for config in settings:
+        cards = card_list.get(partition_key(config.partition, config.cluster))
+        if cards is None or (config.gpu_type != "Any Type" and config.gpu_type not in cards):
+            continue
+        avail = avail_of(config, card_list)
+        prediction = predictor.predict(config, time_limit)
+        if avail > 0:
+            expected = 0.0
+        elif prediction is not None:
+            expected = prediction[0]
+        else:
+            expected = UNKNOWN_WAIT
+        ranking.append(
+            {
+                "config": config,
+                "available": avail,
+                "predicted_wait": prediction[0] if prediction else None,
+                "samples": prediction[1] if prediction else 0,
+                "expected_wait": expected,
+            }
+        )
+    ranking.sort(key=lambda r: (r["expected_wait"], -r["available"]))
+    return ranking
+
+
+def right_size(config: SlurmConfig, history: History, headroom: float = 1.25, min_samples: int = 2) -> Optional[dict]:
+    """
+    Suggest tighter memory and cpus for a config based on the peak usage of its past jobs, with some headroom.
+    Return None if there are not enough samples or the config is already tight.
+    """
+    rows = history.usage(utils.config_digest(config))
+    if len(rows) < min_samples:
+        return None
+
+    suggestion = {"samples": len(rows), "mem": None, "cpus_per_task": None}
+
+    # memory: peak rss with headroom, rounded up to GB
+    peak_rss = max(r["max_rss"] for r in rows)
+    mem_gb = max(1, math.ceil(peak_rss * headroom / (1 << 30)))
+    requested = utils.parse_size(config.mem)
+    if requested > 0 and mem_gb * (1 << 30) < 0.75 * requested:
+        suggestion["mem"] = f"{mem_gb}G"
+
+    # cpus: peak cpu efficiency of the allocated cpus with headroom
+    peak_eff = max((r["total_cpu"] or 0) / (r["runtime"] * (r["alloc_cpus"] or 1)) for r in rows)
+    cpus = max(1, math.ceil(peak_eff * config.cpus_per_task * headroom))
+    if cpus < config.cpus_per_task:
+        suggestion["cpus_per_task"] = cpus
+
+    if suggestion["mem"] is None and suggestion["cpus_per_task"] is None:
+        return None
+    return suggestion
+
+
+def save_ranking(folder: Path, ranking: List[dict]):
+    """log the decision of the fastest start and its inputs into the job folder."""
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    data = {
+        "time": time.time(),
+        "chosen": ranking[0]["config"].name if ranking else None,
+        "candidates": [{**r, "config": r["config"].__dict__} for r in ranking],
+    }
+    with open(folder / "fastest.json", "w") as f:
+        f.write(json.dumps(data, indent=4))
+
+
+def sync(base_path):
+    """backfill the history and update the queue wait statistics. Safe to run in a background thread."""
+    with History(base_path) as history:
+        history.backfill()
+        WaitPredictor(history).sync()
+
+
+def human_wait(prediction: Optional[Tuple[float, int]]) -> str:
+    if prediction is None:
+        return "unknown"
+    wait = prediction[0]
+    if wait < 60:
+        return "<1m"
+    if wait < 3600:
+        return f"~{wait / 60:.0f}m"
+    return f"~{wait / 3600:.1f}h"
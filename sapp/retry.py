@@ -0,0 +1,205 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .backend import get_backend
+from .gpustat import partition_key
+from .jobs import FINAL_STATES, query_states
+from .utils import excluded, merge_exclude
+
+
+# job states caused by the node rather than the job
+NODE_STATES = {"NODE_FAIL", "BOOT_FAIL"}
+
+# messages of a broken gpu in the stderr of a failed job
+GPU_ERRORS = re.compile(
+    r"uncorrectable ECC error|CUDA error: unknown error|no CUDA-capable device is detected|GPU is lost|"
+    r"Unable to determine the device handle for GPU|NVML_ERROR|NVRM: Xid"
+)
+
+
+class Blacklist:
+    """
+    The nodes that failed the jobs of the user recently, stored at `<base_path>/.blacklist.json`. The entries
+    expire after `ttl` seconds, since the admins usually fix or drain a bad node soon.
+    """
+
+    def __init__(self, base_path: Path, ttl: float = 86400) -> None:
+        self.path = Path(base_path) / ".blacklist.json"
+        self.ttl = ttl
+
+    def read(self) -> Dict[str, dict]:
+        """the unexpired entries by `node@cluster`, see `gpustat.partition_key`."""
+        try:
+            with open(self.path, "r") as f:
+                entries = json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+        return {k: v for k, v in entries.items() if time.time() - v.get("time", 0) < self.ttl}
+
+    def nodes(self, cluster: str = None) -> List[str]:
+        return sorted(e["node"] for e in self.read().values() if e.get("cluster") == cluster)
+
+    def add(self, node: str, cluster: str = None, reason: str = None):
+        entries = self.read()
+        entries[partition_key(node, cluster)] = {
+            "node": node,
+            "cluster": cluster,
+            "time": time.time(),
+            "reason": reason,
+        }
+        tmp_path = self.path.with_name(f".blacklist.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(entries, indent=4))
+        os.replace(tmp_path, self.path)
+
+
+def bad_node(folder: Path, jobid: str, state: dict) -> Optional[str]:
+    """
+    The node to blame if the job failed because of it: the job ended with NODE_FAIL or BOOT_FAIL, or failed with
+    a gpu error in its stderr. The node is read from HOSTNAME (the head node of multi-node jobs), or from sacct
+    if the job never wrote it. None if the job failed by itself.
+    """
+    try:
+        node = (folder / "HOSTNAME").read_text().strip() or None
+    except OSError:
+        node = None
+    if node is None and state.get("node") and not re.search(r"[\[,]", state["node"]):
+        node = state["node"]  # a single node
+    if node is None:
+        return None
+    if state["state"] in NODE_STATES:
+        return node
+
+    if state["state"] == "FAILED":
+        try:
+            with open(folder / "job.json", "r") as f:
+                job = json.loads(f.read())
+            error = str(job.get("error") or "").replace("%j", jobid).replace("%x", job.get("jobname") or "")
+            with open(error, "rb") as f:
+                f.seek(max(0, os.path.getsize(error) - 65536))  # the end is enough
+                if GPU_ERRORS.search(f.read().decode(errors="replace")):
+                    return node
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def exclude_script(script: str, nodes: List[str]) -> str:
+    """render the #SBATCH lines of the script again with the nodes excluded."""
+    lines, header_end, args = script.splitlines(), 1, []
+    for i, line in enumerate(lines):
+        if not line.startswith("#SBATCH") and i > 0:
+            break
+        if line.startswith("#SBATCH"):
+            header_end = i + 1
+            tokens = shlex.split(line[len("#SBATCH") :])
+            if excluded(tokens):
+                args += tokens
+                lines[i] = None
+    exclude = merge_exclude(shlex.join(args), nodes)
+    lines.insert(header_end, f"#SBATCH {exclude}")
+    return "\n".join(line for line in lines if line is not None) + "\n"
+
+
+def watching(folder: Path) -> bool:
+    """whether a retry watcher still follows the job of the folder, see `Retry.watch`."""
+    try:
+        pid = (Path(folder) / "WATCHER").read_text().strip()
+    except OSError:
+        return False
+    return pid.isdigit() and (Path("/proc") / pid).exists()
+
+
+class Retry:
+    """
+    Watch an sbatch job from a detached process, and resubmit its script up to `retries` times if the job fails
+    because of a node. The node is added to the blacklist, and all the blacklisted nodes are excluded from the
+    new job. The new job id is written to SLURM_JOB_ID right away, and the failures are appended to RETRY. The
+    watcher follows SLURM_JOB_ID, so the later links of a chain are retried as well, and stops once the latest job
+    ends by itself. It keeps its pid in WATCHER, so that the daemon keeps the slash proxy until it gives up.
+    """
+
+    def __init__(self, folder: Path, retries: int, ttl: float = 86400) -> None:
+        self.folder = Path(folder)
+        self.retries = retries
+        self.ttl = ttl
+
+    def watch_command(self) -> List[str]:
+        return [
+            sys.executable,
+            "-c",
+            "from sapp.retry import Retry; Retry({!r}, {}, {}).watch()".format(
+                str(self.folder), self.retries, self.ttl
+            ),
+        ]
+
+    def spawn_watcher(self):
+        proc = subprocess.Popen(
+            self.watch_command(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        # before the submitting process exits, so the daemon never sees the job without its watcher
+        (self.folder / "WATCHER").write_text(str(proc.pid))
+
+    def watch(self, interval: float = 60):
+        watcher_path = self.folder / "WATCHER"
+        try:
+            watcher_path.write_text(str(os.getpid()))
+            self.follow(interval)
+        finally:
+            watcher_path.unlink(missing_ok=True)
+
+    def follow(self, interval: float):
+        try:
+            with open(self.folder / "job.json", "r") as f:
+                cluster = json.loads(f.read()).get("slurm_config", {}).get("cluster")
+        except (OSError, ValueError):
+            return
+        blacklist = Blacklist(self.folder.parent, self.ttl)
+
+        retries = 0
+        while self.folder.exists():
+            time.sleep(interval)
+            try:
+                jobid = (self.folder / "SLURM_JOB_ID").read_text().strip()
+                state = query_states([jobid], {jobid: cluster} if cluster else None).get(jobid)
+            except (OSError, RuntimeError):
+                continue
+            if state is None or state["state"] not in FINAL_STATES:
+                continue
+            # a chained job submits the next one before it ends, follow that one instead
+            try:
+                if (self.folder / "SLURM_JOB_ID").read_text().strip() != jobid:
+                    continue
+            except OSError:
+                continue
+            node = bad_node(self.folder, jobid, state)
+            if node is None:
+                return
+            blacklist.add(node, cluster, f"{state['state']} of job {jobid}")
+            if retries >= self.retries:
+                return
+
+            script_path = self.folder / "script.sh"
+            script_path.write_text(exclude_script(script_path.read_text(), blacklist.nodes(cluster)))
+            (self.folder / "HOSTNAME").unlink(missing_ok=True)
+            new_jobid = get_backend().submit(script_path)
+            with open(self.folder / "RETRY", "a") as f:
+                f.write(f"{jobid} {state['state']} {node} {new_jobid}\n")
+            if new_jobid is None:
+                return
+            (self.folder / "SLURM_JOB_ID").write_text(new_jobid)
+            retries += 1
@@ -0,0 +1,177 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from .tracing import tracer
+
+
+class RingBuffer:
+    """A bounded byte buffer that only keeps the last `capacity` bytes written to it."""
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.buffer = bytearray()
+        self.dropped = 0
+
+    def write(self, data: bytes):
+        self.buffer += data
+        excess = len(self.buffer) - self.capacity
+        if excess > 0:
+            del self.buffer[:excess]
+            self.dropped += excess
+
+    def getvalue(self) -> bytes:
+        return bytes(self.buffer)
+
+
+class Runner:
+    """
+    Run srun as a managed child process.
+
+    The child is put in its own process group. If we own the terminal, the terminal is handed over to the child,
+    so that Ctrl-C and window resizes reach srun exactly once. Signals sent to sapp directly are forwarded.
+    Stdout and stderr are streamed to the console as soon as they arrive, and optionally kept in ring buffers
+    that are written to the job folder on exit.
+    """
+
+    SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGWINCH)
+
+    # srun prints these messages only when the job has to wait in the queue, salloc for distributed jobs as well
+    QUEUED = re.compile(rb"s(?:run|alloc): job \d+ queued and waiting for resources")
+    GRANTED = re.compile(rb"srun: job \d+ has been allocated resources|salloc: Granted job allocation \d+")
+
+    def __init__(self, args: List[str], folder: Optional[Path] = None, tee: bool = False, tee_size: int = 4 << 20):
+        self.args = args
+        self.folder = Path(folder) if folder is not None else None
+        self.buffers = {"output.txt": RingBuffer(tee_size), "error.txt": RingBuffer(tee_size)} if tee else None
+        self.timing = {}
+        self.proc: subprocess.Popen = None
+
+    @staticmethod
+    def foreground_tty() -> Optional[int]:
+        """return the terminal fd if stdin is a terminal and we are in its foreground process group."""
+        try:
+            if os.isatty(0) and os.tcgetpgrp(0) == os.getpgrp():
+                return 0
+        except OSError:
+            pass
+        return None
+
+    @staticmethod
+    def set_foreground(tty: int, pgrp: int):
+        """make `pgrp` the foreground process group. SIGTTOU is ignored as we may be in background."""
+        handler = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+        try:
+            os.tcsetpgrp(tty, pgrp)
+        except OSError:
+            pass
+        finally:
+            signal.signal(signal.SIGTTOU, handler)
+
+    def forward(self, signum, frame):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.send_signal(signum)
+
+    def pump(self, source, target: int, name: str):
+        """copy the stream of the child to the console without buffering."""
+        tail = b""
+        fd = source.fileno()
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            self.timing.setdefault("first_output", time.time())
+
+            view = memoryview(data)
+            while view:
+                try:
+                    view = view[os.write(target, view) :]
+                except OSError:  # the console is gone, keep draining the pipe
+                    break
+
+            if self.buffers is not None:
+                self.buffers[name].write(data)
+
+            # look for the allocation messages of srun
+            if name == "error.txt" and "granted" not in self.timing:
+                tail = tail[-256:] + data
+                if "queued" not in self.timing and self.QUEUED.search(tail):
+                    self.timing["queued"] = time.time()
+                if self.GRANTED.search(tail):
+                    self.timing["granted"] = time.time()
+        source.close()
+
+    def run(self) -> int:
+        tty = self.foreground_tty()
+
+        def preexec():
+            os.setpgid(0, 0)
+            if tty is not None:
+                self.set_foreground(tty, os.getpgrp())
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        handlers = {sig: signal.signal(sig, self.forward) for sig in self.SIGNALS}
+        try:
+            self.timing["launch"] = time.time()
+            self.proc = subprocess.Popen(self.args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=preexec)
+
+            # also do it in the parent to avoid racing with the child
+            try:
+                os.setpgid(self.proc.pid, self.proc.pid)
+            except OSError:
+                pass
+            if tty is not None:
+                self.set_foreground(tty, self.proc.pid)
+
+            threads = [
+                threading.Thread(target=self.pump, args=(self.proc.stdout, 1, "output.txt"), daemon=True),
+                threading.Thread(target=self.pump, args=(self.proc.stderr, 2, "error.txt"), daemon=True),
+            ]
+            for thread in threads:
+                thread.start()
+
+            returncode = self.proc.wait()
+            for thread in threads:
+                thread.join()
+            self.timing["exit"] = time.time()
+            self.timing["returncode"] = returncode
+
+        finally:
+            if tty is not None:
+                self.set_foreground(tty, os.getpgrp())
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+            self.save()
+
+        return returncode
+
+    def save(self):
+        """write the timings and the captured outputs into the job folder."""
+        if self.folder is None:
+            return
+
+        # the script writes the job id first thing when the allocation is granted
+        jobid_path = self.folder / "SLURM_JOB_ID"
+        if "granted" not in self.timing and jobid_path.exists():
+            self.timing["granted"] = jobid_path.stat().st_mtime
+
+        with open(self.folder / "timing.json", "w") as f:
+            f.write(json.dumps(self.timing, indent=4))
+        tracer.srun(self.timing)
+
+        if self.buffers is not None:
+            for name, buffer in self.buffers.items():
+                with open(self.folder / name, "wb") as f:
+                    f.write(buffer.getvalue())
@@ -4,26 +4,63 @@
 # Licensed under the MIT license.
 
 import sys
+import time
 
+from .tracing import IMPORT_START, tracer  # first, to time the other imports
+
+
+# isort: split
+from . import availability, headless, history, jobs, logs, metrics, service, top, workflow
 from .forms import SlurmApplication
 
 
-def main():
-    sapp = SlurmApplication(sys.argv[1:])
-    sapp.run()
+IMPORT_END = time.time()
+
+
+# built-in sapp commands. Use `sapp -- <command>` to run a program with the same name on the compute node.
+COMMANDS = {
+    "export": metrics.cli,
+    "history": history.cli,
+    "logs": logs.cli,
+    "record": availability.cli,
+    "run": headless.cli,
+    "service": service.cli,
+    "status": jobs.cli,
+    "top": top.cli,
+    "workflow": workflow.cli,
+}
+
+
+def run_app(command):
+    tracer.complete("imports", IMPORT_START, IMPORT_END)
+    sapp = SlurmApplication(command)
+    with tracer.span("menu"):
+        sapp.run()
     sapp.process()
+    trace = tracer.save(sapp.database.base_path / sapp.database.identifier)
+    if trace is not None:
+        print(f"sapp: Trace saved to {trace}", file=sys.stderr)
+
+
+def main():
+    argv = sys.argv[1:]
+    if argv and argv[0] == "--profile":
+        tracer.enable()
+        argv = argv[1:]
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    if argv and argv[0] == "--":
+        argv = argv[1:]
+
+    run_app(argv)
 
 
 def spython():
-    sapp = SlurmApplication(["python"] + sys.argv[1:])
-    sapp.run()
-    sapp.process()
+    run_app(["python"] + sys.argv[1:])
 
 
 def spython3():
-    sapp = SlurmApplication(["python3"] + sys.argv[1:])
-    sapp.run()
-    sapp.process()
+    run_app(["python3"] + sys.argv[1:])
 
 
 if __name__ == "__main__":
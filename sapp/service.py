@@ -0,0 +1,260 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import argparse
+import getpass
+import json
+import os
+import pwd
+import socket
+import socketserver
+import struct
+import subprocess
+import threading
+import time
+from functools import partial
+from typing import Callable, Dict, List, Set
+
+
+# one service per login node, run by root or the service account and shared by all the users on it
+DEFAULT_SOCKET = "/run/sapp/service.sock"
+
+# the account trusted to run the shared service besides root, see `trusted_uids`
+SERVICE_USER = "sapp"
+
+
+def socket_path() -> str:
+    return os.environ.get("SAPP_SERVICE_SOCKET") or DEFAULT_SOCKET
+
+
+def service_user() -> str:
+    return os.environ.get("SAPP_SERVICE_USER") or SERVICE_USER
+
+
+def trusted_uids() -> Set[int]:
+    """root, the service account and the user itself (a private service), the only ones allowed to answer."""
+    uids = {0, os.getuid()}
+    try:
+        uids.add(pwd.getpwnam(service_user()).pw_uid)
+    except KeyError:
+        pass
+    return uids
+
+
+def is_shared() -> bool:
+    """whether this process runs the shared service, i.e. as root or the service account."""
+    return os.getuid() == 0 or getpass.getuser() == service_user()
+
+
+def trusted(path: str) -> bool:
+    """whether the socket belongs to a trusted account, so that no other user could answer for it."""
+    try:
+        return os.stat(path).st_uid in trusted_uids()
+    except OSError:
+        return False
+
+
+def peer_uid(sock: socket.socket):
+    """the user of the process at the other end, None if the platform does not tell."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    _, uid, _ = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid
+
+
+def request(op: str, timeout: float = 2, **kwargs):
+    """
+    Ask the local cluster-state service. Return None if the service is not running, is not run by a trusted
+    account, fails or does not answer within `timeout` seconds, so that the caller queries slurm by itself.
+    """
+    path = socket_path()
+    if not trusted(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            uid = peer_uid(sock)
+            if uid is not None and uid not in trusted_uids():
+                return None
+            sock.sendall(json.dumps({"op": op, **kwargs}).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+    return response.get("data") if isinstance(response, dict) and "error" not in response else None
+
+
+def squeue_all(cluster: str = None, user: str = None) -> Dict[str, dict]:
+    """the states of all the jobs in the queue, or only those of the user, with one squeue call."""
+    proc = subprocess.run(
+        ["squeue", "-h", "-o", "%i|%T|%M|%N|%P"]
+        + (["-u", user] if user else ["-a"])
+        + (["-M", cluster] if cluster else []),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError("squeue fails to execute. Please check if slurm is available.")
+    states = {}
+    for line in proc.stdout.decode().splitlines():
+        fields = line.strip().split("|")
+        if len(fields) == 5:
+            states[fields[0]] = {"state": fields[1], "elapsed": fields[2], "node": fields[3], "partition": fields[4]}
+    return states
+
+
+class ClusterState:
+    """
+    Cache the results of sinfo and squeue for `interval` seconds. When the cache is cold, only the first request
+    runs the command and the concurrent ones wait for its result (single flight).
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.cache: Dict[str, tuple] = {}
+        self.inflight: Dict[str, threading.Event] = {}
+        self.lock = threading.Lock()
+
+    def get(self, name: str, fetch: Callable):
+        with self.lock:
+            entry = self.cache.get(name)
+            if entry is not None and time.time() - entry[0] < self.interval:
+                return entry[1]
+            event = self.inflight.get(name)
+            leader = event is None
+            if leader:
+                event = self.inflight[name] = threading.Event()
+            start = time.time()
+
+        if not leader:
+            event.wait()
+            with self.lock:
+                entry = self.cache.get(name)
+            if entry is None or entry[0] < start:
+                raise RuntimeError(f"Fails to update {name}.")
+            return entry[1]
+
+        try:
+            data = fetch()
+            with self.lock:
+                self.cache[name] = (time.time(), data)
+            return data
+        finally:
+            with self.lock:
+                del self.inflight[name]
+            event.set()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server: Service = self.server
+        server.last_request = time.time()
+        try:
+            req = json.loads(self.rfile.readline(65536))
+            cluster = req.get("cluster") or None
+            if req.get("op") == "card_list":
+                from .gpustat import query_card_list
+
+                data = server.state.get(f"card_list@{cluster}", partial(query_card_list, cluster))
+            elif req.get("op") == "states":
+                states = server.state.get(f"squeue@{cluster}", partial(squeue_all, cluster, server.user))
+                data = {j: states[j] for j in map(str, req.get("jobids", [])) if j in states}
+            else:
+                raise ValueError(f"Unknown op {req.get('op')!r}.")
+            response = {"time": time.time(), "data": data}
+        except Exception as e:
+            response = {"error": str(e)}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class Service(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    A long-lived service that serves the card list and the job states to every sapp on the host through a Unix
+    socket, so that 50 sapp sessions cost one sinfo and one squeue per interval instead of 50 of each.
+
+    The shared service runs as root or the service account, and the clients only trust a socket of those. A
+    service run by any other user is private: only the user could connect, and squeue only lists their jobs.
+    The card list is the view of the account running the service.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, interval: float = 10, idle: float = 0) -> None:
+        self.state = ClusterState(interval)
+        self.idle = idle
+        self.last_request = time.time()
+        self.user = None if is_shared() else getpass.getuser()
+        if os.path.lexists(path):
+            if not trusted(path):
+                raise RuntimeError(f"{path} belongs to another user. Please choose another socket.")
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(path)
+                except OSError:
+                    self.unlink(path)  # left by a dead service
+                else:
+                    raise RuntimeError(f"The sapp service is already running at {path}.")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o755, exist_ok=True)
+        umask = os.umask(0o177 if self.user else 0o111)  # let the other users connect to the shared service
+        try:
+            super().__init__(path, Handler)
+        except OSError as e:
+            raise RuntimeError(f"Fails to listen at {path}: {e}") from e
+        finally:
+            os.umask(umask)
+
+    @staticmethod
+    def unlink(path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise RuntimeError(f"Fails to remove the stale socket {path}: {e}") from e
+
+    def watch_idle(self):
+        while time.time() - self.last_request < self.idle:
+            time.sleep(max(1, self.idle / 10))
+        self.shutdown()
+
+    def run(self):
+        if self.idle > 0:
+            threading.Thread(target=self.watch_idle, daemon=True).start()
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            try:
+                os.unlink(self.server_address)
+            except OSError:
+                pass
+
+
+def cli(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="sapp service",
+        description="Run a cluster-state service shared by all sapp users on this host, as root or the service "
+        "account ($SAPP_SERVICE_USER, default: sapp).",
+    )
+    parser.add_argument(
+        "--socket", default=None, help=f"the socket path. Default: $SAPP_SERVICE_SOCKET or {DEFAULT_SOCKET}."
+    )
+    parser.add_argument(
+        "-i", "--interval", type=float, default=10, help="seconds to reuse sinfo and squeue results. Default: 10."
+    )
+    parser.add_argument(
+        "--idle", type=float, default=0, help="exit after IDLE seconds without requests. Default: never."
+    )
+    args = parser.parse_args(argv)
+
+    path = args.socket or socket_path()
+    try:
+        service = Service(path, args.interval, args.idle)
+    except RuntimeError as e:
+        parser.exit(1, f"sapp service: {e}\n")
+    print(f"sapp service: listening at {path}", flush=True)
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,153 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from slash import Slash
+
+
+class SpeculativeGroup:
+    """
+    A group of sbatch jobs running the same command with different configs. Only the first one to start runs
+    the command, the others are cancelled.
+
+    The group lives in `<base_path>/.speculative/<identifier>`. Each generated script claims the group right
+    after it writes SLURM_JOB_ID: `mkdir` is atomic even on NFS, so exactly one job wins. The winner cancels its
+    siblings and the losers cancel themselves, so the group stays consistent even if the login session dies.
+    A detached watcher cancels the losers as soon as the winner starts and stops their slash services. It removes
+    the group folder once the losers are gone, after which a late loser fails to claim it and cancels itself.
+    """
+
+    def __init__(self, base_path: Path, identifier: str) -> None:
+        self.folder = Path(base_path) / ".speculative" / identifier
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.members: List[dict] = []
+
+    @classmethod
+    def load(cls, folder: Path) -> "SpeculativeGroup":
+        folder = Path(folder)
+        group = cls(folder.parent.parent, folder.name)
+        with open(folder / "group.json", "r") as f:
+            group.members = json.loads(f.read())["members"]
+        return group
+
+    def prologue(self) -> List[str]:
+        """script lines to claim the group. Must run after the job id is written."""
+        claim = shlex.join([str(self.folder / "claimed")])
+        jobids = shlex.join([str(self.folder / "jobids")])
+        return [
+            f"if ! mkdir {claim} 2>/dev/null; then scancel $SLURM_JOB_ID; exit 0; fi",
+            f"echo $SLURM_JOB_ID > {claim}/SLURM_JOB_ID",
+            f'[ -f {jobids} ] && grep -v "^$SLURM_JOB_ID " {jobids} |',
+            "  while read j c; do scancel ${c:+-M $c} $j; done",
+        ]
+
+    def add(self, identifier: str, jobid: str, slash: str = "none", jobname: str = None, cluster: str = None):
+        self.members.append(
+            {"identifier": identifier, "jobid": jobid, "slash": slash, "jobname": jobname, "cluster": cluster}
+        )
+
+    def by_cluster(self, members: List[dict]) -> Dict[Optional[str], List[str]]:
+        groups = defaultdict(list)
+        for m in members:
+            if m["jobid"]:
+                groups[m.get("cluster")].append(m["jobid"])
+        return groups
+
+    def save(self):
+        with open(self.folder / "group.json", "w") as f:
+            f.write(json.dumps({"members": self.members}, indent=4))
+        with open(self.folder / "jobids.tmp", "w") as f:
+            # one "<jobid> <cluster>" line per member, the cluster is empty for the default one
+            f.write("".join(f"{m['jobid']} {m.get('cluster') or ''}\n" for m in self.members if m["jobid"]))
+        os.replace(self.folder / "jobids.tmp", self.folder / "jobids")
+
+    def winner(self) -> str:
+        try:
+            return (self.folder / "claimed" / "SLURM_JOB_ID").read_text().strip() or None
+        except OSError:
+            return None
+
+    def active(self) -> List[str]:
+        """the member jobs still known to squeue. Raise RuntimeError if squeue fails."""
+        active = []
+        for cluster, jobids in self.by_cluster(self.members).items():
+            proc = subprocess.run(
+                ["squeue", "-h", "-j", ",".join(jobids), "-o", "%i"] + (["-M", cluster] if cluster else []),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            # squeue also fails on job ids that have left the queue, which is not an error here
+            if proc.returncode != 0 and b"Invalid job id" not in proc.stderr:
+                raise RuntimeError("squeue fails to execute. Please check if slurm is available.")
+            active += [j for j in proc.stdout.decode().split() if j in jobids]  # skip the "CLUSTER:" lines
+        return active
+
+    def cancel_losers(self, winner: str):
+        losers = [m for m in self.members if m["jobid"] and m["jobid"] != winner]
+        for cluster, jobids in self.by_cluster(losers).items():
+            subprocess.run(
+                ["scancel", *jobids] + (["-M", cluster] if cluster else []),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        for m in losers:
+            if m["slash"] != "none" and m["jobname"]:
+                try:
+                    Slash(env_name=m["slash"]).stop(m["jobname"])
+                except Exception:
+                    pass  # the slash daemon stops the service once the job is gone
+
+    def watch_command(self) -> List[str]:
+        return [
+            sys.executable,
+            "-c",
+            "from sapp.speculative import SpeculativeGroup; SpeculativeGroup.load({!r}).watch()".format(
+                str(self.folder)
+            ),
+        ]
+
+    def spawn_watcher(self):
+        subprocess.Popen(
+            self.watch_command(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def watch(self, interval: float = 10):
+        """
+        Wait for the first job to start, then clean up the others. Once the losers are gone, or all the jobs end
+        without a winner, remove the group folder. Runs in a detached process.
+        """
+        winner = None
+        while self.folder.exists():
+            winner = self.winner()
+            if winner is not None:
+                self.cancel_losers(winner)
+                break
+            if self.remaining() == []:
+                break
+            time.sleep(interval)
+
+        # a loser could still claim the group until it leaves the queue
+        while self.folder.exists() and self.remaining(winner) != []:
+            time.sleep(interval)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def remaining(self, winner: str = None) -> Optional[List[str]]:
+        """the active jobs other than the winner, None if squeue fails for now."""
+        try:
+            return [j for j in self.active() if j != winner]
+        except RuntimeError:
+            return None
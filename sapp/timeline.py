@@ -0,0 +1,104 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import json
+import shlex
+from pathlib import Path
+from typing import List, Optional
+
+
+# the markers written by the job script, in order
+MARKERS = ("alloc_start", "proxy_ready", "staging_done", "command_start", "command_exit")
+
+
+def mark(path: Path, name: str) -> str:
+    """the script line to append a marker with the current time to the TIMELINE file."""
+    return f'echo "{name} $(date +%s.%N)" >> {shlex.join([str(path)])}'
+
+
+def wait_for(condition: str, timeout: int = 30) -> str:
+    """the script line to wait up to `timeout` seconds for a shell condition to hold, checked every second."""
+    return f"for _ in $(seq {timeout}); do {condition} && break; sleep 1; done"
+
+
+def run(path: Path, command: str, background: bool = False) -> List[str]:
+    """
+    the script lines to run the command between the start and exit markers, keeping its exit code. Run it in the
+    background if the script traps signals, since bash runs the traps only after the foreground command exits.
+    """
+    if background:
+        # a trapped signal interrupts wait with a code > 128, then wait again for the command to exit
+        command_lines = [
+            f"{command} &",
+            "pid=$!",
+            "wait $pid",
+            "rc=$?",
+            "while [ $rc -gt 128 ] && kill -0 $pid 2>/dev/null; do wait $pid; rc=$?; done",
+        ]
+    else:
+        command_lines = [command, "rc=$?"]
+    return [
+        mark(path, "command_start"),
+        *command_lines,
+        f'echo "command_exit $(date +%s.%N) $rc" >> {shlex.join([str(path)])}',
+        "exit $rc",
+    ]
+
+
+def parse(path: Path) -> dict:
+    """read the markers of a job. A marker written more than once (e.g. requeued jobs) keeps the last value."""
+    timeline = {}
+    try:
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return timeline
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 2 or fields[0] not in MARKERS:
+            continue
+        try:
+            timeline[fields[0]] = float(fields[1])
+            if fields[0] == "command_exit" and len(fields) > 2:
+                timeline["returncode"] = int(fields[2])
+        except ValueError:
+            continue  # a partial line of a killed job
+    return timeline
+
+
+def breakdown(folder: Path) -> Optional[dict]:
+    """
+    Split the wall time of a job into the queue wait (submission to allocation), the setup (allocation to
+    the command start, i.e. the overhead of sapp in the job) and the run time. None if the job has not started.
+    """
+    folder = Path(folder)
+    timeline = parse(folder / "TIMELINE")
+    if "alloc_start" not in timeline:
+        return None
+
+    try:
+        with open(folder / "job.json", "r") as f:
+            submit_time = json.loads(f.read()).get("submit_time")
+    except (OSError, ValueError):
+        submit_time = None
+
+    alloc_start, command_start = timeline["alloc_start"], timeline.get("command_start")
+    command_exit = timeline.get("command_exit")
+    return {
+        "queue": alloc_start - submit_time if submit_time is not None else None,
+        "setup": command_start - alloc_start if command_start is not None else None,
+        "run": command_exit - command_start if command_exit is not None and command_start is not None else None,
+        "returncode": timeline.get("returncode"),
+        **timeline,
+    }
+
+
+def human_span(seconds: Optional[float]) -> str:
+    """like `history.human_duration`, but keeps the sub-second overheads visible."""
+    if seconds is None:
+        return "-"
+    if seconds < 60:
+        return f"{seconds:.2f}s"
+    from .history import human_duration
+
+    return human_duration(seconds)
@@ -0,0 +1,206 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import argparse
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import utils
+from .jobs import JobIndex, cluster_map, format_table, query_states
+
+
+def parse_tres(s: str) -> Dict[str, str]:
+    """e.g. cpu=00:01:23,energy=0,fs/disk=1234,mem=1124K"""
+    return dict(item.split("=", 1) for item in s.split(",") if "=" in item)
+
+
+def human_size(n: float) -> str:
+    for unit in ("B", "K", "M", "G", "T"):
+        if abs(n) < 1024 or unit == "T":
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+
+
+class Sampler:
+    """
+    Sample the resource usage of running jobs with one squeue call per cluster and one sstat call per refresh.
+
+    The allocation of a job is fetched only when the job shows up for the first time, and the usage counters are
+    cumulative, so the rates are computed from the deltas between two refreshes. sstat has no -M, so the usage of
+    the jobs on named clusters is unknown and only their allocations are shown.
+    """
+
+    def __init__(self) -> None:
+        self.allocs: Dict[str, dict] = {}
+        self.previous: Dict[str, dict] = {}
+
+    def running(self, jobids: List[str], cluster: str = None) -> List[str]:
+        if not jobids:
+            return []
+        new = [j for j in jobids if j not in self.allocs]
+        fmt = "%i|%C|%m|%N|%M" if new else "%i|||%N|%M"
+        proc = subprocess.run(
+            ["squeue", "-h", "-t", "RUNNING", "-j", ",".join(jobids), "-o", fmt]
+            + (["-M", cluster] if cluster else []),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        running = []
+        for line in proc.stdout.decode().splitlines():  # with -M, the "CLUSTER:" line has no fields
+            fields = line.strip().split("|")
+            if len(fields) != 5:
+                continue
+            jobid, cpus, mem, node, elapsed = fields
+            if jobid not in self.allocs:
+                self.allocs[jobid] = {"cpus": int(cpus or 1), "mem": utils.parse_size(mem)}
+            self.allocs[jobid].update(node=node, elapsed=utils.parse_duration(elapsed))
+            running.append(jobid)
+        return running
+
+    def forget(self, running: List[str]):
+        """forget the finished jobs."""
+        for jobid in list(self.allocs):
+            if jobid not in running:
+                self.allocs.pop(jobid)
+                self.previous.pop(jobid, None)
+
+    def usage(self, jobids: List[str]) -> Dict[str, dict]:
+        """the cumulative usage of all the steps of the jobs."""
+        usage = {j: {"cpu": 0.0, "rss": 0.0, "read": 0.0, "write": 0.0} for j in jobids}
+        if not jobids:
+            return usage
+        proc = subprocess.run(
+            ["sstat", "-a", "-n", "-P", "-j", ",".join(jobids), "-o", "JobID,MaxRSS,TRESUsageInTot,TRESUsageOutTot"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        for line in proc.stdout.decode().splitlines():
+            fields = line.strip().split("|")
+            if len(fields) != 4:
+                continue
+            jobid = fields[0].split(".")[0]
+            if jobid not in usage:
+                continue
+            tres_in, tres_out = parse_tres(fields[2]), parse_tres(fields[3])
+            usage[jobid]["cpu"] += utils.parse_duration(tres_in.get("cpu"))
+            usage[jobid]["rss"] = max(usage[jobid]["rss"], utils.parse_size(fields[1], "B"))
+            usage[jobid]["read"] += utils.parse_size(tres_in.get("fs/disk"), "B")
+            usage[jobid]["write"] += utils.parse_size(tres_out.get("fs/disk"), "B")
+        return usage
+
+    def sample(self, groups: Dict[Optional[str], List[str]]) -> Dict[str, dict]:
+        """sample the running jobs among the job ids grouped by cluster, None for the default one."""
+        now = time.time()
+        running = {j: cluster for cluster, jobids in groups.items() for j in self.running(jobids, cluster)}
+        self.forget(list(running))
+        samples = {}
+        for jobid, cluster in running.items():
+            if cluster is not None:
+                alloc = self.allocs[jobid]
+                samples[jobid] = {"node": alloc["node"], "cpus": alloc["cpus"], "mem": alloc["mem"], "cpu_eff": None}
+        for jobid, curr in self.usage([j for j, cluster in running.items() if cluster is None]).items():
+            alloc = self.allocs[jobid]
+            prev = self.previous.get(jobid)
+            if prev is not None and now > prev["time"]:
+                dt = now - prev["time"]
+                cpu_eff = (curr["cpu"] - prev["cpu"]) / (dt * alloc["cpus"])
+                read_rate = (curr["read"] - prev["read"]) / dt
+                write_rate = (curr["write"] - prev["write"]) / dt
+            else:
+                # first sample, use the average since the job starts
+                dt = max(alloc["elapsed"], 1)
+                cpu_eff = curr["cpu"] / (dt * alloc["cpus"])
+                read_rate = curr["read"] / dt
+                write_rate = curr["write"] / dt
+            self.previous[jobid] = {"time": now, **curr}
+            samples[jobid] = {
+                "node": alloc["node"],
+                "cpus": alloc["cpus"],
+                "cpu_eff": max(0.0, cpu_eff),
+                "rss": curr["rss"],
+                "mem": alloc["mem"],
+                "read": max(0.0, read_rate),
+                "write": max(0.0, write_rate),
+            }
+        return samples
+
+
+def over_provisioned(sample: dict, threshold: float = 0.25) -> bool:
+    """the job uses less than a quarter of the cpus or the memory it requests."""
+    if sample["cpu_eff"] is None:  # unknown usage
+        return False
+    if sample["cpus"] > 1 and sample["cpu_eff"] < threshold:
+        return True
+    return sample["mem"] > 0 and sample["rss"] < threshold * sample["mem"]
+
+
+def render(names: Dict[str, str], samples: Dict[str, dict], color: bool) -> str:
+    header = ["IDENTIFIER", "JOBID", "NODE", "CPUS", "CPU EFF", "MAXRSS", "MEM", "READ/s", "WRITE/s"]
+    rows, flags = [], []
+    for jobid, s in samples.items():
+        known = s["cpu_eff"] is not None
+        rows.append(
+            [
+                names.get(jobid, "-"),
+                jobid,
+                s["node"],
+                str(s["cpus"]),
+                f"{s['cpu_eff'] * 100:.0f}%" if known else "-",
+                human_size(s["rss"]) if known else "-",
+                human_size(s["mem"]) if s["mem"] else "-",
+                human_size(s["read"]) if known else "-",
+                human_size(s["write"]) if known else "-",
+            ]
+        )
+        flags.append(over_provisioned(s))
+    lines = format_table(header, rows).split("\n")
+    if color:
+        lines = [lines[0]] + [f"\033[33m{line}\033[0m" if flag else line for line, flag in zip(lines[1:], flags)]
+    return "\n".join(lines)
+
+
+def cli(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="sapp top", description="Show the resource usage of your running sapp jobs.")
+    parser.add_argument("-d", "--delay", type=float, default=5, help="seconds between refreshes. Default: 5.")
+    parser.add_argument("--once", action="store_true", help="print once and exit.")
+    args = parser.parse_args(argv)
+
+    from .core import Database
+
+    index = JobIndex(Path(Database.SAPP_FOLDER).expanduser())
+    color = sys.stdout.isatty()
+    sampler = Sampler()
+
+    try:
+        while True:
+            # mark the finished jobs like `sapp status`, so that only the running ones go to squeue
+            entries = index.refresh()
+            clusters = cluster_map(entries)
+            pending = [e["jobid"] for e in entries.values() if e.get("jobid") and not e.get("final")]
+            states = query_states(pending, clusters)
+            index.update(states)
+            index.save()
+
+            names, groups = {}, defaultdict(list)
+            for name, entry in entries.items():
+                jobid = entry.get("jobid")
+                if jobid in states and states[jobid]["state"] == "RUNNING":
+                    names[jobid] = name
+                    groups[clusters.get(jobid)].append(jobid)
+            samples = sampler.sample(groups)
+
+            if not args.once:
+                print("\033[H\033[2J", end="")
+                print(f"sapp top - {time.strftime('%H:%M:%S')} - refresh every {args.delay:g}s, Ctrl-C to quit")
+                print("Highlighted jobs use less than 25% of the cpus or memory they request.\n")
+            print(render(names, samples, color) if samples else "No running sapp job.", flush=True)
+
+            if args.once:
+                return
+            time.sleep(args.delay)
+    except KeyboardInterrupt:
+        pass
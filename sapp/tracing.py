@@ -0,0 +1,88 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import List, Optional
+
+
+# the time this module is imported, it is imported first by `sapp.sapp` to time the other imports
+IMPORT_START = time.time()
+
+_NULL = nullcontext()
+
+
+class Tracer:
+    """
+    Record the wall time of the phases of a sapp invocation in the Chrome trace format, which could be opened
+    with chrome://tracing or https://ui.perfetto.dev.
+
+    It is enabled by `sapp --profile` or the env var `SAPP_PROFILE=1`. When disabled, `span` returns a shared
+    null context and nothing is recorded.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.events: List[dict] = []
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def complete(self, name: str, start: Optional[float], end: Optional[float], **args):
+        """record a phase with the start and end time in seconds since the epoch."""
+        if not self.enabled or start is None or end is None:
+            return
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": max(0.0, end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+
+    def span(self, name: str, **args):
+        """a context manager that records the phase inside."""
+        if not self.enabled:
+            return _NULL
+        return self._span(name, args)
+
+    @contextmanager
+    def _span(self, name: str, args: dict):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.time(), **args)
+
+    def srun(self, timing: dict):
+        """record the phases of an srun job from the timings of the runner."""
+        launch, granted, exit = timing.get("launch"), timing.get("granted"), timing.get("exit")
+        self.complete("srun allocation wait", launch, granted, queued="queued" in timing)
+        self.complete("command start", granted, timing.get("first_output"))
+        self.complete("command", granted, exit, returncode=timing.get("returncode"))
+
+    def save(self, folder: Path) -> Optional[Path]:
+        """write the trace into the job folder."""
+        if not self.enabled:
+            return None
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            events = sorted(self.events, key=lambda e: e["ts"])
+        path = folder / "trace.json"
+        with open(path, "w") as f:
+            f.write(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, indent=4))
+        return path
+
+
+tracer = Tracer(enabled=os.environ.get("SAPP_PROFILE", "") not in ("", "0"))
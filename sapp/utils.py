@@ -1,18 +1,95 @@
 # Copyright (c) Haoyi Wu.
 # Licensed under the MIT license.
 
+import hashlib
+import json
 import os
 import shlex
 import sys
-from typing import List, Union
+import warnings
+from dataclasses import fields
+from typing import Dict, List, Optional, Union
 
 from .config import SlurmConfig, SubmitConfig
+from .distributed import tasks_per_node
 
 
 def resolve_identifier(s: str, identifier: str = None):
     return s.replace("%i", identifier) if identifier is not None else s
 
 
+def parse_clusters(s: str) -> List[str]:
+    """the clusters in the general config, e.g. "a, b,c" -> ["a", "b", "c"]. Empty for the default cluster only."""
+    return [c.strip() for c in str(s or "").split(",") if c.strip()]
+
+
+# fields added to SlurmConfig later and their defaults, ignored by the digest when unset so that old digests stay
+LATER_FIELDS = {
+    f.name: f.default
+    for f in fields(SlurmConfig)
+    if f.name in ("cluster", "constraint", "distributed", "cpu_bind", "gpu_bind", "mem_bind", "hint", "set_threads")
+}
+
+
+def config_digest(config: SlurmConfig) -> str:
+    """
+    A short digest of the resources requested by a slurm config. The config name is ignored so that
+    equivalent settings share the same digest.
+    """
+    data = {
+        k: v for k, v in config.__dict__.items() if k != "name" and not (k in LATER_FIELDS and v == LATER_FIELDS[k])
+    }
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def parse_size(s: str, default_unit: str = "M") -> float:
+    """
+    Parse the slurm memory size (e.g. 40G, 1124K, 2.5M) into bytes. Return 0 for empty or invalid inputs.
+    """
+    units = {"b": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+    s = str(s or "").strip().lower()
+    # sacct reports the memory per node or per cpu with a trailing n or c
+    if s[-1:] in ("n", "c") and s[-2:-1] in units:
+        s = s[:-1]
+    try:
+        if s[-1:] in units:
+            return float(s[:-1]) * units[s[-1]]
+        return float(s) * units[default_unit.lower()] if s else 0
+    except ValueError:
+        return 0
+
+
+def parse_duration(s: str) -> float:
+    """
+    Parse the slurm time format into seconds: MM, MM:SS, HH:MM:SS, D-HH, D-HH:MM and D-HH:MM:SS, where the seconds
+    may have decimals (e.g. MM:SS.mmm of sacct). Return 0 for invalid inputs.
+    """
+    s = str(s or "").strip()
+    days = 0
+    dashed = "-" in s
+    if dashed:
+        d, s = s.split("-", 1)
+        try:
+            days = int(d)
+        except ValueError:
+            return 0
+    try:
+        parts = [float(p) for p in s.split(":")] if s else []
+    except ValueError:
+        return 0
+    seconds = 0
+    for p in parts:
+        seconds = seconds * 60 + p
+    # D-HH means hours and D-HH:MM means hours and minutes, even if D is 0
+    if dashed and len(parts) == 1:
+        seconds *= 3600
+    elif dashed and len(parts) == 2:
+        seconds *= 60
+    elif len(parts) == 1:  # a lone number means minutes
+        seconds *= 60
+    return days * 86400 + seconds
+
+
 def parse_arguments(s: str) -> List[str]:
     """
     Parse the arguments into different lines for sbatch use.
@@ -34,11 +111,131 @@ def parse_arguments(s: str) -> List[str]:
     return lines
 
 
+def task_args(slurm_config: SlurmConfig) -> List[str]:
+    """a distributed job runs one task per gpu on every node, see `distributed.launch`."""
+    if slurm_config.distributed:
+        return [f"--ntasks-per-node={tasks_per_node(slurm_config)}"]
+    return ["-n", str(slurm_config.ntasks)]
+
+
+def gpu_arg(slurm_config: SlurmConfig, general_config: dict) -> str:
+    """the gpus are counted per node for distributed jobs, while --gpus counts the whole job."""
+    if general_config.get("gpu", False):
+        return "--gpus-per-node=" if slurm_config.distributed else "--gpus="
+    return "--gres=gpu:"
+
+
+# binding presets for common workloads. --hint could not be used together with --cpu-bind
+BINDING_PRESETS = {
+    "none": {"cpu_bind": None, "gpu_bind": None, "mem_bind": None, "hint": None, "set_threads": False},
+    "gpu": {"cpu_bind": "cores", "gpu_bind": "closest", "mem_bind": "local", "hint": None, "set_threads": True},
+    "gpu-nosmt": {
+        "cpu_bind": None,
+        "gpu_bind": "closest",
+        "mem_bind": "local",
+        "hint": "nomultithread",
+        "set_threads": True,
+    },
+    "cpu": {"cpu_bind": "cores", "gpu_bind": None, "mem_bind": "local", "hint": None, "set_threads": True},
+    "memory-bound": {
+        "cpu_bind": None,
+        "gpu_bind": None,
+        "mem_bind": "local",
+        "hint": "memory_bound",
+        "set_threads": True,
+    },
+}
+
+
+def binding_preset(slurm_config: SlurmConfig) -> Optional[str]:
+    """the name of the preset that the binding options match, None for custom options."""
+    for name, preset in BINDING_PRESETS.items():
+        if all(getattr(slurm_config, k) == v for k, v in preset.items()):
+            return name
+    return None
+
+
+def thread_env(slurm_config: SlurmConfig) -> Dict[str, str]:
+    if not slurm_config.set_threads:
+        return {}
+    return {"OMP_NUM_THREADS": str(slurm_config.cpus_per_task), "MKL_NUM_THREADS": str(slurm_config.cpus_per_task)}
+
+
+def binding_args(slurm_config: SlurmConfig, tp: str) -> List[str]:
+    """
+    The binding options of the tasks. --cpu-bind is only known by srun, and salloc could not export variables, so
+    the steps started later with srun (e.g. `distributed.launch`) should take the srun options as well.
+    """
+    args = []
+    if slurm_config.cpu_bind and tp == "srun":
+        args += [f"--cpu-bind={slurm_config.cpu_bind}"]
+    if slurm_config.gpu_bind:
+        args += [f"--gpu-bind={slurm_config.gpu_bind}"]
+    if slurm_config.mem_bind:
+        args += [f"--mem-bind={slurm_config.mem_bind}"]
+    if slurm_config.hint:
+        if slurm_config.cpu_bind and tp == "srun":
+            warnings.warn(f"--hint={slurm_config.hint} is ignored since --cpu-bind is given.", UserWarning)
+        else:
+            args += [f"--hint={slurm_config.hint}"]
+    env = thread_env(slurm_config)
+    if env and tp in ("srun", "sbatch"):
+        args += ["--export=ALL," + ",".join(f"{k}={v}" for k, v in env.items())]
+    return args
+
+
+def binds_tasks(slurm_config: SlurmConfig) -> bool:
+    """whether the config binds the tasks, which only srun does."""
+    return bool(slurm_config.cpu_bind or slurm_config.gpu_bind or slurm_config.mem_bind)
+
+
+def bound_command(command: str, slurm_config: SlurmConfig) -> str:
+    """the command of a batch script run as a single srun step with the binding options, e.g. `srun -n 1 ... cmd`."""
+    args = ["srun", "-N", "1", "-n", "1", "-c", str(slurm_config.cpus_per_task)]
+    if slurm_config.unbuffered:
+        args += ["-u"]
+    return shlex.join(args + binding_args(slurm_config, "srun")) + " " + command
+
+
+def excluded(args: List[str]) -> List[str]:
+    """the nodes of -x/--exclude in the arguments."""
+    nodes = []
+    for i, arg in enumerate(args):
+        if arg.startswith("--exclude="):
+            nodes += arg[len("--exclude=") :].split(",")
+        elif arg in ("-x", "--exclude") and i + 1 < len(args):
+            nodes += args[i + 1].split(",")
+    return [node for node in nodes if node]
+
+
+def merge_exclude(other: Optional[str], nodes: List[str]) -> Optional[str]:
+    """merge the nodes into the -x/--exclude of the other arguments, e.g. ("--exclude a -q high", ["b"])."""
+    if not nodes:
+        return other
+    args, rest = shlex.split(other or ""), []
+    skip = False
+    for i, arg in enumerate(args):
+        if skip:
+            skip = False
+        elif arg in ("-x", "--exclude") and i + 1 < len(args):
+            skip = True
+        elif not arg.startswith("--exclude="):
+            rest.append(arg)
+    merged = list(dict.fromkeys(excluded(args) + nodes))
+    return shlex.join(rest + [f"--exclude={','.join(merged)}"])
+
+
 def get_command(
-    config: Union[SlurmConfig, SubmitConfig], tp: str = None, identifier: str = None, general_config: dict = None
+    config: Union[SlurmConfig, SubmitConfig],
+    tp: str = None,
+    identifier: str = None,
+    general_config: dict = None,
+    exclude: List[str] = None,
 ):
+    """the srun or salloc arguments, or the sbatch header lines. The `exclude` nodes are merged into `other`."""
     general_config = {} if general_config is None else general_config
     slurm_config = config.slurm_config if isinstance(config, SubmitConfig) else config
+    other = merge_exclude(slurm_config.other, exclude or [])
     if tp is None and isinstance(config, SubmitConfig):
         tp = "srun" if config.task in (0, 2) else "sbatch"
     args = []
@@ -46,13 +243,15 @@ def get_command(
     if tp == "srun":
         args += ["srun"]
         args += ["-N", str(slurm_config.nodes)]
-        args += ["-n", str(slurm_config.ntasks)]
+        args += task_args(slurm_config)
         if slurm_config.disable_status:
             args += ["-X"]
         if slurm_config.unbuffered:
             args += ["-u"]
         args += ["-p", str(slurm_config.partition)]
-        gpu_argname = "--gpus=" if general_config.get("gpu", False) else "--gres=gpu:"
+        if slurm_config.cluster:
+            args += ["-M", slurm_config.cluster]
+        gpu_argname = gpu_arg(slurm_config, general_config)
         if slurm_config.gpu_type == "Any Type" or slurm_config.gpu_type == "Unknown GPU Type":
             args += [f"{gpu_argname}{slurm_config.num_gpus}"]
         else:
@@ -60,8 +259,11 @@ def get_command(
         args += ["-c", str(slurm_config.cpus_per_task)]
         if slurm_config.mem:
             args += ["--mem", slurm_config.mem]
-        if slurm_config.other:
-            args += shlex.split(slurm_config.other)
+        if slurm_config.constraint:
+            args += [f"--constraint={slurm_config.constraint}"]
+        args += binding_args(slurm_config, "srun")
+        if other:
+            args += shlex.split(other)
 
         if isinstance(config, SubmitConfig):
             args += ["-t", config.time]
@@ -76,12 +278,44 @@ def get_command(
             if config.mail_user:
                 args += ["--mail-user", config.mail_user]
 
+    elif tp == "salloc":
+        args += ["salloc", "--no-shell"]
+        args += ["-N", str(slurm_config.nodes)]
+        args += task_args(slurm_config)
+        args += ["-p", str(slurm_config.partition)]
+        if slurm_config.cluster:
+            args += ["-M", slurm_config.cluster]
+        gpu_argname = gpu_arg(slurm_config, general_config)
+        if slurm_config.gpu_type == "Any Type" or slurm_config.gpu_type == "Unknown GPU Type":
+            args += [f"{gpu_argname}{slurm_config.num_gpus}"]
+        else:
+            args += [f"{gpu_argname}{slurm_config.gpu_type}:{slurm_config.num_gpus}"]
+        args += ["-c", str(slurm_config.cpus_per_task)]
+        if slurm_config.mem:
+            args += ["--mem", slurm_config.mem]
+        if slurm_config.constraint:
+            args += [f"--constraint={slurm_config.constraint}"]
+        args += binding_args(slurm_config, "salloc")
+        if other:
+            args += shlex.split(other)
+
+        if isinstance(config, SubmitConfig):
+            args += ["-t", config.time]
+            if config.jobname:
+                args += ["-J", config.jobname]
+            if config.mail_type:
+                args += ["--mail-type", ",".join(config.mail_type)]
+            if config.mail_user:
+                args += ["--mail-user", config.mail_user]
+
     elif tp == "sbatch":
         args += ["#!/usr/bin/bash"]
         args += [f"#SBATCH -N {slurm_config.nodes}"]
-        args += [f"#SBATCH -n {slurm_config.ntasks}"]
+        args += [f"#SBATCH {' '.join(task_args(slurm_config))}"]
         args += [f"#SBATCH -p {slurm_config.partition}"]
-        gpu_argname = "--gpus=" if general_config.get("gpu", False) else "--gres=gpu:"
+        if slurm_config.cluster:
+            args += [f"#SBATCH -M {slurm_config.cluster}"]
+        gpu_argname = gpu_arg(slurm_config, general_config)
         if slurm_config.gpu_type == "Any Type" or slurm_config.gpu_type == "Unknown GPU Type":
             args += [f"#SBATCH {gpu_argname}{slurm_config.num_gpus}"]
         else:
@@ -89,8 +323,11 @@ def get_command(
         args += [f"#SBATCH -c {slurm_config.cpus_per_task}"]
         if slurm_config.mem:
             args += [f"#SBATCH --mem {slurm_config.mem}"]
-        if slurm_config.other:
-            for line in parse_arguments(slurm_config.other):
+        if slurm_config.constraint:
+            args += [f"#SBATCH --constraint={slurm_config.constraint}"]
+        args += [f"#SBATCH {arg}" for arg in binding_args(slurm_config, "sbatch")]
+        if other:
+            for line in parse_arguments(other):
                 args += [f"#SBATCH {line}"]
 
         if isinstance(config, SubmitConfig):
@@ -105,6 +342,9 @@ def get_command(
                 args += [f"#SBATCH --mail-type {','.join(config.mail_type)}"]
             if config.mail_user:
                 args += [f"#SBATCH --mail-user {config.mail_user}"]
+            if config.resubmit > 0 and config.task == 1:  # the job script traps the signal
+                args += [f"#SBATCH --signal=B:USR1@{config.signal_lead}"]
+                args += ["#SBATCH --open-mode=append"]
 
     return args
 
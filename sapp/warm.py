@@ -0,0 +1,193 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import fcntl
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import warnings
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from . import utils
+from .config import SubmitConfig
+
+
+class WarmPool:
+    """
+    Keep `salloc` allocations alive between interactive runs, so that the next `spython` call with the same
+    config could start inside the allocation with `srun --jobid <id> --overlap` instead of queueing again.
+
+    Each allocation is recorded as `<jobid>.json` in the pool folder. A detached watcher releases the allocation
+    once it has been idle for `timeout` seconds.
+    """
+
+    def __init__(self, base_path: Path, timeout: int = 30 * 60) -> None:
+        self.folder = Path(base_path) / ".warm"
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.timeout = timeout
+        self.jobid: Optional[str] = None  # the allocation in use by `acquire`, None for a normal srun
+
+    @staticmethod
+    def digest(config: SubmitConfig) -> str:
+        """allocations could be shared only if the resources and the time limit are the same."""
+        return f"{utils.config_digest(config.slurm_config)}-{config.time}"
+
+    @staticmethod
+    def is_running(jobid: str, cluster: str = None) -> bool:
+        proc = subprocess.run(
+            ["squeue", "-j", str(jobid), "-h", "-o", "%T"] + (["-M", cluster] if cluster else []),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # with -M, squeue prints a "CLUSTER: name" line first
+        return proc.returncode == 0 and proc.stdout.decode().split()[-1:] == ["RUNNING"]
+
+    @staticmethod
+    def is_busy(record: dict) -> bool:
+        pid = record.get("pid")
+        return pid is not None and (Path("/proc") / str(pid)).exists()
+
+    def read(self, jobid: str) -> Optional[dict]:
+        try:
+            with open(self.folder / f"{jobid}.json", "r") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def write(self, record: dict):
+        path = self.folder / f"{record['jobid']}.json"
+        with open(path.with_suffix(".tmp"), "w") as f:
+            f.write(json.dumps(record))
+        os.replace(path.with_suffix(".tmp"), path)
+
+    def discard(self, jobid: str):
+        (self.folder / f"{jobid}.json").unlink(missing_ok=True)
+
+    @contextmanager
+    def lock(self):
+        with open(self.folder / ".lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def claim(self, digest: str) -> Optional[dict]:
+        """find an idle allocation with the same digest and mark it as busy."""
+        with self.lock():
+            for path in sorted(self.folder.glob("*.json")):
+                record = self.read(path.stem)
+                if record is None or record["digest"] != digest or self.is_busy(record):
+                    continue
+                if not self.is_running(record["jobid"], record.get("cluster")):
+                    self.discard(record["jobid"])
+                    continue
+                record["pid"] = os.getpid()
+                self.write(record)
+                return record
+        return None
+
+    def allocate(self, config: SubmitConfig, general_config: dict, exclude: List[str] = None) -> Optional[str]:
+        """request a new allocation with salloc. Return the job id, or None on failure."""
+        args = utils.get_command(config, tp="salloc", general_config=general_config, exclude=exclude)
+
+        # salloc reports the allocation progress on stderr, forward it to the console
+        jobid = None
+        proc = subprocess.Popen(args, stderr=subprocess.PIPE)
+        for line in proc.stderr:
+            line = line.decode(errors="replace")
+            print(line, end="", file=sys.stderr)
+            match = re.search(r"(?:Pending|Granted) job allocation (\d+)", line)
+            if match:
+                jobid = match.group(1)
+        proc.wait()
+
+        if proc.returncode != 0 or jobid is None:
+            return None
+        return jobid
+
+    def watch_command(self, jobid: str) -> List[str]:
+        return [
+            sys.executable,
+            "-c",
+            "from sapp.warm import WarmPool; WarmPool({!r}, {}).watch({!r})".format(
+                str(self.folder.parent), self.timeout, jobid
+            ),
+        ]
+
+    @contextmanager
+    def acquire(
+        self, config: SubmitConfig, general_config: dict, identifier: str = None, exclude: List[str] = None
+    ) -> Iterator[List[str]]:
+        """
+        Yield the srun command that runs inside a warm allocation matching the config.
+        If no allocation could be made, fall back to a normal srun command. The `exclude` nodes are not allocated.
+        """
+        args = utils.get_command(
+            config, tp="srun", identifier=identifier, general_config=general_config, exclude=exclude
+        )
+        digest = self.digest(config)
+
+        record = self.claim(digest)
+        if record is None:
+            jobid = self.allocate(config, general_config, exclude)
+            if jobid is None:
+                warnings.warn("Fails to create a warm allocation. Fall back to a normal srun.", UserWarning)
+                yield args
+                return
+            record = {
+                "jobid": jobid,
+                "digest": digest,
+                "pid": os.getpid(),
+                "last_used": time.time(),
+                "cluster": config.slurm_config.cluster,
+            }
+            self.write(record)
+            subprocess.Popen(
+                self.watch_command(jobid),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        else:
+            print(f"sapp: Reuse warm allocation {record['jobid']}", file=sys.stderr)
+
+        self.jobid = record["jobid"]
+        try:
+            yield args[:1] + ["--jobid", record["jobid"], "--overlap"] + args[1:]
+        finally:
+            self.jobid = None
+            with self.lock():
+                record["pid"] = None
+                record["last_used"] = time.time()
+                if self.read(record["jobid"]) is not None:
+                    self.write(record)
+
+    def watch(self, jobid: str, interval: int = 30):
+        """
+        Release the allocation once it is idle for longer than the timeout. Runs in a detached process.
+        """
+        while True:
+            time.sleep(interval)
+            with self.lock():
+                record = self.read(jobid)
+                if record is None:
+                    return
+                cluster = record.get("cluster")
+                if not self.is_running(jobid, cluster):
+                    self.discard(jobid)
+                    return
+                if not self.is_busy(record) and time.time() - record["last_used"] > self.timeout:
+                    subprocess.run(
+                        ["scancel", str(jobid)] + (["-M", cluster] if cluster else []),
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                    )
+                    self.discard(jobid)
+                    return
@@ -0,0 +1,206 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import argparse
+import json
+import os
+import re
+import shlex
+import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from dataclasses import replace
+from typing import Dict, List, Optional
+
+from .config import SubmitConfig
+from .core import Database
+from .headless import submit_config
+from .tracing import tracer
+
+
+# the stage name is a part of the job folder name
+STAGE_NAME = re.compile(r"^[\w.-]+$")
+STAGE_KEYS = ("name", "command", "config", "after", "time", "jobname", "slash")
+
+
+def load(path: str) -> List[dict]:
+    """
+    Read the stages of a workflow file, e.g.
+
+        {"stages": [
+            {"name": "prep", "command": "python prep.py", "config": "cpu"},
+            {"name": "train", "command": ["python", "train.py"], "config": "A40x4", "after": ["prep"]}
+        ]}
+
+    The command is a list or a string split like a shell. `config` is the name of a saved setting (the most recent
+    one if omitted), `after` the stages to finish successfully first. `time`, `jobname` and `slash` override the
+    command line for the stage.
+    """
+    with open(path, "r") as f:
+        data = json.loads(f.read())
+    if not isinstance(data, dict) or not isinstance(data.get("stages"), list) or not data["stages"]:
+        raise ValueError("The workflow should be an object with a non-empty list of stages.")
+
+    stages = []
+    for stage in data["stages"]:
+        if not isinstance(stage, dict):
+            raise ValueError(f"Stage {stage!r} is not an object.")
+        unknown = [key for key in stage if key not in STAGE_KEYS]
+        if unknown:
+            raise ValueError(f"Unknown keys {', '.join(unknown)} in stage {stage.get('name')!r}.")
+        name = stage.get("name")
+        if not isinstance(name, str) or not STAGE_NAME.match(name):
+            raise ValueError(f"Invalid stage name {name!r}. Use letters, digits, '_', '-' and '.'.")
+        command = stage.get("command")
+        command = shlex.split(command) if isinstance(command, str) else command
+        if not command or not isinstance(command, list):
+            raise ValueError(f"No command for stage {name}.")
+        after = stage.get("after", [])
+        after = [after] if isinstance(after, str) else list(after)
+        stages.append({**stage, "command": [str(arg) for arg in command], "after": after})
+
+    names = [stage["name"] for stage in stages]
+    for stage in stages:
+        if names.count(stage["name"]) > 1:
+            raise ValueError(f"Duplicate stage {stage['name']}.")
+        missing = [name for name in stage["after"] if name not in names]
+        if missing:
+            raise ValueError(f"Stage {stage['name']} depends on unknown stages {', '.join(missing)}.")
+    return stages
+
+
+def waves(stages: List[dict]) -> List[List[dict]]:
+    """group the stages so that each one only depends on the earlier groups. Raise ValueError on cycles."""
+    done, result = set(), []
+    remaining = list(stages)
+    while remaining:
+        wave = [stage for stage in remaining if all(name in done for name in stage["after"])]
+        if not wave:
+            raise ValueError(f"Cyclic dependencies among stages {', '.join(s['name'] for s in remaining)}.")
+        result.append(wave)
+        done.update(stage["name"] for stage in wave)
+        remaining = [stage for stage in remaining if stage["name"] not in done]
+    return result
+
+
+def stage_configs(database: Database, stages: List[dict], config: SubmitConfig) -> Dict[str, SubmitConfig]:
+    """the submit config of each stage. Raise ValueError for unknown settings."""
+    settings = {s.name: s for s in database.settings}
+    configs = {}
+    for stage in stages:
+        name = stage.get("config")
+        if name is not None and name not in settings:
+            raise ValueError(f"No saved setting named {name} for stage {stage['name']}.")
+        if name is None and config.slurm_config is None:
+            raise ValueError(f"No recent setting for stage {stage['name']}. Please give a config.")
+        configs[stage["name"]] = replace(
+            config,
+            slurm_config=settings[name] if name is not None else config.slurm_config,
+            time=stage.get("time", config.time),
+            jobname=stage.get("jobname", f"{config.jobname}-{stage['name']}" if config.jobname else stage["name"]),
+            slash=stage.get("slash", config.slash),
+            resubmit=0,  # the stages after would wait for the first job of a chain, which never succeeds
+        )
+    clusters = {c.slurm_config.cluster for c in configs.values()}
+    if len(clusters) > 1:
+        raise ValueError("Dependencies do not work across clusters. Please submit the stages to one cluster.")
+    return configs
+
+
+def submit(database: Database, stages: List[dict], configs: Dict[str, SubmitConfig]) -> Dict[str, Optional[str]]:
+    """
+    Submit the stages with sbatch, each one with --dependency=afterok on the jobs of the stages it comes after.
+    The stages of a wave are submitted concurrently. The stages after a failed submission are skipped. Return the
+    job id of each stage, None if not submitted.
+    """
+    identifier = database.identifier
+    jobids: Dict[str, Optional[str]] = {}
+
+    def run(stage: dict) -> Optional[str]:
+        # each stage has its own job folder, like a normal sbatch job
+        stage_database = copy(database)
+        stage_database.identifier = f"{identifier}_{stage['name']}"
+        dependency = "afterok:" + ":".join(jobids[name] for name in stage["after"]) if stage["after"] else None
+        with tracer.span(f"stage {stage['name']}"):
+            return stage_database.execute(stage["command"], configs[stage["name"]], check=False, dependency=dependency)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for wave in waves(stages):
+            ready = []
+            for stage in wave:
+                if all(jobids[name] is not None for name in stage["after"]):
+                    ready.append(stage)
+                else:
+                    warnings.warn(
+                        f"Skip stage {stage['name']} since the stages before it fail to submit.", UserWarning
+                    )
+                    jobids[stage["name"]] = None
+            for stage, jobid in zip(ready, pool.map(run, ready)):
+                jobids[stage["name"]] = jobid
+    return jobids
+
+
+def save(database: Database, path: str, stages: List[dict], jobids: Dict[str, Optional[str]]):
+    """save the graph and the job ids to workflow.json in the job folder of every submitted stage."""
+    data = {
+        "identifier": database.identifier,
+        "file": path,
+        "stages": [
+            {**stage, "identifier": f"{database.identifier}_{stage['name']}", "jobid": jobids.get(stage["name"])}
+            for stage in stages
+        ],
+    }
+    for stage in data["stages"]:
+        folder = database.base_path / stage["identifier"]
+        if folder.is_dir():
+            with open(folder / "workflow.json", "w") as f:
+                f.write(json.dumps(data, indent=4))
+
+
+def cli(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="sapp workflow",
+        description="Submit the stages of a workflow file with sbatch, chained by their dependencies.",
+    )
+    parser.add_argument("file", help="the workflow file in json.")
+    parser.add_argument("--slash", default=None, help="slash environment to use. 'none' to disable.")
+    parser.add_argument("-t", "--time", default=None, help="time limit of the stages, e.g. 0-01:00:00.")
+    parser.add_argument("-J", "--jobname", default=None, help="job name prefix for slurm. Default: the stage names.")
+    parser.add_argument(
+        "--force", action="store_true", help="submit even if a stage breaks the partition or QOS limits."
+    )
+    parser.add_argument("--profile", action="store_true", help="save the time of each phase to trace.json.")
+    parser.set_defaults(sbatch=True, speculative=None)
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        tracer.enable()
+
+    database = Database()
+    config = submit_config(database, args)
+    try:
+        stages = load(args.file)
+        waves(stages)
+        configs = stage_configs(database, stages, config)
+    except (OSError, ValueError) as e:
+        parser.exit(1, f"sapp workflow: {e}\n")
+
+    # check every stage first, so that nothing is submitted if one could never start
+    for stage in stages:
+        reasons = database.check_limits(configs[stage["name"]], count_jobs=True)
+        if reasons and not args.force:
+            parser.exit(
+                1,
+                f"sapp workflow: stage {stage['name']} could never start: {'; '.join(reasons)}. "
+                "Use --force to submit anyway.\n",
+            )
+
+    jobids = submit(database, stages, configs)
+    save(database, os.path.abspath(args.file), stages, jobids)
+    tracer.save(database.base_path / f"{database.identifier}_{stages[0]['name']}")
+    for stage in stages:
+        after = f" after {', '.join(stage['after'])}" if stage["after"] else ""
+        print(f"sapp: Stage {stage['name']}: job {jobids[stage['name']] or '(not submitted)'}{after}", file=sys.stderr)
+    if not all(jobids.values()):
+        sys.exit(1)
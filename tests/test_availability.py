@@ -0,0 +1,25 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+from sapp.availability import ANY_TYPE, AvailabilitySeries
+
+
+CARDS = {"gpu": {"a100": [{"gpu": 2, "cpu": 16, "mem": 64000}], "v100": [{"gpu": 1, "cpu": 8, "mem": 32000}]}}
+
+
+def test_records_stay_sorted(tmp_path):
+    series = AvailabilitySeries(tmp_path)
+    series.record(CARDS, now=1000.0)
+    series.record(CARDS, now=900.0)  # a recorder with a clock behind
+    times = [t for t, *_ in series.query(0, 2000)]
+    assert times == sorted(times)
+    assert len(list(series.query(1000, 1001))) == 6
+
+
+def test_query_by_key(tmp_path):
+    series = AvailabilitySeries(tmp_path)
+    for i in range(3):
+        series.record(CARDS, now=1000.0 + i * 300)
+    key = series.key_index("gpu", ANY_TYPE)
+    records = list(series.query(1000, 1600, key))
+    assert [(t, gpu) for t, _, gpu, _, _ in records] == [(1000.0, 3), (1300.0, 3)]
@@ -0,0 +1,100 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from sapp.backend import CLIBackend, RestBackend
+
+
+PREFIX = "/slurm/v0.0.40/"
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """a stand-in slurmrestd that knows a few jobs and accepts submissions."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive, as slurmrestd
+
+    def reply(self, status: int, data: dict):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        jobid = self.path[len(PREFIX + "job/") :] if self.path.startswith(PREFIX + "job/") else None
+        if jobid in self.server.jobs:
+            self.reply(200, {"jobs": [self.server.jobs[jobid]], "errors": []})
+        else:
+            self.reply(404, {"errors": [{"error": f"Unknown request {self.path}"}]})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(("POST", self.path))
+        self.server.submitted.append(body)
+        time.sleep(self.server.delay)
+        self.reply(200, {"job_id": 42, "errors": []})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.daemon_threads = True
+    server.requests, server.submitted, server.delay = [], [], 0
+    server.jobs = {
+        "1": {
+            "job_id": 1,
+            "job_state": ["RUNNING"],
+            "start_time": {"set": True, "number": int(time.time()) - 65},
+            "end_time": {"set": True, "number": 0},
+            "nodes": "node01",
+            "partition": "gpu",
+        }
+    }
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def backend(server, monkeypatch):
+    monkeypatch.setattr(CLIBackend, "submit", lambda self, path: pytest.fail("fell back to sbatch"))
+    monkeypatch.setattr(CLIBackend, "job_states", lambda self, jobids, cluster=None: pytest.fail("fell back"))
+    return RestBackend(f"http://127.0.0.1:{server.server_address[1]}")
+
+
+def test_job_states_queries_each_job(server, backend):
+    states = backend.job_states(["1", "2"])
+    assert list(states) == ["1"]
+    assert states["1"]["state"] == "RUNNING"
+    assert states["1"]["node"] == "node01"
+    assert server.requests == [("GET", PREFIX + "job/1"), ("GET", PREFIX + "job/2")]
+
+
+def test_submit_translates_the_script(server, backend, tmp_path):
+    script = tmp_path / "script.sh"
+    script.write_text("#!/usr/bin/bash\n#SBATCH -N 1\n#SBATCH -p gpu\n#SBATCH -t 0-12\n\necho hi\n")
+    assert backend.submit(script) == "42"
+    job = server.submitted[0]["job"]
+    assert job["partition"] == "gpu"
+    assert job["time_limit"]["number"] == 12 * 60
+
+
+def test_submit_is_not_sent_again_after_a_timeout(server, backend, tmp_path):
+    script = tmp_path / "script.sh"
+    script.write_text("#!/usr/bin/bash\n#SBATCH -N 1\n\necho hi\n")
+    backend.pool.timeout = 0.2
+    server.delay = 1
+    assert backend.submit(script) is None
+    assert server.requests == [("POST", PREFIX + "job/submit")]
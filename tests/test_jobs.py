@@ -0,0 +1,26 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import os
+
+from sapp.jobs import JobIndex
+
+
+def test_refresh_sees_a_rewritten_job_id(tmp_path):
+    folder = tmp_path / "job"
+    folder.mkdir()
+    (folder / "SLURM_JOB_ID").write_text("100")
+    index = JobIndex(tmp_path)
+    index.refresh()
+    index.update({"100": {"state": "TIMEOUT", "elapsed": "1:00:00", "node": "n1", "partition": "gpu"}})
+    assert index.entries["job"]["final"]
+
+    # the next job of a chain rewrites the file in place, the folder mtime stays
+    folder_mtime = folder.stat().st_mtime_ns
+    (folder / "SLURM_JOB_ID").write_text("101")
+    os.utime(folder / "SLURM_JOB_ID", ns=(folder_mtime + 10**9, folder_mtime + 10**9))
+    os.utime(folder, ns=(folder_mtime, folder_mtime))
+
+    entry = index.refresh()["job"]
+    assert entry["jobid"] == "101"
+    assert not entry.get("final")
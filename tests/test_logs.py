@@ -0,0 +1,39 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import gzip
+import io
+
+import pytest
+
+from sapp.logs import log_segments, search
+
+
+LOG = b"Error: first\nstep 1 ok\nError: second\nwarning: not ok yet\nstep 2 ok\n"
+
+
+@pytest.fixture(params=["plain", "gz"])
+def segments(request, tmp_path):
+    path = tmp_path / "output.txt"
+    if request.param == "gz":
+        with gzip.open(tmp_path / "output.txt.1.gz", "wb") as f:
+            f.write(LOG)
+    else:
+        path.write_bytes(LOG)
+    return log_segments(path)
+
+
+@pytest.mark.parametrize(
+    "pattern, ignore_case, lines",
+    [
+        ("^Error", False, [b"Error: first", b"Error: second"]),
+        ("ok$", False, [b"step 1 ok", b"step 2 ok"]),
+        ("^error", True, [b"Error: first", b"Error: second"]),
+        ("^step \\d ok$", False, [b"step 1 ok", b"step 2 ok"]),
+        ("missing", False, []),
+    ],
+)
+def test_search(segments, pattern, ignore_case, lines):
+    out = io.BytesIO()
+    assert search(segments, pattern, out, ignore_case) == len(lines)
+    assert out.getvalue().splitlines() == lines
@@ -0,0 +1,77 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import json
+import time
+
+import pytest
+
+from sapp import retry
+from sapp.retry import Blacklist, Retry, exclude_script, merge_exclude
+
+
+@pytest.mark.parametrize(
+    "other, nodes, expected",
+    [
+        (None, [], None),
+        (None, ["n1"], "--exclude=n1"),
+        ("-q high", ["n1", "n2"], "-q high --exclude=n1,n2"),
+        ("--exclude a -q high", ["b"], "-q high --exclude=a,b"),
+        ("-x a,b --exclude=c", ["b", "d"], "--exclude=a,b,c,d"),
+    ],
+)
+def test_merge_exclude(other, nodes, expected):
+    assert merge_exclude(other, nodes) == expected
+
+
+def test_exclude_script():
+    script = "#!/usr/bin/bash\n#SBATCH -N 1\n#SBATCH -x a\n#SBATCH -p gpu\n\necho $SLURM_JOB_ID\n"
+    assert exclude_script(script, ["b"]) == (
+        "#!/usr/bin/bash\n#SBATCH -N 1\n#SBATCH -p gpu\n#SBATCH --exclude=a,b\n\necho $SLURM_JOB_ID\n"
+    )
+
+
+def test_blacklist_expires(tmp_path, monkeypatch):
+    blacklist = Blacklist(tmp_path, ttl=60)
+    blacklist.add("n1", None, "NODE_FAIL of job 1")
+    blacklist.add("n2", "c2", "NODE_FAIL of job 2")
+    assert blacklist.nodes() == ["n1"]
+    assert blacklist.nodes("c2") == ["n2"]
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert blacklist.nodes() == []
+    assert Blacklist(tmp_path, ttl=120).nodes() == ["n1"]
+
+
+def test_follow_the_chain_then_retry(tmp_path, monkeypatch):
+    folder = tmp_path / "job"
+    folder.mkdir()
+    (folder / "job.json").write_text(json.dumps({"slurm_config": {"cluster": None}}))
+    (folder / "script.sh").write_text("#!/usr/bin/bash\n#SBATCH -N 1\n\necho hi\n")
+    (folder / "SLURM_JOB_ID").write_text("1")
+
+    def query_states(jobids, clusters=None):
+        jobid = jobids[0]
+        if jobid == "1":
+            # the chain trap submits job 2 before job 1 times out
+            (folder / "SLURM_JOB_ID").write_text("2")
+            return {"1": {"state": "TIMEOUT", "node": "n1"}}
+        if jobid == "2":
+            (folder / "HOSTNAME").write_text("n2")
+            return {"2": {"state": "NODE_FAIL", "node": "n2"}}
+        return {jobid: {"state": "COMPLETED", "node": "n3"}}
+
+    class Backend:
+        def submit(self, path):
+            return "3"
+
+    monkeypatch.setattr(retry, "query_states", query_states)
+    monkeypatch.setattr(retry, "get_backend", Backend)
+    Retry(folder, retries=1).watch(interval=0)
+
+    assert (folder / "RETRY").read_text() == "2 NODE_FAIL n2 3\n"
+    assert (folder / "SLURM_JOB_ID").read_text() == "3"
+    assert "#SBATCH --exclude=n2" in (folder / "script.sh").read_text()
+    assert Blacklist(tmp_path).nodes() == ["n2"]
+    assert not (folder / "WATCHER").exists()
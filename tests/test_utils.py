@@ -0,0 +1,34 @@
+# Copyright (c) Haoyi Wu.
+# Licensed under the MIT license.
+
+import pytest
+
+from sapp.config import SlurmConfig
+from sapp.utils import bound_command, parse_duration
+
+
+@pytest.mark.parametrize(
+    "value, seconds",
+    [
+        ("60", 3600),
+        ("05:30", 330),
+        ("01:02:03", 3723),
+        ("0-12", 43200),
+        ("0-01:30", 5400),
+        ("1-00:00:00", 86400),
+        ("2-03", 2 * 86400 + 3 * 3600),
+        ("00:05.500", 5.5),
+        ("", 0),
+        ("invalid", 0),
+    ],
+)
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+def test_bound_command():
+    config = SlurmConfig(cpus_per_task=8, cpu_bind="cores", mem_bind="local", set_threads=True)
+    command = bound_command("python train.py", config)
+    assert command.startswith("srun -N 1 -n 1 -c 8 ")
+    assert "--cpu-bind=cores --mem-bind=local --export=ALL,OMP_NUM_THREADS=8,MKL_NUM_THREADS=8 " in command
+    assert command.endswith(" python train.py")